@@ -0,0 +1,149 @@
+""" Micro-benchmarks for the collection processing and retrieval stages
+Usage: python benchmarks.py [benchmark ...]   (runs every benchmark when none is given)
+"""
+
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+import parsers
+
+BENCHMARK_SAMPLE_SIZE = 2000
+BENCHMARK_REPEATS = 3
+IMPORT_BENCHMARK_MODULES = ('metrics', 'main', 'classifier', 'graphIR')
+POSTING_BENCHMARK_TERMS = 100
+
+
+def sample_raw_docs(n=BENCHMARK_SAMPLE_SIZE):
+    raw_docs = []
+    collection_dir = f"{parsers.COLLECTION_PATH}{parsers.DATASET}"
+    if os.path.isdir(collection_dir):
+        for directory in sorted(os.listdir(collection_dir))[:-3]:
+            for file_name in sorted(os.listdir(f"{collection_dir}/{directory}"))[:n - len(raw_docs)]:
+                with open(f"{collection_dir}/{directory}/{file_name}", encoding='ISO-8859-1') as f:
+                    raw_docs.append(f.read())
+            if len(raw_docs) >= n:
+                break
+    else:
+        for chunk in parsers.archive_member_chunks(('train', 'test'), n):
+            raw_docs = [raw_doc for _, _, _, raw_doc in chunk]
+            break
+    return raw_docs
+
+
+def timed(function, repeats=BENCHMARK_REPEATS):
+    timings, result = [], None
+    for _ in range(repeats):
+        start_time = time.perf_counter()
+        result = function()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings), result
+
+
+def benchmark_xml_backends(raw_docs=None, repeats=BENCHMARK_REPEATS):
+    raw_docs = raw_docs if raw_docs is not None else sample_raw_docs()
+    docs_per_second, outputs = {}, {}
+    for backend in parsers.XML_EXTRACTORS:
+        elapsed_time, outputs[backend] = timed(lambda: [parsers.parse_xml_string(raw_doc, backend) for raw_doc in raw_docs], repeats)
+        docs_per_second[backend] = len(raw_docs) / max(elapsed_time, 1e-9)
+        print(f"{backend:>10}: {docs_per_second[backend]:10.1f} docs/s")
+    reference = outputs.pop('bs4')
+    for backend, output in outputs.items():
+        print(f"{backend:>10}: {sum(a != b for a, b in zip(reference, output))} of {len(raw_docs)} documents differ from bs4")
+    return docs_per_second
+
+
+def benchmark_analyzers(raw_docs=None, repeats=BENCHMARK_REPEATS):
+    # The first repeat runs with cold normalisation caches, the best one shows the memoised throughput
+    import main
+    from normcache import normalisation_report
+    raw_docs = raw_docs if raw_docs is not None else sample_raw_docs()
+    raw_texts = [' '.join(doc.values()) for raw_doc in raw_docs for doc in parsers.parse_xml_string(raw_doc).values()]
+    texts_per_second = {}
+    for analyzer in (main.raw_analyzer, main.stem_analyzer, main.lemma_analyzer):
+        elapsed_time, _ = timed(lambda: [analyzer.process_raw_text(raw_text) for raw_text in raw_texts], repeats)
+        texts_per_second[analyzer.name] = len(raw_texts) / max(elapsed_time, 1e-9)
+        print(f"{analyzer.name:>20}: {texts_per_second[analyzer.name]:10.1f} texts/s")
+    normalisation_report()
+    return texts_per_second
+
+
+def benchmark_imports(modules=IMPORT_BENCHMARK_MODULES, repeats=BENCHMARK_REPEATS):
+    # Every import runs in a fresh interpreter, so the timings include interpreter startup but no cached modules
+    project_dir = os.path.dirname(os.path.abspath(__file__))
+    import_seconds = {}
+    for module in modules:
+        import_seconds[module], _ = timed(lambda: subprocess.run([sys.executable, '-c', f'import {module}'], cwd=project_dir,
+                                                                 capture_output=True, check=True), repeats)
+        print(f"{module:>20}: {import_seconds[module]:10.3f}s")
+    return import_seconds
+
+
+def benchmark_posting_file(raw_docs=None, repeats=BENCHMARK_REPEATS, n_terms=POSTING_BENCHMARK_TERMS):
+    # Sizes against the in-memory (terms x docs) matrix, then decode speed of whole terms, of every term, and of
+    # skip pointer lookups of single documents
+    import numpy as np
+    from scipy import sparse
+    from sklearn.feature_extraction.text import CountVectorizer
+    import main
+    from postingfile import open_posting_file, save_posting_file
+    raw_docs = raw_docs if raw_docs is not None else sample_raw_docs()
+    raw_texts = [' '.join(main.stem_analyzer.process_raw_text(' '.join(doc.values())))
+                 for raw_doc in raw_docs for doc in parsers.parse_xml_string(raw_doc).values()]
+    count_index = CountVectorizer(analyzer=str.split)
+    counts = sparse.csc_matrix(count_index.fit_transform(raw_texts))
+    rng = np.random.default_rng(0)
+    terms = rng.choice(counts.shape[1], min(n_terms, counts.shape[1]), replace=False)
+    frequent = int(np.argmax(np.diff(counts.indptr)))
+    docs = np.sort(rng.choice(counts.shape[0], min(n_terms, counts.shape[0]), replace=False))
+    with tempfile.TemporaryDirectory() as directory:
+        path = f'{directory}/postings'
+        write_time, posting_file = timed(lambda: save_posting_file(path, counts, count_index.vocabulary_), repeats)
+        open_time, posting_file = timed(lambda: open_posting_file(path), repeats)
+        terms_time, _ = timed(lambda: posting_file.decode(terms), repeats)
+        all_time, _ = timed(posting_file.count_matrix, repeats)
+        lookup_time, _ = timed(lambda: posting_file.lookup(frequent, docs), repeats)
+        frequent_time, _ = timed(lambda: posting_file.postings(frequent), repeats)
+        results = {
+            'postings': counts.nnz,
+            'matrix bytes': counts.data.nbytes + counts.indices.nbytes + counts.indptr.nbytes,
+            'file bytes': posting_file.size(),
+            'doc id bytes': os.path.getsize(f'{path}.docs'),
+            'write s': write_time,
+            'open s': open_time,
+            'postings/s': counts.nnz / max(all_time, 1e-9),
+            'term postings/s': posting_file.document_frequencies()[terms].sum() / max(terms_time, 1e-9),
+            'lookup s': lookup_time,
+            'full term s': frequent_time,
+        }
+        posting_file.close()
+    print(f"{'postings':>20}: {results['postings']} in {len(raw_texts)} docs, {counts.shape[1]} terms")
+    print(f"{'size':>20}: {results['file bytes'] / 1024:10.1f}kb on disk, {results['matrix bytes'] / 1024:10.1f}kb as a matrix "
+          f"({results['doc id bytes'] * 8 / max(counts.nnz, 1):.2f} bits per doc id)")
+    print(f"{'write':>20}: {write_time:10.3f}s")
+    print(f"{'open':>20}: {open_time * 1000:10.3f}ms")
+    print(f"{'decode all':>20}: {results['postings/s']:10.1f} postings/s")
+    print(f"{'decode terms':>20}: {results['term postings/s']:10.1f} postings/s ({len(terms)} random terms)")
+    print(f"{'lookup':>20}: {lookup_time * 1000:10.3f}ms for {len(docs)} docs in the longest list, "
+          f"{frequent_time * 1000:.3f}ms to decode it all")
+    return results
+
+
+BENCHMARKS = {
+    'xml': benchmark_xml_backends,
+    'analyzers': benchmark_analyzers,
+    'imports': benchmark_imports,
+    'postings': benchmark_posting_file,
+}
+
+
+def main(names=()):
+    for name in names or BENCHMARKS:
+        print(f"\nRunning {name} benchmark...")
+        BENCHMARKS[name]()
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
@@ -0,0 +1,128 @@
+""" Vectorised BM25 (k1, b) grid search
+Term frequencies, document lengths and IDF are computed once and the count matrices are cut down to the query terms,
+so every grid point costs one impact computation and sparse product per field and a top-p cut for the whole topic
+batch. The fields are summed as Whoosh's BM25F does: whoosh_bm25f_fields reads them from the Whoosh index (postings,
+quantised field lengths, average lengths, idf and the terms of the parsed queries), so the sweep tunes the model
+evaluation ranks with.
+Results are written after every grid point, so an interrupted sweep resumes where it stopped. Rows of other models
+already in the results file are kept; rows without a model are legacy Whoosh BM25F grid points.
+"""
+
+import json
+import os
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+from scipy import sparse
+from tqdm import tqdm
+
+from lazy import LazyModule, lazy_import
+from metrics import calc_hit_measures
+from sparse_bm25 import bm25_impacts, top_p
+
+pd = LazyModule('pandas')
+BM25F = lazy_import('whoosh.scoring', 'BM25F')
+
+LEGACY_SWEEP_MODEL = 'bm25f'  # model of the rows written before sweeps recorded it
+
+worker_sweep = None
+
+
+def whoosh_bm25f_fields(searcher, queries, doc_rows):
+    # queries: the (field, term) pairs of every parsed query; doc_rows: Whoosh docnum -> matrix row
+    reader = searcher.reader()
+    n_rows, weighting = doc_rows.max(initial=-1) + 1, BM25F()
+    fields = []
+    for field in sorted({field for query in queries for field, _ in query}):
+        terms = sorted({text for query in queries for query_field, text in query if query_field == field and (field, text) in reader})
+        columns = {text: column for column, text in enumerate(terms)}
+        rows, term_columns, tfs = [], [], []
+        for column, text in enumerate(terms):
+            matcher = searcher.postings(field, text)
+            while matcher.is_active():
+                rows.append(doc_rows[matcher.id()])
+                term_columns.append(column)
+                tfs.append(matcher.weight())
+                matcher.next()
+        counts = sparse.csr_matrix((tfs, (rows, term_columns)), shape=(n_rows, len(terms)), dtype=np.float64)
+        doc_lengths = np.ones(n_rows)
+        for docnum, row in enumerate(doc_rows.tolist()):
+            if row >= 0:
+                doc_lengths[row] = searcher.doc_field_length(docnum, field, 1)
+        idf = np.array([weighting.idf(searcher, field, text) for text in terms])
+        query_columns = [[columns[text] for query_field, text in query if query_field == field and text in columns] for query in queries]
+        query_matrix = sparse.csr_matrix((np.ones(sum(map(len, query_columns))),
+                                          (np.repeat(np.arange(len(queries)), [len(c) for c in query_columns]),
+                                           [column for c in query_columns for column in c])), shape=(len(queries), len(terms)))
+        fields.append((counts, doc_lengths, searcher.avg_field_length(field) or 1, idf, query_matrix))
+    return fields
+
+
+class BM25Sweep:
+    def __init__(self, fields, relevant_rows, n_expected, p, ks, model):
+        # fields: (counts, doc_lengths, avg_doc_length, idf, query_matrix) of every scored field
+        self.fields = []
+        for counts, doc_lengths, avg_doc_length, idf, query_matrix in fields:
+            query_matrix = sparse.csr_matrix(query_matrix, dtype=np.float64)
+            terms = np.unique(query_matrix.indices)
+            self.fields.append((sparse.csr_matrix(counts)[:, terms].tocsr(), doc_lengths, avg_doc_length, idf[terms],
+                                query_matrix[:, terms].tocsr()))
+        self.relevant_rows = [np.asarray(rows) for rows in relevant_rows]
+        self.n_expected = n_expected
+        self.p = p
+        self.ks = ks
+        self.model = model
+
+    def evaluate(self, k1, b):
+        scores = None
+        for counts, doc_lengths, avg_doc_length, idf, queries in self.fields:
+            field_scores = queries @ bm25_impacts(counts, doc_lengths, avg_doc_length, idf, k1, b).T
+            scores = field_scores if scores is None else scores + field_scores
+        rankings = top_p(sparse.csr_matrix(scores).tocsr(), self.p)
+        metrics_scores = defaultdict(list)
+        for (docs, _), relevant, n_expected in zip(rankings, self.relevant_rows, self.n_expected):
+            for metric, score in calc_hit_measures(np.isin(docs, relevant), n_expected, self.ks).items():
+                metrics_scores[metric].append(score)
+        return {**{metric: np.mean(scores) for metric, scores in metrics_scores.items()}, 'k1': k1, 'b': b, 'model': self.model}
+
+
+def init_sweep_worker(sweep):
+    global worker_sweep
+    worker_sweep = sweep
+
+
+def evaluate_grid_point(grid_point):
+    return worker_sweep.evaluate(*grid_point)
+
+
+def load_sweep_results(results_file):
+    return pd.read_json(results_file, orient='split') if os.path.isfile(results_file) else None
+
+
+def save_sweep_results(results, results_file):
+    with open(results_file, 'w') as f:
+        f.write(json.dumps(json.loads(results.to_json(orient='split')), indent=4))
+
+
+def run_sweep(sweep, k1_values, b_values, results_file, workers=1):
+    results = load_sweep_results(results_file)
+    if results is not None and 'model' not in results:
+        results['model'] = LEGACY_SWEEP_MODEL
+    done = results[results['model'] == sweep.model] if results is not None else None
+    grid = [(k1, b) for k1 in k1_values for b in b_values
+            if done is None or done.loc[np.isclose(done['k1'], k1) & np.isclose(done['b'], b)].empty]
+    if done is not None and len(done):
+        print(f"Resuming BM25 sweep from \"{results_file}\", {len(grid)} of {len(k1_values) * len(b_values)} grid points left")
+    pool = Pool(workers, initializer=init_sweep_worker, initargs=(sweep,)) if workers > 1 and len(grid) > 1 else None
+    try:
+        grid_results = pool.imap_unordered(evaluate_grid_point, grid) if pool else (sweep.evaluate(*grid_point) for grid_point in grid)
+        for grid_result in tqdm(grid_results, total=len(grid), desc=f'{"TUNING BM25":20}'):
+            update_data = pd.DataFrame(data=[grid_result])
+            results = update_data if results is None else pd.concat([results, update_data], ignore_index=True)
+            save_sweep_results(results, results_file)
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
+    return results[results['model'] == sweep.model].reset_index(drop=True) if results is not None else None
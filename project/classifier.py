@@ -3,23 +3,27 @@ import random
 from copy import deepcopy
 from enum import Enum
 
-from sklearn.model_selection import GridSearchCV
-
 import main as p1
 from typing import List
 
 import scipy as sy
 
-import jsonpickle
-from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
-from sklearn.naive_bayes import MultinomialNB
-from sklearn.neighbors import KNeighborsClassifier
-from sklearn.neural_network import MLPClassifier
 from scipy.sparse import hstack
 
-from BM25Vectorizer import *
+from lazy import LazyObject, lazy_import
 from metrics import *
 from parsers import *
+from qrels import UNJUDGED, as_qrels
+from runs import RUN_SUFFIX, load_run, run_exists, save_run
+
+GridSearchCV = lazy_import('sklearn.model_selection', 'GridSearchCV')
+TfidfVectorizer = lazy_import('sklearn.feature_extraction.text', 'TfidfVectorizer')
+CountVectorizer = lazy_import('sklearn.feature_extraction.text', 'CountVectorizer')
+MultinomialNB = lazy_import('sklearn.naive_bayes', 'MultinomialNB')
+KNeighborsClassifier = lazy_import('sklearn.neighbors', 'KNeighborsClassifier')
+MLPClassifier = lazy_import('sklearn.neural_network', 'MLPClassifier')
+BM25Vectorizer = lazy_import('BM25Vectorizer', 'BM25Vectorizer')
+BM25Scorer = lazy_import('BM25Vectorizer', 'BM25Scorer')
 
 OVERRIDE_SAVED_JSON = False
 TESTED_N_NEIGHBOURS = (1, 3, 5, 7)
@@ -169,24 +173,24 @@ class SparseVectorClassifier:
         return self.classifier.predict_proba(self.transform(X))
 
 
-# TESTED CLASSIFIERS
-mlp_classifier = NamedClassifier(MLPClassifier(random_state=1, max_iter=1000), "MLP", "mlp")  # unused but working
-mnb_classifier = NamedClassifier(MultinomialNB(), 'Multinomial Naïve Bayes', "mnb")
-knn_classifier = NamedClassifier(KNeighborsClassifier(n_neighbors=3), 'KNN', "knn")
+# TESTED CLASSIFIERS (built on first use, so importing this module does not load sklearn)
+mlp_classifier = NamedClassifier(LazyObject(MLPClassifier, random_state=1, max_iter=1000), "MLP", "mlp")  # unused but working
+mnb_classifier = NamedClassifier(LazyObject(MultinomialNB), 'Multinomial Naïve Bayes', "mnb")
+knn_classifier = NamedClassifier(LazyObject(KNeighborsClassifier, n_neighbors=3), 'KNN', "knn")
 
 # TESTED TUNING
-tuned_knn_classifier = NamedClassifier(GridSearchCV(KNeighborsClassifier(), {'n_neighbors': TESTED_N_NEIGHBOURS, 'metric': TESTED_KNN_DISTANCES}, verbose=0, cv=3), 'Tuned KNN')
-tuned_mlp_classifier = NamedClassifier(GridSearchCV(MLPClassifier(max_iter=500), {'hidden_layer_sizes': TESTED_LAYER_COMPS}, verbose=0, cv=3), 'Tuned MLP')
+tuned_knn_classifier = NamedClassifier(LazyObject(GridSearchCV, LazyObject(KNeighborsClassifier), {'n_neighbors': TESTED_N_NEIGHBOURS, 'metric': TESTED_KNN_DISTANCES}, verbose=0, cv=3), 'Tuned KNN')
+tuned_mlp_classifier = NamedClassifier(LazyObject(GridSearchCV, LazyObject(MLPClassifier, max_iter=500), {'hidden_layer_sizes': TESTED_LAYER_COMPS}, verbose=0, cv=3), 'Tuned MLP')
 
 # TESTED VECTORIZERS
-tfidf_vectorizer = NamedVectorizer(TfidfVectorizer(), 'TF-IDF')
-tf_vectorizer = NamedVectorizer(CountVectorizer(), 'TF')
-bm25_vectorizer = NamedVectorizer(BM25Vectorizer(), 'BM25')
+tfidf_vectorizer = NamedVectorizer(LazyObject(TfidfVectorizer), 'TF-IDF')
+tf_vectorizer = NamedVectorizer(LazyObject(CountVectorizer), 'TF')
+bm25_vectorizer = NamedVectorizer(LazyObject(BM25Vectorizer), 'BM25')
 simple_vectorizers = (tfidf_vectorizer, bm25_vectorizer, tf_vectorizer)
 
 # SPECIAL VECTORIZERS
-bm25_scorer = NamedVectorizer(BM25Scorer(), 'BM25 scorer')  # BM25 train document scores
-static_tfidf_vectorizer = StaticVectorizer(TfidfVectorizer(), 'static TF-IDF')  # A TFIDF vectorizer where the whole trainning set is indexed and is shared between topics
+bm25_scorer = NamedVectorizer(LazyObject(BM25Scorer), 'BM25 scorer')  # BM25 train document scores
+static_tfidf_vectorizer = StaticVectorizer(LazyObject(TfidfVectorizer), 'static TF-IDF')  # A TFIDF vectorizer where the whole trainning set is indexed and is shared between topics
 
 # EMSEMBLED VECTORIZERS (MULTIPLE IR MODELS)
 tf_and_idf_vectorizer = EnsembleVectorizer(tfidf_vectorizer, tf_vectorizer)
@@ -212,15 +216,8 @@ def setup():
 
     # <Build Q>
     topics = parse_topics(f"{COLLECTION_PATH}{TOPICS}")
-    train_indexes = parse_qrels(f"{COLLECTION_PATH}qrels.train.txt")
-    for train_index, test_index in zip(train_indexes, parse_qrels(f"{COLLECTION_PATH}qrels.test.txt")):
-        for key in test_index:
-            if key in train_index:
-                train_index[key] += test_index[key]
-            else:
-                train_index[key] = test_index[key]
-
-    topic_index, doc_index, topic_index_n, doc_index_n = train_indexes
+    qrels = parse_qrels_index(f"{COLLECTION_PATH}qrels.train.txt").merge(parse_qrels_index(f"{COLLECTION_PATH}qrels.test.txt"))
+    topic_index, doc_index, topic_index_n, doc_index_n = qrels.to_dicts()
     topic_index = {'p': topic_index, 'n': topic_index_n}
     doc_index = {'p': doc_index, 'n': doc_index_n}
     # </Build Q>
@@ -230,29 +227,30 @@ def setup():
 
     for split in ('train', 'test'):
         print(f'\n\nPARSING {split.upper()} SET...')
-        if not OVERRIDE_SAVED_JSON and os.path.isfile(f'{COLLECTION_PATH}{DATASET}_eval_{split}.json'):
-            print(f"{DATASET}_eval_{split}.json found, loading them...")
-            docs[split] = json.loads(open(f'{COLLECTION_PATH}{DATASET}_eval_{split}.json', encoding='ISO-8859-1').read())
+        refreshed = refresh_dataset(split) if REFRESH_CORPUS else 0
+        docs[split] = None if OVERRIDE_SAVED_JSON or refreshed else load_corpus(f'_eval_{split}')
+        if docs[split] is not None:
+            print(f"{DATASET}_eval_{split} document store found, loading it...")
         else:
-            if os.path.isfile(f'{COLLECTION_PATH}{DATASET}_{split}.json'):
-                print(f"{DATASET}_{split}.json found, loading it...")
-                docs[split] = dict(json.loads(open(f'{COLLECTION_PATH}{DATASET}_{split}.json', encoding='ISO-8859-1').read()))
+            docs[split] = load_corpus(f'_{split}')
+            if docs[split] is not None:
+                print(f"{DATASET}_{split} document store found, loading it...")
             else:
-                print(f"{DATASET}_{split}.json not found, parsing full dataset...")
-                docs[split] = (parse_dataset(split), doc_index)
-            docs[split] = get_subset(docs[split], list(doc_index['p'].keys()) + list(doc_index['n'].keys()))
-            print(f"Saving eval set to {DATASET}_eval_{split}.json...")
-            with open(f'{COLLECTION_PATH}{DATASET}_eval_{split}.json', 'w', encoding='ISO-8859-1') as f:
-                f.write(json.dumps(docs[split], indent=4))
+                print(f"{DATASET}_{split} document store not found, parsing full dataset...")
+                docs[split] = parse_dataset(split)
+            print(f"Saving eval set to {DATASET}_eval_{split} document store...")
+            save_docstore(corpus_path(f'_eval_{split}'), get_subset(docs[split], list(doc_index['p'].keys()) + list(doc_index['n'].keys())))
+            docs[split] = load_corpus(f'_eval_{split}')
         # </Dataset processing>
 
     return docs, topics, topic_index, doc_index
 
 
 def training(q, Dtrain, Rtrain, classifier=None, vectorizer=None, **args):
-    q_judged_doc_ids = Rtrain['p'].get(q, []) + Rtrain['n'].get(q, [])
+    Rtrain = as_qrels(Rtrain)
+    q_judged_doc_ids = Rtrain.positives(q) + Rtrain.negatives(q)
     q_judged_docs = get_subset(Dtrain, q_judged_doc_ids)
-    return SparseVectorClassifier(q_judged_docs, [int(doc_id in Rtrain['p'].get(q, [])) for doc_id in q_judged_docs], vectorizer=vectorizer, classifier=classifier, **args)
+    return SparseVectorClassifier(q_judged_docs, Rtrain.label(q, q_judged_docs).tolist(), vectorizer=vectorizer, classifier=classifier, **args)
 
 
 def classify(d: dict, q: str, M: SparseVectorClassifier, **args):
@@ -354,31 +352,31 @@ def plot_classification_metrics(classification_results, title):
 def get_classification_results(Dtest, Qtest, Rtest, classifier, vectorizer, pre_retrieval=None, skip_classification=False):
     classification_results, classification_exists = None, False
 
-    classification_results_file = f"classification_results/eval_{classifier.file_term}_{vectorizer.file_term}.json"
-    reranking_results_file = f"reranking_results/eval_{classifier.file_term}_{vectorizer.file_term}.json"
+    classification_results_file = f"classification_results/eval_{classifier.file_term}_{vectorizer.file_term}{RUN_SUFFIX}"
+    reranking_results_file = f"reranking_results/eval_{classifier.file_term}_{vectorizer.file_term}{RUN_SUFFIX}"
     if not os.path.exists("classification_results"):
         os.mkdir("classification_results")
     if not os.path.exists("reranking_results"):
         os.mkdir("reranking_results")
 
     # Classification checkpoint exists
-    if (not skip_classification) and os.path.isfile(classification_results_file):
+    if (not skip_classification) and run_exists(classification_results_file):
         print(f"Classification results already exist, loading from file (\"{classification_results_file}\")...")
-        classification_results = jsonpickle.decode(open(classification_results_file, encoding='ISO-8859-1').read())
+        classification_results = load_run(classification_results_file)
         classification_exists = True
     elif not skip_classification and not pre_retrieval:
         print(f"Classification results don't exist, retrieving with model...")
         classification_results = classify_topics(Dtest, Qtest, Rtest, classifier=classifier, vectorizer=vectorizer, pre_retrieval=None, skip_classification=skip_classification)
-        with open(reranking_results_file, 'w', encoding='ISO-8859-1') as f:
-            f.write(jsonpickle.encode(pre_retrieval, indent=4))
+        print(f"Saving classification to file (\"{classification_results_file}\")...")
+        save_run(classification_results_file, classification_results)
 
     if not pre_retrieval:
         return classification_results
 
     # Ranking checkpoint exists
-    if os.path.isfile(reranking_results_file):
+    if run_exists(reranking_results_file):
         print(f"Reranking results already exist, loading from file (\"{reranking_results_file}\")...")
-        pre_retrieval.update(jsonpickle.decode(open(reranking_results_file, encoding='ISO-8859-1').read()))
+        pre_retrieval.update(load_run(reranking_results_file))
         if not (classification_exists or skip_classification):
             print(f"Classification results don't exist, retrieving with model...")
             classification_results = classify_topics(Dtest, Qtest, Rtest, classifier=classifier, vectorizer=vectorizer, pre_retrieval=None, skip_classification=skip_classification)
@@ -386,38 +384,37 @@ def get_classification_results(Dtest, Qtest, Rtest, classifier, vectorizer, pre_
         print(f"Reranking results don't exist, retrieving with model...")
         classification_results = classify_topics(Dtest, Qtest, Rtest, classifier=classifier, vectorizer=vectorizer, pre_retrieval=pre_retrieval, skip_classification=skip_classification)
         print(f"Saving reranking to file (\"{reranking_results_file}\")...")
-        with open(reranking_results_file, 'w', encoding='ISO-8859-1') as f:
-            f.write(jsonpickle.encode(pre_retrieval, indent=4))
+        save_run(reranking_results_file, pre_retrieval)
 
     # Save results
     if not classification_exists and classification_results:
         print(f"Saving classification to file (\"{classification_results_file}\")...")
-        with open(classification_results_file, 'w', encoding='ISO-8859-1') as f:
-            f.write(jsonpickle.encode(classification_results, indent=4))
+        save_run(classification_results_file, classification_results)
 
     return classification_results
 
 
 def classify_topics(Dtest, Qtest, Rtest, classifier: NamedClassifier = None, vectorizer=None, k=DEFAULT_K, pre_retrieval=None, skip_classification=False):
     classification_results = {q_id: {'related_documents': set(doc_ids)} for q_id, doc_ids in Rtest['p'].items()}
+    R = as_qrels(Rtest)
     with tqdm(Qtest, desc=f'{f"CLASSIFYING {list(Qtest)[0]}":20}', leave=True, dynamic_ncols=True) as q_tqdm:
         for q in q_tqdm:
             q_tqdm.set_description(desc=f'{f"CLASSIFYING {q}":20}')
 
-            model = training(q, docs['train'], Rtest, classifier=classifier, vectorizer=vectorizer)
+            model = training(q, docs['train'], R, classifier=classifier, vectorizer=vectorizer)
 
             # CLASSIFICATION
             if not skip_classification:
-                raw_results = {'p': {d_id: classify(doc, q, model) for d_id, doc in get_subset(Dtest, Rtest['p'].get(q, [])).items()},
-                               'n': {d_id: classify(doc, q, model) for d_id, doc in get_subset(Dtest, Rtest['n'].get(q, [])).items()}}
+                raw_results = {'p': {d_id: classify(doc, q, model) for d_id, doc in get_subset(Dtest, R.positives(q)).items()},
+                               'n': {d_id: classify(doc, q, model) for d_id, doc in get_subset(Dtest, R.negatives(q)).items()}}
                 retrieved_doc_ids = dict(sorted({**raw_results['n'], **raw_results['p']}.items(), key=lambda x: x[1], reverse=True))
                 classification_result = {
-                    'unrelated_documents': set(Rtest['n'].get(q, [])),
+                    'unrelated_documents': set(R.negatives(q)),
                     'total_result': len(retrieved_doc_ids),
                     'visited_documents': list(retrieved_doc_ids),
                     'visited_documents_orders': {doc_id: rank + 1 for rank, doc_id in enumerate(retrieved_doc_ids)},
-                    'assessed_documents': {doc_id: (rank + 1, int(doc_id in Rtest['p'].get(q, []))) for rank, doc_id in enumerate(retrieved_doc_ids) if
-                                           doc_id in Rtest['p'].get(q, []) or doc_id in Rtest['n'].get(q, [])},
+                    'assessed_documents': {doc_id: (rank + 1, int(label)) for rank, (doc_id, label) in enumerate(zip(retrieved_doc_ids, R.label(q, retrieved_doc_ids)))
+                                           if label != UNJUDGED},
                     'document_probabilities': retrieved_doc_ids,
                     'predicted_related': set([doc_id for doc_id, prob in retrieved_doc_ids.items() if round(prob)]),
                     'predicted_unrelated': set([doc_id for doc_id, prob in retrieved_doc_ids.items() if not round(prob)]),
@@ -431,6 +428,7 @@ def classify_topics(Dtest, Qtest, Rtest, classifier: NamedClassifier = None, vec
 
                 ranking_result = {
                     'visited_documents': list(retrieved_docs_ids),
+                    'visited_scores': list(retrieved_docs_ids.values()),
                     'visited_documents_orders': {doc_id: rank + 1 for rank, doc_id in enumerate(retrieved_docs_ids)},
                     'document_probabilities': retrieved_docs_ids
                 }
@@ -1,5 +1,4 @@
 import numpy as np
-from kneed import KneeLocator
 
 from metrics import *
 from parsers import *
@@ -7,13 +6,16 @@ import classifier as cl
 import itertools
 
 from time import time
-from sklearn_extra.cluster import KMedoids
-from sklearn.cluster import KMeans
-from sklearn.cluster import AgglomerativeClustering
-from sklearn.metrics import silhouette_score
-from sklearn.metrics.pairwise import pairwise_distances
-from matplotlib import pyplot as plt
-from sklearn.metrics.cluster import adjusted_rand_score
+from lazy import LazyModule, lazy_import
+
+KneeLocator = lazy_import('kneed', 'KneeLocator')
+KMedoids = lazy_import('sklearn_extra.cluster', 'KMedoids')
+KMeans = lazy_import('sklearn.cluster', 'KMeans')
+AgglomerativeClustering = lazy_import('sklearn.cluster', 'AgglomerativeClustering')
+silhouette_score = lazy_import('sklearn.metrics', 'silhouette_score')
+pairwise_distances = lazy_import('sklearn.metrics.pairwise', 'pairwise_distances')
+plt = LazyModule('matplotlib.pyplot')
+adjusted_rand_score = lazy_import('sklearn.metrics.cluster', 'adjusted_rand_score')
 
 
 SUBSET_SIZE = 1000
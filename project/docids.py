@@ -0,0 +1,37 @@
+""" Dense int32 ids for the item ids of a run file or a rank fusion
+Ids are assigned in insertion order and live only as long as their map: a run file stores its doc id fields as int
+positions into its own id table, and rank fusion scatters the runs of a topic over int arrays. Nothing else is
+interned: the corpus, rankings, qrels and result dicts keep item ids.
+"""
+
+import numpy as np
+
+UNKNOWN_DOC = -1
+
+
+class DocIdMap:
+    def __init__(self, doc_ids=()):
+        self.doc_ids = []
+        self.positions = {}
+        self.add(doc_ids)
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def __contains__(self, doc_id):
+        return doc_id in self.positions
+
+    def add(self, doc_ids):
+        n_doc_ids = len(self.doc_ids)
+        for doc_id in doc_ids:
+            if doc_id not in self.positions:
+                self.positions[doc_id] = len(self.doc_ids)
+                self.doc_ids.append(doc_id)
+        return len(self.doc_ids) - n_doc_ids
+
+    def encode(self, doc_ids):
+        doc_ids = list(doc_ids)
+        return np.fromiter((self.positions.get(doc_id, UNKNOWN_DOC) for doc_id in doc_ids), dtype=np.int32, count=len(doc_ids))
+
+    def decode(self, doc_numbers):
+        return [self.doc_ids[doc_number] for doc_number in np.asarray(doc_numbers).tolist()]
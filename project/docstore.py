@@ -0,0 +1,129 @@
+""" Memory-mapped document store for the parsed collection
+A store at <path> is made of:
+    <path>.data          UTF-8 field blobs, one document after the other
+    <path>.offsets.npy   (n_docs, n_fields + 1) byte offsets of every field of every document
+    <path>.ids.npy       item ids, one row per document
+    <path>.meta.json     field names
+Documents are only decoded when a field is accessed. Stores are appended to; removing documents rewrites them.
+"""
+
+import json
+import mmap
+import os
+from collections.abc import Mapping
+
+import numpy as np
+
+STORE_FILES = ('data', 'offsets.npy', 'ids.npy', 'meta.json')
+
+
+class StoredDocument(Mapping):
+    __slots__ = ('_store', '_row')
+
+    def __init__(self, store, row):
+        self._store = store
+        self._row = row
+
+    def __getitem__(self, field):
+        return self._store.read_field(self._row, self._store.field_index[field])
+
+    def __iter__(self):
+        return iter(self._store.fields)
+
+    def __len__(self):
+        return len(self._store.fields)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class DocumentStore(Mapping):
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}.meta.json', encoding='utf8') as f:
+            self.fields = tuple(json.load(f)['fields'])
+        self.field_index = {field: i for i, field in enumerate(self.fields)}
+        self.offsets = np.load(f'{path}.offsets.npy', mmap_mode='r')
+        self.ids = np.load(f'{path}.ids.npy', mmap_mode='r')
+        # Later rows override earlier ones with the same id but keep its position, like dict.update
+        self._rows = {doc_id: row for row, doc_id in enumerate(self.ids.tolist())}
+        with open(f'{path}.data', 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+    def __getitem__(self, doc_id):
+        return StoredDocument(self, self._rows[doc_id])
+
+    def __contains__(self, doc_id):
+        return doc_id in self._rows
+
+    def __iter__(self):
+        return iter(self._rows)
+
+    def __len__(self):
+        return len(self._rows)
+
+    def __reduce__(self):
+        return DocumentStore, (self.path,)
+
+    def read_field(self, row, field):
+        start, end = self.offsets[row, field], self.offsets[row, field + 1]
+        return self._data[start:end].decode('utf8')
+
+    def close(self):
+        if isinstance(self._data, mmap.mmap):
+            self._data.close()
+
+
+def docstore_exists(path):
+    return all(os.path.isfile(f'{path}.{file}') for file in STORE_FILES)
+
+
+def open_docstore(path):
+    return DocumentStore(path)
+
+
+def save_docstore(path, docs, append=False):
+    fields, start = None, 0
+    if append and docstore_exists(path):
+        with open(f'{path}.meta.json', encoding='utf8') as f:
+            fields = tuple(json.load(f)['fields'])
+        old_offsets, old_ids = np.load(f'{path}.offsets.npy'), np.load(f'{path}.ids.npy')
+        start = int(old_offsets[-1, -1]) if len(old_offsets) else 0
+    else:
+        append, old_offsets, old_ids = False, None, None
+
+    doc_ids, offsets = [], []
+    with open(f'{path}.data', 'ab' if append else 'wb') as f:
+        for doc_id, doc in docs.items():
+            if fields is None:
+                fields = tuple(doc.keys())
+            row = [start]
+            for field in fields:
+                start += f.write(doc[field].encode('utf8'))
+                row.append(start)
+            doc_ids.append(doc_id)
+            offsets.append(row)
+
+    if fields is None:
+        fields = ()
+    offsets = np.array(offsets, dtype=np.uint64).reshape(-1, len(fields) + 1)
+    doc_ids = np.array(doc_ids, dtype=str)
+    if append:
+        offsets = np.concatenate([old_offsets, offsets])
+        doc_ids = np.concatenate([old_ids, doc_ids]) if len(doc_ids) else old_ids
+    np.save(f'{path}.offsets.npy', offsets)
+    np.save(f'{path}.ids.npy', doc_ids)
+    with open(f'{path}.meta.json', 'w', encoding='utf8') as f:
+        json.dump({'fields': fields}, f)
+    return len(doc_ids)
+
+
+def remove_docs(path, doc_ids):
+    # Written next to the store while it is still mapped, then swapped in file by file
+    store = open_docstore(path)
+    kept = {doc_id: store[doc_id] for doc_id in store if doc_id not in doc_ids}
+    save_docstore(f'{path}.tmp', kept)
+    store.close()
+    for file in STORE_FILES:
+        os.replace(f'{path}.tmp.{file}', f'{path}.{file}')
+    return len(store) - len(kept)
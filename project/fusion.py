@@ -0,0 +1,62 @@
+""" Rank fusion of N runs with NumPy scatter-add
+A run of a topic is an int array of document ids in rank order, optionally with their scores. The contributions of
+every run are summed per document with np.add.at, in run order, and the top p documents are kept with a partial sort.
+Ties are broken by first occurrence, i.e. by the first run (then rank) that retrieved the document.
+
+    rrf         sum of weight / (k + rank)
+    combsum     sum of weight * score, scores min-max normalised per run
+    combmnz     combsum * number of runs that retrieved the document
+"""
+
+import numpy as np
+
+FUSION_METHODS = ('rrf', 'combsum', 'combmnz')
+RRF_K = 50
+
+
+def normalise_scores(scores):
+    scores = np.asarray(scores, dtype=np.float64)
+    if not len(scores):
+        return scores
+    low, high = scores.min(), scores.max()
+    return np.ones_like(scores) if high == low else (scores - low) / (high - low)
+
+
+def fuse(doc_runs, score_runs=None, method='rrf', k=RRF_K, weights=None, p=None):
+    if method not in FUSION_METHODS:
+        raise ValueError(f"Unknown fusion method {method}, expected one of {FUSION_METHODS}")
+    if method != 'rrf' and score_runs is None:
+        raise ValueError(f"{method} fusion needs the scores of every run")
+    doc_runs = [np.asarray(docs, dtype=np.int64) for docs in doc_runs]
+    lengths = [len(docs) for docs in doc_runs]
+    if not sum(lengths):
+        return np.array([], dtype=np.int64), np.array([], dtype=np.float64)
+    docs = np.concatenate(doc_runs)
+    runs = np.repeat(np.arange(len(doc_runs)), lengths)
+    fused_docs, first, inverse = np.unique(docs, return_index=True, return_inverse=True)
+
+    if method == 'rrf':
+        contributions = 1 / (k + np.concatenate([np.arange(1, length + 1) for length in lengths]))
+    else:
+        contributions = np.concatenate([normalise_scores(scores) for scores in score_runs])
+    if weights is not None:
+        contributions = np.asarray(weights, dtype=np.float64)[runs] * contributions
+    fused_scores = np.zeros(len(fused_docs))
+    np.add.at(fused_scores, inverse, contributions)
+    if method == 'combmnz':
+        fused_scores *= np.bincount(inverse, minlength=len(fused_docs))
+
+    candidates = np.arange(len(fused_docs))
+    if p is not None and len(fused_docs) > p:
+        top = np.argpartition(-fused_scores, p - 1)[:p] if p > 0 else candidates[:0]
+        # Keep every document tied with the p-th score, so the cut does not depend on argpartition
+        candidates = np.flatnonzero(fused_scores >= fused_scores[top].min()) if len(top) else top
+    order = candidates[np.lexsort((first[candidates], -fused_scores[candidates]))][:p]
+    return fused_docs[order], fused_scores[order]
+
+
+def fuse_topics(topic_doc_runs, topic_score_runs=None, method='rrf', k=RRF_K, weights=None, p=None):
+    # topic_doc_runs: {q_id: [docs of run 0, docs of run 1, ...]}; p is an int or {q_id: p}
+    return {q_id: fuse(doc_runs, topic_score_runs[q_id] if topic_score_runs else None, method, k, weights,
+                       p.get(q_id) if isinstance(p, dict) else p)
+            for q_id, doc_runs in topic_doc_runs.items()}
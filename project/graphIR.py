@@ -1,14 +1,7 @@
 import itertools
 import collections
-import networkx as nx
-import pagerank as pk
 from copy import deepcopy
-import jsonpickle
 from statistics import mean
-from sklearn.feature_extraction.text import CountVectorizer
-from sklearn.feature_extraction.text import TfidfVectorizer
-
-import pandas as pd
 
 import classifier as cl
 import main as p1
@@ -16,8 +9,19 @@ import main as p1
 from metrics import *
 
 from parsers import *
+from qrels import UNJUDGED, as_qrels
+from runs import RUN_SUFFIX, load_run, run_exists, save_run
+
+from lazy import LazyModule, lazy_import
 
-from sklearn.metrics.pairwise import cosine_similarity, manhattan_distances, euclidean_distances
+nx = LazyModule('networkx')
+pk = LazyModule('pagerank')
+pd = LazyModule('pandas')
+CountVectorizer = lazy_import('sklearn.feature_extraction.text', 'CountVectorizer')
+TfidfVectorizer = lazy_import('sklearn.feature_extraction.text', 'TfidfVectorizer')
+cosine_similarity = lazy_import('sklearn.metrics.pairwise', 'cosine_similarity')
+manhattan_distances = lazy_import('sklearn.metrics.pairwise', 'manhattan_distances')
+euclidean_distances = lazy_import('sklearn.metrics.pairwise', 'euclidean_distances')
 
 threshold = 0.4
 SUBSET_SIZE = 1000
@@ -78,6 +82,7 @@ def undirected_page_rank(q, D, p, sim, th, priors):
 def classify_graph(classification_results, Dtest, Qtest, Rtest, type, th,priors):
     ranking_results = {q_id: {'related_documents': set(doc_ids)} for q_id, doc_ids in Rtest['p'].items()}
     pk_type = 'vanilla_pk' if type == 'vanilla' else 'extended_pk'
+    R = as_qrels(Rtest)
     with cl.tqdm(Qtest, desc=f'{f"CLASSIFYING {list(Qtest)[0]}":20}', leave=False) as q_tqdm:
         for q in q_tqdm:
             q_tqdm.set_description(desc=f'{f"CLASSIFYING {q}":20}')
@@ -91,10 +96,11 @@ def classify_graph(classification_results, Dtest, Qtest, Rtest, type, th,priors)
                 # 'unrelated_documents': classification_results[q]['unrelated_documents'] ,
                 'total_result': len(retrieved_docs_ids),
                 'visited_documents': list(retrieved_docs_ids),
+                'visited_scores': list(retrieved_docs_ids.values()),
                 'visited_documents_orders': {doc_id: rank + 1 for rank, doc_id in enumerate(retrieved_docs_ids)},
-                'assessed_documents': {doc_id: (rank + 1, int(doc_id in Rtest['p'].get(q, []))) for rank, doc_id in
-                                       enumerate(retrieved_docs_ids) if
-                                       doc_id in Rtest['p'].get(q, []) or doc_id in Rtest['n'].get(q, [])},
+                'assessed_documents': {doc_id: (rank + 1, int(label)) for rank, (doc_id, label) in
+                                       enumerate(zip(retrieved_docs_ids, R.label(q, retrieved_docs_ids))) if
+                                       label != UNJUDGED},
                 'document_probabilities': retrieved_docs_ids
             }
             ranking_results[q].update(ranking_result)
@@ -103,17 +109,16 @@ def classify_graph(classification_results, Dtest, Qtest, Rtest, type, th,priors)
 
 def get_pk_results(classification_baseline, Dtest, Qtest, Rtest, type, threshold, priors):
     # <Get Retrieval results>
-    pk_results_file = f"pagerank_results/eval_{type}_{threshold}_{priors}"
+    pk_results_file = f"pagerank_results/eval_{type}_{threshold}_{priors}{RUN_SUFFIX}"
     if not os.path.exists("pagerank_results"):
         os.mkdir("pagerank_results")
-    if os.path.isfile(pk_results_file):
+    if run_exists(pk_results_file):
         print(f"Retrieval results already exist, loading from file (\"{pk_results_file}\")...")
-        pk_results = jsonpickle.decode(open(pk_results_file, encoding='ISO-8859-1').read())
+        pk_results = load_run(pk_results_file)
     else:
         print(f"Retrieval results don't exist, retrieving with model...")
         pk_results = classify_graph(classification_baseline, Dtest, Qtest, Rtest, type=type, th=threshold, priors = priors)
-        with open(pk_results_file, 'w', encoding='ISO-8859-1') as f:
-            f.write(jsonpickle.encode(pk_results, indent=4))
+        save_run(pk_results_file, pk_results)
     # </Get Retrieval results>
     return pk_results
 
@@ -0,0 +1,84 @@
+""" Deferred imports and objects
+Heavy stacks (sklearn, matplotlib, seaborn, pandas, networkx, nltk) are only loaded by the code paths that use them:
+    LazyModule('matplotlib.pyplot')            imports the module on first attribute access
+    lazy_import('sklearn.naive_bayes', 'X')    stands for one attribute of a module, resolved on first call or access
+    LazyObject(factory, *args, **kwargs)       builds factory(*args, **kwargs) on first attribute access; LazyObject
+                                               arguments are built first, so nested estimators stay deferred too
+Special (dunder) lookups are not forwarded: use a proxy for calls and attributes, not for isinstance or subclassing.
+"""
+
+import importlib
+
+
+class LazyModule:
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def _load(self):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return self._module
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('__') or attribute in ('_name', '_module'):
+            raise AttributeError(attribute)
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        return f"<lazy module {self._name}>"
+
+
+class LazyAttribute:
+    def __init__(self, module, name):
+        self._module = module
+        self._name = name
+        self._value = None
+
+    def _load(self):
+        if self._value is None:
+            self._value = getattr(importlib.import_module(self._module), self._name)
+        return self._value
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('__') or attribute in ('_module', '_name', '_value'):
+            raise AttributeError(attribute)
+        return getattr(self._load(), attribute)
+
+    def __repr__(self):
+        return f"<lazy {self._module}.{self._name}>"
+
+
+def lazy_import(module, name):
+    return LazyAttribute(module, name)
+
+
+class LazyObject:
+    def __init__(self, factory, *args, **kwargs):
+        self._factory = factory
+        self._args = args
+        self._kwargs = kwargs
+        self._object = None
+
+    def _load(self):
+        if self._object is None:
+            self._object = self._factory(*[build(arg) for arg in self._args], **{key: build(value) for key, value in self._kwargs.items()})
+        return self._object
+
+    def __getattr__(self, attribute):
+        if attribute.startswith('__') or attribute in ('_factory', '_args', '_kwargs', '_object'):
+            raise AttributeError(attribute)
+        return getattr(self._load(), attribute)
+
+    def __call__(self, *args, **kwargs):
+        return self._load()(*args, **kwargs)
+
+    def __repr__(self):
+        return repr(self._load())
+
+
+def build(value):
+    return value._load() if isinstance(value, LazyObject) else value
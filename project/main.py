@@ -1,25 +1,45 @@
+import re
 import string
 import time
-import jsonpickle
-import nltk
 import warnings
-import pandas as pd
-import whoosh.scoring
 from collections import defaultdict
-
-from nltk.stem import WordNetLemmatizer
-from pympler import asizeof
-from sklearn.feature_extraction.text import TfidfVectorizer, CountVectorizer
-from sklearn.model_selection import KFold
-from whoosh import index
-from whoosh.analysis import *
-from whoosh.fields import *
-from whoosh.qparser import *
+from functools import partial
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Pool, get_context
 
 from metrics import *
 from parsers import *
-
-nltk.download('wordnet')
+from qrels import UNJUDGED, as_qrels
+from sparse_bm25 import NamedSparseBM25, pruning_report
+from bm25_sweep import BM25Sweep, run_sweep, whoosh_bm25f_fields
+from postings import PostingLists
+from docids import DocIdMap
+from fusion import RRF_K, fuse_topics
+from runs import RUN_SUFFIX, TREC_RUN_SUFFIX, export_trec_run, load_run, run_exists, save_run
+from profiling import StageProfiler, directory_size, nbytes
+from tokencache import corpus_fingerprint, load_token_cache, token_cache_path
+from scheduler import Scheduler
+from normcache import NORMALISATION_CACHE_PATH, drain_normalisation_caches, merge_normalisation_caches, normalisation_cache, \
+    normalisation_report, save_normalisation_caches
+from querycache import GENERATION_FILE, QUERY_CACHE_PATH, QUERY_CACHE_SIZE, QueryCache, read_generation, write_generation
+from postingfile import POSTING_FILES, CompressedPostingLists, open_posting_file, posting_file_exists, posting_file_path, save_posting_file
+from lazy import LazyModule, lazy_import
+
+pd = LazyModule('pandas')
+whooshext = LazyModule('whooshext')
+index = LazyModule('whoosh.index')
+porter = LazyModule('whoosh.lang.porter')
+StemmingAnalyzer = lazy_import('whoosh.analysis', 'StemmingAnalyzer')
+RegexTokenizer = lazy_import('whoosh.analysis', 'RegexTokenizer')
+LowercaseFilter = lazy_import('whoosh.analysis', 'LowercaseFilter')
+StopFilter = lazy_import('whoosh.analysis', 'StopFilter')
+Schema = lazy_import('whoosh.fields', 'Schema')
+ID = lazy_import('whoosh.fields', 'ID')
+TEXT = lazy_import('whoosh.fields', 'TEXT')
+SearchSession = lazy_import('search', 'SearchSession')
+CountVectorizer = lazy_import('sklearn.feature_extraction.text', 'CountVectorizer')
+TfidfTransformer = lazy_import('sklearn.feature_extraction.text', 'TfidfTransformer')
+KFold = lazy_import('sklearn.model_selection', 'KFold')
 
 COLLECTION_LEN = 807168
 COLLECTION_PATH = 'collection/'
@@ -39,9 +59,26 @@ MaxMRRRank = 10
 BETA = 0.5
 K1_TEST_VALS = np.arange(0, 4.1, 0.5)
 B_TEST_VALS = np.arange(0, 1.1, 0.2)
+TUNING_WORKERS = 1
+FUSION_METHOD = 'rrf'  # 'rrf', 'combsum' or 'combmnz'
+FUSED_MODEL_NAMES = {'rrf': 'RFF'}  # key of the fused model in the results evaluation returns; RRF keeps its old key
 DEFAULT_P = 1000
 K_TESTS = (1, 3, 5, 10, 20, 50, 100, 200, 500, DEFAULT_P)
 FOLDS = 0
+FOLD_WORKERS = os.cpu_count()
+ANALYSIS_WORKERS = 1
+ANALYSIS_CHUNK_SIZE = 1000
+INDEXING_PROCS = 1
+INDEXING_LIMIT_MB = 128  # memory limit of each Whoosh writer process
+INDEXING_MULTISEGMENT = True  # keep one segment per writer process; merging rebuilds field length totals from quantised lengths, shifting BM25F scores
+TRACE_INDEXING_MEMORY = False  # tracemalloc deltas per indexing stage, at the cost of slower indexing
+USE_TOKEN_CACHE = True  # analyse each corpus once per analyzer and reuse the token streams from disk
+USE_POSTING_FILE = True  # keep the count index in a compressed, memory-mapped posting file and reopen it instead of vectorising again
+PERSIST_NORMALISATION_CACHE = False  # keep the lemma/stem memo between runs, see normcache.py
+USE_QUERY_CACHE = True  # LRU of search results per index, keyed by query, scoring, k and index generation
+PERSIST_QUERY_CACHE = False  # also keep them on disk, reused across runs until the index is rebuilt
+EVALUATION_WORKERS = 1  # stages of the analyzer x scoring grid run at once, see scheduler.py
+EXPORT_TREC_RUNS = False  # also write every ranking as a TREC run file next to its checkpoint, for trec_eval
 RANDOM_STATE = 420
 
 topics = {}
@@ -49,30 +86,32 @@ topic_index = {}
 doc_index = {}
 topic_index_n = {}
 doc_index_n = {}
+fold_job = None  # evaluation inputs, inherited by the forked fold workers instead of being pickled
+analyzer_factories = {}  # analyzer name -> callable building a fresh analyzer chain, used by the analysis workers
+worker_analyzer = None
 
 
-class NamedBM25F(whoosh.scoring.BM25F):
-    def __init__(self, *args, **aargs):
-        super().__init__(*args, **aargs)
-        self.name = f"BM25_k1_{self.K1:.2f}_b_{self.B:.2f}".replace('.', ',')
-
-    def __str__(self):
-        return self.name
-
-
-class NamedTF_IDF(whoosh.scoring.TF_IDF):
-    def __init__(self, *args, **aargs):
-        super().__init__(*args, **aargs)
-        self.name = f"TF_IDF"
-
-    def __str__(self):
-        return self.name
+def __getattr__(name):
+    # The Whoosh subclasses load with whooshext; schemas pickled before it still find main.LemmaFilter
+    if name in ('NamedBM25F', 'NamedTF_IDF', 'LemmaFilter'):
+        return getattr(whooshext, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class NamedAnalyzer():
-    def __init__(self, analyzer, name):
-        self.analyzer = analyzer
+    def __init__(self, analyzer, name, factory=None):
+        if analyzer is not None:
+            self.analyzer = analyzer
         self.name = name
+        if factory:
+            analyzer_factories[name] = factory
+
+    def __getattr__(self, attribute):
+        # Without a chain the analyzer is built by its factory on first use, so defining it does not load Whoosh
+        if attribute != 'analyzer' or 'name' not in self.__dict__:
+            raise AttributeError(attribute)
+        self.analyzer = analyzer_factories[self.name]()
+        return self.analyzer
 
     def __call__(self, *args, **aargs):
         return self.analyzer(*args, **aargs)
@@ -80,8 +119,28 @@ class NamedAnalyzer():
     def process_raw_text(self, raw_text):
         return [token.text for token in self.analyzer(raw_text)]
 
-    def process_raw_texts(self, raw_texts):
-        return [' '.join(self.process_raw_text(raw_text)) for raw_text in tqdm(raw_texts, desc=f'{"PRE-PROCESSING":20}')]
+    def process_raw_texts(self, raw_texts, workers=ANALYSIS_WORKERS, chunk_size=ANALYSIS_CHUNK_SIZE):
+        start_time = time.time()
+        if workers > 1 and self.name not in analyzer_factories:
+            warnings.warn(f"No factory registered for analyzer {self.name}, pre-processing serially")
+            workers = 1
+        if workers <= 1:
+            texts = [' '.join(self.process_raw_text(raw_text)) for raw_text in tqdm(raw_texts, desc=f'{"PRE-PROCESSING":20}')]
+        else:
+            raw_texts = list(raw_texts)
+            chunks = [raw_texts[i:i + chunk_size] for i in range(0, len(raw_texts), chunk_size)]
+            texts = []
+            with Pool(workers, initializer=init_analysis_worker, initargs=(self.name,)) as pool:
+                # imap keeps the chunks in submission order, so the texts line up with raw_texts
+                for chunk_texts, normalisations in tqdm(pool.imap(analyse_chunk, chunks), total=len(chunks), desc=f'{"PRE-PROCESSING":20}'):
+                    texts.extend(chunk_texts)
+                    merge_normalisation_caches(normalisations)
+        elapsed_time = time.time() - start_time
+        print(f"Pre-processed {len(texts)} texts with {self.name} in {elapsed_time:.2f}s ({len(texts) / max(elapsed_time, 1e-9):.1f} texts/s, {workers} workers)")
+        normalisation_report()
+        if PERSIST_NORMALISATION_CACHE:
+            save_normalisation_caches(NORMALISATION_CACHE_PATH)
+        return texts
 
     def __repr__(self):
         return repr(self.analyzer)
@@ -90,14 +149,9 @@ class NamedAnalyzer():
         return self.name
 
 
-class LemmaFilter(Filter):
-    def __init__(self):
-        self.wnl = WordNetLemmatizer()
-
-    def __call__(self, tokens):
-        for t in tokens:
-            t.text = self.wnl.lemmatize(t.text)
-            yield t
+def cached_normaliser(name, function):
+    # Memoised normaliser shared by every analyzer chain of the process
+    return normalisation_cache(name, function, path=NORMALISATION_CACHE_PATH if PERSIST_NORMALISATION_CACHE else None)
 
 
 def SimplePreprocessor(article):
@@ -108,31 +162,129 @@ def SimplePreprocessor(article):
 
 
 class InvertedIndex:
-    def __init__(self, D, analyzer: NamedAnalyzer = None, scoring=None, skip_indexing=False):
+    def __init__(self, D, analyzer: NamedAnalyzer = None, scoring=None, skip_indexing=False, fingerprint=None):
         self.D_name, self.D = D
         self.analyzer = analyzer if analyzer else NamedAnalyzer(StemmingAnalyzer(), "stemming_stopwords")
-        self.whoosh_dir = f"whoosh/{self.D_name}_{self.analyzer}"
+        self.whoosh_dir = whoosh_index_dir(self.D_name, self.analyzer)
+        self.row_ids = np.array(list(self.D), dtype=str)  # Matrix row -> item id
+        self.token_cache = None
+        self.posting_file = None
+        self.posting_lists = None
+        self.__count_test_matrix = None  # decoded from the posting file when a ranked path first needs it
+        self.__tfidf_test_matrix = None
+        self.search_session = None
+        self.query_cache = None
+        if USE_QUERY_CACHE:
+            self.query_cache = QueryCache(QUERY_CACHE_SIZE, f"{QUERY_CACHE_PATH}/{self.D_name}_{self.analyzer}" if PERSIST_QUERY_CACHE else None)
+        self.__generation = None
+        self.profiler = StageProfiler(trace_memory=TRACE_INDEXING_MEMORY)
         if skip_indexing:
             warnings.warn("Skiping indexing, errors will be thrown if checkpoints don't exist")
         else:
-            raw_text_test = self.analyzer.process_raw_texts(self._raw_text_from_dict(self.D))
+            with self.profiler.stage('analysis'):
+                if (USE_TOKEN_CACHE or USE_POSTING_FILE) and fingerprint is None:
+                    fingerprint = corpus_fingerprint(self.D)
+                if USE_TOKEN_CACHE:
+                    self.token_cache = load_token_cache(self.D, self.analyzer, fingerprint)
+                posting_path = posting_file_path(self.D, self.analyzer, fingerprint) if USE_POSTING_FILE else None
+                if posting_path and posting_file_exists(posting_path):
+                    print(f"Posting file found in \"{posting_path}\"")
+                    self.posting_file = open_posting_file(posting_path)
+                elif self.token_cache:
+                    raw_text_test = self.token_cache.raw_texts()
+                else:
+                    raw_text_test = self.analyzer.process_raw_texts(self._raw_text_from_dict(self.D))
             dud_analyzer = lambda x: x.split()
-            self.boolean_index = CountVectorizer(binary=True, analyzer=dud_analyzer)
-            self.boolean_test_matrix = self.boolean_index.fit_transform(tqdm(raw_text_test, desc=f'{"INDEXING BOOLEAN":20}'))
-            self.tfidf_index = TfidfVectorizer(vocabulary=self.boolean_index.vocabulary, analyzer=dud_analyzer)
-            self.tfidf_test_matrix = self.tfidf_index.fit_transform(tqdm(raw_text_test, desc=f'{"INDEXING TFIDF":20}'))
-            self._save_index()
-            self.scoring = scoring if scoring else NamedBM25F()
+            if self.posting_file:
+                with self.profiler.stage('posting file reading'):
+                    self._load_posting_file(dud_analyzer)
+            else:
+                self._vectorise(raw_text_test, dud_analyzer)
+                if posting_path:
+                    with self.profiler.stage('posting file writing'):
+                        print(f"Posting file not found, writing \"{posting_path}\"...")
+                        self.posting_file = save_posting_file(posting_path, self.count_test_matrix, self.vocabulary)
+            # Column -> term and column -> position in the vocabulary dict, which sets the order of tied terms
+            self.vocabulary_terms = np.empty(len(self.vocabulary), dtype=object)
+            self.vocabulary_order = np.empty(len(self.vocabulary), dtype=np.int64)
+            for position, (term, column) in enumerate(self.vocabulary.items()):
+                self.vocabulary_terms[column], self.vocabulary_order[column] = term, position
+            with self.profiler.stage('whoosh writing'):
+                self._save_index()
+            self.scoring = scoring if scoring else whooshext.NamedBM25F()
+
+    def _vectorise(self, raw_text_test, dud_analyzer):
+        with self.profiler.stage('count indexing'):
+            self.count_index = CountVectorizer(analyzer=dud_analyzer)
+            self.__count_test_matrix = self.count_index.fit_transform(tqdm(raw_text_test, desc=f'{"INDEXING COUNTS":20}'))
+        with self.profiler.stage('boolean indexing'):
+            self.boolean_index = CountVectorizer(binary=True, analyzer=dud_analyzer, vocabulary=self.vocabulary)
+            self.posting_lists = PostingLists(self.count_test_matrix)
+        with self.profiler.stage('tfidf indexing'):
+            self._index_tfidf()
+
+    def _load_posting_file(self, dud_analyzer):
+        # Vectorizers are fixed to the vocabulary of the file and boolean queries read the compressed postings; the
+        # count and tf-idf matrices are only decoded when a sparse scoring or the tf-idf matrix is asked for
+        self.count_index = CountVectorizer(analyzer=dud_analyzer, vocabulary=self.posting_file.vocabulary()).fit([])
+        self.boolean_index = CountVectorizer(binary=True, analyzer=dud_analyzer, vocabulary=self.vocabulary)
+        self.posting_lists = CompressedPostingLists(self.posting_file)
+        self._index_tfidf()
+
+    def _index_tfidf(self):
+        # The idf TfidfTransformer.fit computes, from the document frequencies of the postings on both paths, so a
+        # reopened index has the very same tf-idf values without decoding its counts
+        document_frequencies = self.posting_lists.document_frequencies().astype(np.float64)
+        self.tfidf_index = TfidfTransformer()
+        self.tfidf_index.idf_ = np.log((self.posting_lists.n_docs + 1) / (document_frequencies + 1)) + 1
+
+    @property
+    def count_test_matrix(self):
+        if self.__count_test_matrix is None:
+            if self.posting_file is None:
+                raise RuntimeError(f"No count matrix: {self.D_name} was opened with skip_indexing=True")
+            with self.profiler.stage('posting file decoding'):
+                self.__count_test_matrix = self.posting_file.count_matrix()
+        return self.__count_test_matrix
+
+    @property
+    def tfidf_test_matrix(self):
+        if self.__tfidf_test_matrix is None:
+            self.__tfidf_test_matrix = self.tfidf_index.transform(self.count_test_matrix)
+        return self.__tfidf_test_matrix
+
+    def has_count_matrix(self):
+        return self.__count_test_matrix is not None or self.posting_file is not None
+
+    def memory_report(self):
+        # Sizes of the index components; the corpus itself (self.D) is not part of the index
+        sizes = {'row ids': nbytes(self.row_ids)}
+        if self.posting_lists is not None:
+            sizes.update({
+                'posting lists': self.posting_lists.nbytes(),
+                'vocabulary': nbytes(self.vocabulary) + nbytes(self.vocabulary_terms) + nbytes(self.vocabulary_order) + nbytes(self.idf),
+            })
+        # Matrices a reopened index has not decoded take no memory
+        if self.__count_test_matrix is not None:
+            sizes['count matrix'] = nbytes(self.__count_test_matrix)
+        if self.__tfidf_test_matrix is not None:
+            sizes['tfidf matrix'] = nbytes(self.__tfidf_test_matrix)
+        return sizes
+
+    def disk_report(self):
+        sizes = {'whoosh directory': directory_size(self.whoosh_dir)}
+        if self.token_cache:
+            sizes['token cache'] = directory_size(self.token_cache.path)
+        if self.posting_file:
+            sizes['posting file'] = self.posting_file.size()
+        return sizes
 
     @staticmethod
     def _raw_text_from_dict(doc_dict):
         return [' '.join(list(doc.values())) for doc in doc_dict.values()]  # Joins all docs in a single list of raw_doc strings
 
     def _save_index(self):
-        if not os.path.exists("whoosh"):
-            os.mkdir("whoosh")
-        if not os.path.exists(self.whoosh_dir):
-            os.mkdir(self.whoosh_dir)
+        os.makedirs(self.whoosh_dir, exist_ok=True)
         if index.exists_in(self.whoosh_dir):
             print(f"Whoosh index found in \"{self.whoosh_dir}\"")
         else:
@@ -140,10 +292,23 @@ class InvertedIndex:
             schema = Schema(id=ID(stored=True, unique=True),
                             **{tag: TEXT(phrase=False, analyzer=self.analyzer) for tag in AVAILABLE_DATA})  # Schema
             ix = index.create_in(self.whoosh_dir, schema)
-            writer = ix.writer()
-            for doc_id, doc in tqdm(self.D.items(), desc=f'{"INDEXING WHOOSH":20}'):
-                writer.add_document(id=doc_id, **{tag: doc[tag] for tag in AVAILABLE_DATA})
+            start_time = time.time()
+            if INDEXING_PROCS > 1:
+                writer = ix.writer(procs=INDEXING_PROCS, limitmb=INDEXING_LIMIT_MB, multisegment=INDEXING_MULTISEGMENT)
+            else:
+                writer = ix.writer(limitmb=INDEXING_LIMIT_MB)
+            for row, (doc_id, doc) in enumerate(tqdm(self.D.items(), desc=f'{"INDEXING WHOOSH":20}')):
+                if self.token_cache:  # Whoosh indexes pre-analysed token lists as they are
+                    writer.add_document(id=doc_id, **{tag: self.token_cache.field_tokens(row, tag) for tag in AVAILABLE_DATA})
+                else:
+                    writer.add_document(id=doc_id, **{tag: doc[tag] for tag in AVAILABLE_DATA})
             writer.commit()
+            self.__generation = write_generation(self.whoosh_dir)
+            elapsed_time = time.time() - start_time
+            with ix.reader() as reader:
+                n_segments = len(reader.leaf_readers())
+            print(f"Indexed {len(self.D)} docs in {elapsed_time:.2f}s ({len(self.D) / max(elapsed_time, 1e-9):.1f} docs/s, "
+                  f"{INDEXING_PROCS} procs, {n_segments} segments)")
 
     @property
     def scoring(self):
@@ -152,6 +317,13 @@ class InvertedIndex:
     @scoring.setter
     def scoring(self, new_scoring):
         self.__scoring = new_scoring
+        self.close_search_session()  # searchers are bound to their weighting
+
+    @property
+    def generation(self):
+        if self.__generation is None:
+            self.__generation = read_generation(self.whoosh_dir)
+        return self.__generation
 
     @property
     def idf(self):
@@ -159,23 +331,51 @@ class InvertedIndex:
 
     @property
     def vocabulary(self):
-        return self.boolean_index.vocabulary_
+        return self.count_index.vocabulary_
 
     @property
     def doc_ids(self):
         return [doc_id for doc_id in self.D.keys()]
 
+    def get_search_session(self):
+        if self.search_session is None:
+            self.search_session = SearchSession(self.whoosh_dir, AVAILABLE_DATA, self.__scoring)
+        return self.search_session
+
+    def close_search_session(self):
+        if self.search_session is not None:
+            self.search_session.close()
+            self.search_session = None
+        if self.query_cache is not None:
+            self.query_cache.close()
+
     def search_index(self, string, k=10):
-        id_list = []
-        ix = index.open_dir(self.whoosh_dir)
-        with ix.searcher(weighting=self.__scoring) as searcher:
-            q = MultifieldParser(AVAILABLE_DATA, ix.schema, group=OrGroup)
-            q.remove_plugin_class(PhrasePlugin)
-            q = q.parse(string)
-            results = searcher.search(q, limit=k)
-            for r in results:
-                id_list.append((r['id'], r.score))
-        return id_list
+        return self.search_index_many([string], k)[0]
+
+    def search_index_many(self, strings, k=10):
+        strings = list(strings)
+        if self.query_cache is None:
+            return self._search_index_many(strings, k)
+        scoring = str(self.__scoring)
+        keys = [QueryCache.key(string, scoring, self.generation, k) for string in strings]
+        results = [self.query_cache.get(key, scoring) for key in keys]
+        missing = [i for i, result in enumerate(results) if result is None]
+        for i, result in zip(missing, self._search_index_many([strings[i] for i in missing], k) if missing else []):
+            results[i] = result
+            self.query_cache.put(keys[i], scoring, result)
+        return results
+
+    def _search_index_many(self, strings, k=10):
+        if isinstance(self.__scoring, NamedSparseBM25):
+            if not self.has_count_matrix():
+                raise RuntimeError(f"{self.__scoring} ranks from the count matrix, which is not built with skip_indexing=True: "
+                                   f"index {self.D_name} with {self.analyzer}, or rank with a Whoosh scoring")
+            queries = self.count_transform(strings)
+            rankings = self.__scoring.fit(self.count_test_matrix).rank(queries, k)
+            if self.__scoring.pruning:
+                print(f"Block-max pruning: {pruning_report(self.__scoring.pruning_stats)}")
+            return [list(zip(self.row_ids[rows].tolist(), scores.tolist())) for rows, scores in rankings]
+        return self.get_search_session().search_many(strings, k)
 
     def get_term_idf(self, term):
         return 0 if term not in self.vocabulary else self.idf[self.vocabulary[term]]
@@ -186,16 +386,49 @@ class InvertedIndex:
     def boolean_transform(self, raw_documents):
         return self.boolean_index.transform(raw_documents)
 
+    def count_transform(self, raw_documents):
+        return self.count_index.transform([' '.join(self.build_analyzer()(raw_text)) for raw_text in raw_documents])
+
     def tfidf_transform(self, raw_documents):
-        return self.tfidf_index.transform([' '.join(self.build_analyzer()(raw_text)) for raw_text in raw_documents])
+        return self.tfidf_index.transform(self.count_transform(raw_documents))
 
     def build_analyzer(self):
+        if self.token_cache:
+            return self.token_cache.analyse
         return lambda x: self.analyzer.process_raw_text(x)
 
 
-stem_analyzer = NamedAnalyzer(StemmingAnalyzer(), "stemming_stopwords")
-lemma_analyzer = NamedAnalyzer(RegexTokenizer() | LowercaseFilter() | StopFilter() | LemmaFilter(), "lemma_stopwords")
-raw_analyzer = NamedAnalyzer(RegexTokenizer() | LowercaseFilter(), "no_preprocessing")
+def whoosh_index_dir(D_name, analyzer):
+    return f"whoosh/{D_name}_{analyzer}"
+
+
+def init_analysis_worker(name):
+    # Every worker builds its own chain (and filter caches) instead of unpickling the parent's
+    global worker_analyzer
+    worker_analyzer = NamedAnalyzer(analyzer_factories[name](), name)
+    drain_normalisation_caches()  # the forms and counts inherited from the parent are not new
+
+
+def analyse_chunk(raw_texts):
+    texts = [' '.join(worker_analyzer.process_raw_text(raw_text)) for raw_text in raw_texts]
+    return texts, drain_normalisation_caches()
+
+
+def build_stem_analyzer():
+    return StemmingAnalyzer(stemfn=cached_normaliser('porter_stem', porter.stem), cachesize=None)
+
+
+def build_lemma_analyzer():
+    return RegexTokenizer() | LowercaseFilter() | StopFilter() | whooshext.LemmaFilter(cached_normaliser('wordnet_lemma', whooshext.lemmatize))
+
+
+def build_raw_analyzer():
+    return RegexTokenizer() | LowercaseFilter()
+
+
+stem_analyzer = NamedAnalyzer(None, "stemming_stopwords", build_stem_analyzer)
+lemma_analyzer = NamedAnalyzer(None, "lemma_stopwords", build_lemma_analyzer)
+raw_analyzer = NamedAnalyzer(None, "no_preprocessing", build_raw_analyzer)
 
 
 def rprint(x, *args, **pargs):
@@ -208,8 +441,10 @@ def extract_topic_query(q, I: InvertedIndex, k=DEFAULT_K, metric='idf', _topics=
         _topics = topics
     raw_text, term_scores = ' '.join(_topics[q].values()), []
     if metric == 'tfidf':
-        scores = I.tfidf_transform([raw_text]).todense().A[0]
-        term_scores = {term: scores[i] for term, i in I.vocabulary.items() if scores[i] != 0}
+        scores = I.tfidf_transform([raw_text])
+        columns, values = scores.indices[scores.data != 0], scores.data[scores.data != 0]
+        order = np.lexsort((I.vocabulary_order[columns], -values))[:k]
+        return [(I.vocabulary_terms[column], value) for column, value in zip(columns[order], values[order])]
     elif metric == 'idf':
         term_scores = {term: I.get_term_idf(term) for term in set(I.build_analyzer()(raw_text))}
     return sorted(term_scores.items(), key=lambda x: x[1], reverse=True)[:k]
@@ -219,16 +454,36 @@ def indexing(D, *args, **aargs):
     start_time = time.time()
     # print(json.dumps(train_docs, indent=2))
     I = InvertedIndex(D, *args, **aargs)
-    return I, time.time() - start_time, asizeof.asizeof(I)
+    indexing_time = time.time() - start_time
+    memory_sizes = I.memory_report()
+    I.profiler.report({**memory_sizes, **I.disk_report()})
+    return I, indexing_time, sum(memory_sizes.values())
 
 
 def boolean_query(q, I: InvertedIndex, k, metric='idf', _topics=None, *args):
+    return boolean_queries([q], I, k, metric, _topics, *args)[q]
+
+
+def boolean_queries(q_ids, I: InvertedIndex, k, metric='idf', _topics=None, *args):
+    if _topics is None:
+        _topics = topics
+    term_lists = [[I.vocabulary[term] for term, _ in extract_topic_query(q, I, k, metric, _topics=_topics, *args) if term in I.vocabulary]
+                  for q in q_ids]
+    matches = I.posting_lists.at_least_many(term_lists, [round(BOOLEAN_ROUND_TOLERANCE * k)] * len(term_lists))
+    return {q: I.row_ids[rows].tolist() for q, rows in zip(q_ids, matches)}
+
+
+def boolean_queries_at_k(q_ids, I: InvertedIndex, k_values, metric='idf', _topics=None, *args):
+    # The top k terms are a prefix of the top max(k) terms, so each topic's terms are ranked and matched once
     if _topics is None:
         _topics = topics
-    extracted_terms = [' '.join(list(zip(*extract_topic_query(q, I, k, metric, _topics=_topics, *args)))[0])]
-    topic_boolean = I.boolean_transform(extracted_terms)
-    dot_product = np.dot(topic_boolean, I.boolean_test_matrix.T).A[0]
-    return [doc_id for i, doc_id in enumerate(I.doc_ids) if dot_product[i] >= round(BOOLEAN_ROUND_TOLERANCE * k)]
+    thresholds = [round(BOOLEAN_ROUND_TOLERANCE * k) for k in k_values]
+    results = {k: {} for k in k_values}
+    for q in tqdm(q_ids, desc=f'{"SWEEPING K":20}'):
+        ranked_terms = [I.vocabulary.get(term, -1) for term, _ in extract_topic_query(q, I, max(k_values), metric, _topics=_topics, *args)]
+        for k, rows in zip(k_values, I.posting_lists.at_least_prefixes(ranked_terms, k_values, thresholds)):
+            results[k][q] = I.row_ids[rows].tolist()
+    return results
 
 
 def ranking(q, p, I: InvertedIndex, *args):
@@ -242,9 +497,9 @@ def get_subset(adict, subset):
 def main():
     docs, topics, topic_index, doc_index, topic_index_n, doc_index_n = setup()
 
-    evaluation(topics, (doc_index, doc_index_n), docs, analyzers=(stem_analyzer, lemma_analyzer), scorings=(NamedBM25F(K1=2, B=1), NamedTF_IDF()), metric='tfidf', explore='g')
+    evaluation(topics, (doc_index, doc_index_n), docs, analyzers=(stem_analyzer, lemma_analyzer), scorings=(whooshext.NamedBM25F(K1=2, B=1), whooshext.NamedTF_IDF()), metric='tfidf', explore='g')
 
-    # tune_bm25("BM25tune_results_lemma.json", I, topic_index)
+    # tune_bm25("BM25tune_results_", I, topic_index)
     return 0
 
 
@@ -258,95 +513,67 @@ def setup(use_eval=USE_ONLY_EVAL):
     topic_index, doc_index, topic_index_n, doc_index_n = parse_qrels(f"{COLLECTION_PATH}{QRELS}")
     # </Build Q>
     # <Dataset processing>
-    if use_eval and os.path.isfile(f'{COLLECTION_PATH}{DATASET}_eval.json'):
-        print(f"{DATASET}_eval.json found, loading it...")
-        docs = ('eval', json.loads(open(f'{COLLECTION_PATH}{DATASET}_eval.json', encoding='ISO-8859-1').read()))
+    refreshed = refresh_dataset('test') if REFRESH_CORPUS else 0
+    docs = load_corpus('_eval') if use_eval and not refreshed else None
+    if docs is not None:
+        print(f"{DATASET}_eval document store found, loading it...")
+        docs = ('eval', docs)
     else:
         print(f"Loading full dataset...")
-        if not OVERRIDE_SAVED_JSON and os.path.isfile(f'{COLLECTION_PATH}{DATASET}.json'):
-            print(f"{DATASET}.json found, loading it...")
-            docs = json.loads(open(f'{COLLECTION_PATH}{DATASET}.json', encoding='ISO-8859-1').read())
+        docs = None if OVERRIDE_SAVED_JSON else load_corpus('_test')
+        if docs is not None:
+            print(f"{DATASET}_test document store found, loading it...")
         else:
-            print(f"{DATASET}.json not found, parsing full dataset...")
+            print(f"{DATASET}_test document store not found, parsing full dataset...")
             docs = parse_dataset()
         docs = ('full', docs)
 
         if use_eval:
-            docs = ('eval', get_subset(docs[1], doc_index))
-            print(f"Saving eval set to {DATASET}_eval.json...")
-            with open(f'{COLLECTION_PATH}{DATASET}_eval.json', 'w', encoding='ISO-8859-1') as f:
-                f.write(json.dumps(docs[1], indent=4))
+            print(f"Saving eval set to {DATASET}_eval document store...")
+            save_docstore(corpus_path('_eval'), get_subset(docs[1], doc_index))
+            docs = ('eval', load_corpus('_eval'))
     # </Dataset processing>
     return docs, topics, topic_index, doc_index, topic_index_n, doc_index_n
 
 
 def evaluation(Q, R, D, analyzers=None, scorings=(), metric=(), explore=(), skip_indexing=False):
     global doc_index, doc_index_n, topic_index, topic_index_n
-    doc_index, doc_index_n = R
-
-    # <Get fold>
     if FOLDS:
-        doc_ids_list = list(D[1])
-        kf = KFold(n_splits=FOLDS, random_state=RANDOM_STATE, shuffle=True)
-        sampled_doc_ids = [doc_ids_list[i] for i in next(kf.split(doc_ids_list))[1]]
-        doc_index = get_subset(doc_index, sampled_doc_ids)
-        doc_index_n = get_subset(doc_index_n, sampled_doc_ids)
-
-        D = (f"{D[0]}_{FOLDS}", get_subset(D[1], sampled_doc_ids))
-    # </get fold>
+        # Every fold is scored in its own worker and the mean/std table printed; the explore cells and the returned
+        # results are those of the first fold, whose indexes and runs the workers already checkpointed
+        fold_doc_ids = fold_splits(D)
+        evaluate_folds(Q, R, D, analyzers, scorings, metric, skip_indexing, fold_doc_ids=fold_doc_ids)
+        R, D = fold_subset(R, D, fold_doc_ids, 0)
+    doc_index, doc_index_n = R
 
     topic_index = invert_index(doc_index)
     topic_index_n = invert_index(doc_index_n)
 
+    scheduler = Scheduler(EVALUATION_WORKERS)
+    cells, targets = schedule_evaluation(scheduler, D, analyzers, scorings, metric, explore, skip_indexing)
+    values = scheduler.run(targets)
     models_ranking_results, models_retrieval_results = {}, {}
 
     for analyzer in analyzers:
         print(f"\nEvaluating models with preprocessing: {analyzer}...")
-        I, indexing_time, indexing_space = indexing(D, analyzer=analyzer, skip_indexing=skip_indexing)
-        print(f'Indexing time: {indexing_time:10.3f}s, Indexing space: {indexing_space / (1024 ** 2):10.3f}mb')
+        I = values.get(f"index {analyzer}")
 
         # a)
         if 'a' in explore:
             plot_a(I, Q, analyzer, metric)
 
+        if metric:
+            retrieval_results = values[f"retrieve {analyzer} {metric}"]
+            models_retrieval_results[f"{analyzer} {metric}"] = retrieval_results
+
         for scoring in scorings:
             print(f"\nEvaluating model with scoring: {scoring}...")
-            I.scoring = scoring
-
-            if metric:
-                # <Get Retrieval results>
-                retrieval_results_file = f"{I.whoosh_dir.replace('whoosh', 'retrieval_results')}_{metric}.json"
-                if not os.path.exists("retrieval_results"):
-                    os.mkdir("retrieval_results")
-                if os.path.isfile(retrieval_results_file):
-                    print(f"Retrieval results already exist, loading from file (\"{retrieval_results_file}\")...")
-                    retrieval_results = jsonpickle.decode(open(retrieval_results_file, encoding='ISO-8859-1').read())
-                else:
-                    print(f"Retrieval results don't exist, retrieving with model...")
-                    retrieval_results = retrieve_topics(I, topic_index, topic_index_n, metric='tfidf')
-                    with open(retrieval_results_file, 'w', encoding='ISO-8859-1') as f:
-                        f.write(jsonpickle.encode(retrieval_results, indent=4))
-                # </Get Retrieval results>
-                models_retrieval_results[f"{analyzer} {metric}"] = retrieval_results
-
-            # <Get Ranking results>
-            ranking_results_file = f"{I.whoosh_dir.replace('whoosh', 'ranking_results')}_{I.scoring}.json"
-            if not os.path.exists("ranking_results"):
-                os.mkdir("ranking_results")
-            if os.path.isfile(ranking_results_file):
-                print(f"Ranking results already exist, loading from file (\"{ranking_results_file}\")...")
-                ranking_results = jsonpickle.decode(open(ranking_results_file, encoding='ISO-8859-1').read())
-            else:
-                print(f"Ranking results don't exist, ranking with model...")
-                ranking_results = rank_topics(I, topic_index, topic_index_n)
-                with open(ranking_results_file, 'w', encoding='ISO-8859-1') as f:
-                    f.write(jsonpickle.encode(ranking_results, indent=4))
-            # </Get Ranking results>
-
+            ranking_results = values[f"rank {analyzer} {scoring}"]
             models_ranking_results[f"{analyzer} {scoring}"] = ranking_results
 
             # c)
             if 'c' in explore:
+                I.scoring = scoring
                 conf_matrix_vals = precision_boolean_metrics(I, retrieval_results)
                 print_confusion_matrix(conf_matrix_vals)
                 boolean_precision_values = calculate_precision_boolean(I, retrieval_results)
@@ -363,13 +590,13 @@ def evaluation(Q, R, D, analyzers=None, scorings=(), metric=(), explore=(), skip
             if 'f' in explore:
                 metrics_per_sorted_topic(ranking_results)
 
-            print_general_stats(ranking_results)
+            print_general_stats(ranking_results, results=values[f"evaluate {analyzer} {scoring}"])
     # g)
-    if 'g' in explore and len(models_ranking_results) > 1:
-        print("Ranking with RFF...")
-        ranking_results = get_RRF_ranks(list(models_ranking_results.values()), topic_index, topic_index_n)
-        print_general_stats(ranking_results)
-        models_ranking_results[f"RFF"] = ranking_results
+    if 'fuse' in cells:
+        print(f"Ranking with {FUSION_METHOD.upper()}...")
+        ranking_results = values['fuse']
+        print_general_stats(ranking_results, results=values['evaluate fuse'])
+        models_ranking_results[FUSED_MODEL_NAMES.get(FUSION_METHOD, FUSION_METHOD.upper())] = ranking_results
         plot_iap_for_models(models_ranking_results)
 
     if models_retrieval_results:
@@ -378,6 +605,177 @@ def evaluation(Q, R, D, analyzers=None, scorings=(), metric=(), explore=(), skip
         return models_ranking_results
 
 
+def schedule_evaluation(scheduler, D, analyzers, scorings, metric=(), explore=(), skip_indexing=False):
+    # One analysed corpus and index per analyzer, shared by the retrieval and every scoring of that analyzer
+    D_name, docs = D
+    cells, targets = [], []
+    # Hashed once for every analyzer's token cache and posting file
+    fingerprint = corpus_fingerprint(docs) if (USE_TOKEN_CACHE or USE_POSTING_FILE) and not skip_indexing else None
+    for analyzer in analyzers:
+        index_inputs = []
+        if USE_TOKEN_CACHE and not skip_indexing:
+            index_inputs.append(scheduler.add(f"analyse {analyzer}", partial(analyse_stage, docs, analyzer, fingerprint),
+                                              outputs=(f"{token_cache_path(docs, analyzer, fingerprint)}/vocabulary.json",)))
+        # The index is rebuilt when its Whoosh generation or posting file goes, so the rankings made from it go stale too;
+        # an up to date index is opened again by the same function when a later stage needs it
+        open_index = partial(index_stage, D, analyzer, skip_indexing, fingerprint)
+        index_stage_name = scheduler.add(f"index {analyzer}", open_index, index_inputs, index_outputs(D, analyzer, skip_indexing, fingerprint),
+                                         open_index, local=True)
+        if 'a' in explore or 'c' in explore:
+            targets.append(index_stage_name)
+        if metric:
+            path = results_file('retrieval_results', D_name, analyzer, metric)
+            targets.append(scheduler.add(f"retrieve {analyzer} {metric}", partial(retrieve_stage, metric, path), (index_stage_name,),
+                                         (path,), load_run))
+        for scoring in scorings:
+            path = results_file('ranking_results', D_name, analyzer, scoring)
+            cells.append(scheduler.add(f"rank {analyzer} {scoring}", partial(rank_stage, scoring, path), (index_stage_name,), (path,), load_run))
+            scheduler.add(f"evaluate {analyzer} {scoring}", general_stats, (cells[-1],))
+    targets += cells
+    if 'g' in explore and len(cells) > 1:
+        path = results_file('ranking_results', D_name, FUSION_METHOD, '+'.join(cell.split(' ', 1)[1].replace(' ', '_') for cell in cells))
+        targets.append(scheduler.add('fuse', partial(fuse_stage, path), cells, (path,), load_run))
+        scheduler.add('evaluate fuse', general_stats, ('fuse',))
+        cells.append('fuse')
+    return cells, targets
+
+
+def analyse_stage(docs, analyzer, fingerprint):
+    load_token_cache(docs, analyzer, fingerprint)
+
+
+def index_stage(D, analyzer, skip_indexing, fingerprint, *_):
+    I, indexing_time, indexing_space = indexing(D, analyzer=analyzer, skip_indexing=skip_indexing, fingerprint=fingerprint)
+    print(f'Indexing time: {indexing_time:10.3f}s, Indexing space: {indexing_space / (1024 ** 2):10.3f}mb')
+    if not skip_indexing:
+        read_generation(I.whoosh_dir)  # indexes built before generations existed get theirs here
+    return I
+
+
+def index_outputs(D, analyzer, skip_indexing, fingerprint):
+    if skip_indexing:
+        return ()
+    outputs = [f"{whoosh_index_dir(D[0], analyzer)}/{GENERATION_FILE}"]
+    if USE_POSTING_FILE:
+        posting_path = posting_file_path(D[1], analyzer, fingerprint)
+        outputs += [f"{posting_path}.{file}" for file in POSTING_FILES]
+    return tuple(outputs)
+
+
+def retrieve_stage(metric, path, I):
+    write_retrieval_results(I, metric, path)
+
+
+def rank_stage(scoring, path, I):
+    I.scoring = scoring
+    write_ranking_results(I, path)
+
+
+def fuse_stage(path, *models_ranking_results):
+    save_ranking_run(path, get_fused_ranks(list(models_ranking_results), topic_index, topic_index_n), f"fused_{FUSION_METHOD}")
+
+
+def results_file(kind, D_name, analyzer, model):
+    return f"{kind}/{D_name}_{analyzer}_{model}{RUN_SUFFIX}"
+
+
+def get_retrieval_results(I, metric):
+    retrieval_results_file = results_file('retrieval_results', I.D_name, I.analyzer, metric)
+    if run_exists(retrieval_results_file):
+        print(f"Retrieval results already exist, loading from file (\"{retrieval_results_file}\")...")
+        return load_run(retrieval_results_file)
+    print(f"Retrieval results don't exist, retrieving with model...")
+    return write_retrieval_results(I, metric, retrieval_results_file)
+
+
+def write_retrieval_results(I, metric, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    retrieval_results = retrieve_topics(I, topic_index, topic_index_n, metric='tfidf')
+    save_run(path, retrieval_results)
+    return retrieval_results
+
+
+def get_ranking_results(I):
+    ranking_results_file = results_file('ranking_results', I.D_name, I.analyzer, I.scoring)
+    if run_exists(ranking_results_file):
+        print(f"Ranking results already exist, loading from file (\"{ranking_results_file}\")...")
+        return load_run(ranking_results_file)
+    print(f"Ranking results don't exist, ranking with model...")
+    return write_ranking_results(I, ranking_results_file)
+
+
+def write_ranking_results(I, path):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    ranking_results = rank_topics(I, topic_index, topic_index_n)
+    save_ranking_run(path, ranking_results, f"{I.analyzer}_{I.scoring}")
+    return ranking_results
+
+
+def save_ranking_run(path, ranking_results, run_name):
+    save_run(path, ranking_results)
+    if EXPORT_TREC_RUNS:
+        export_trec_run(ranking_results, f"{os.path.splitext(path)[0]}{TREC_RUN_SUFFIX}", run_name)
+
+
+def fold_splits(D):
+    doc_ids_list = list(D[1])
+    kf = KFold(n_splits=FOLDS, random_state=RANDOM_STATE, shuffle=True)
+    return [[doc_ids_list[i] for i in test] for _, test in kf.split(doc_ids_list)]
+
+
+def fold_subset(R, D, fold_doc_ids, fold):
+    R = (get_subset(R[0], fold_doc_ids[fold]), get_subset(R[1], fold_doc_ids[fold]))
+    return R, (f"{D[0]}_{FOLDS}_{fold}", get_subset(D[1], fold_doc_ids[fold]))
+
+
+def evaluate_folds(Q, R, D, analyzers, scorings, metric=(), skip_indexing=False, workers=None, fold_doc_ids=None):
+    # Every fold is indexed, ranked and scored in its own forked process; the corpus is inherited, not pickled.
+    # Returns the (model x measure) mean/std summary over the folds and the per-fold table
+    global fold_job
+    fold_doc_ids = fold_doc_ids if fold_doc_ids is not None else fold_splits(D)
+    workers = workers if workers is not None else FOLD_WORKERS  # read at call time, so setting FOLD_WORKERS takes effect
+    os.makedirs("whoosh", exist_ok=True)
+    fold_job = (Q, R, D, analyzers, scorings, metric, skip_indexing, fold_doc_ids)
+    start_time = time.time()
+    try:
+        with ProcessPoolExecutor(max_workers=max(1, min(FOLDS, workers)), mp_context=get_context('fork')) as executor:
+            fold_results = list(executor.map(evaluate_fold, range(FOLDS)))
+    finally:
+        fold_job = None
+    print(f"Evaluated {FOLDS} folds in {time.time() - start_time:.2f}s")
+
+    results = pd.DataFrame([{'fold': fold, 'model': model, **model_metrics} for fold, fold_result in enumerate(fold_results)
+                            for model, model_metrics in fold_result.items()])
+    summary = results.drop(columns='fold').groupby('model', sort=False).agg(['mean', 'std'])
+    print(summary)
+    return summary, results
+
+
+def evaluate_fold(fold):
+    global doc_index, doc_index_n, topic_index, topic_index_n, topics
+    Q, R, D, analyzers, scorings, metric, skip_indexing, fold_doc_ids = fold_job
+    topics = Q
+    (doc_index, doc_index_n), D = fold_subset(R, D, fold_doc_ids, fold)
+    topic_index, topic_index_n = invert_index(doc_index), invert_index(doc_index_n)
+
+    fold_results = {}
+    fingerprint = corpus_fingerprint(D[1]) if (USE_TOKEN_CACHE or USE_POSTING_FILE) and not skip_indexing else None
+    for analyzer in analyzers:
+        I, indexing_time, indexing_space = indexing(D, analyzer=analyzer, skip_indexing=skip_indexing, fingerprint=fingerprint)
+        for scoring in scorings:
+            I.scoring = scoring
+            metrics_scores = defaultdict(list)
+            for q_id, data in get_ranking_results(I).items():
+                for measure, score in calc_precision_based_measures(data['visited_documents'], data['related_documents'], K_TESTS).items():
+                    metrics_scores[measure].append(score)
+            fold_results[f"{analyzer} {scoring}"] = {'indexing time': indexing_time, **{measure: np.mean(scores) for measure, scores in metrics_scores.items()}}
+        if metric:
+            retrieval_results = get_retrieval_results(I, metric)
+            fold_results[f"{analyzer} {metric}"] = calculate_precision_boolean(I, retrieval_results, normalized=True)
+        I.close_search_session()
+    return fold_results
+
+
 def plot_a(I, Q, analyzer, metric):
     plt.gca().set_title(f"TF-IDF scores histogram for vocabulary with {analyzer}")
     plt.gca().set_xlabel("TF-IDF score")
@@ -399,17 +797,26 @@ def plot_a(I, Q, analyzer, metric):
 
 
 def retrieve_topics(I, topic_index, topic_index_n, k=5, metric=None):
+    return build_retrieval_results(topic_index, topic_index_n, boolean_queries(list(topic_index), I, k, metric=metric))
+
+
+def retrieve_topics_at_k(I, topic_index, topic_index_n, k_values, metric=None):
+    topics_retrieved_doc_ids_at_k = boolean_queries_at_k(list(topic_index), I, k_values, metric=metric)
+    return {k: build_retrieval_results(topic_index, topic_index_n, topics_retrieved_doc_ids_at_k[k]) for k in k_values}
+
+
+def build_retrieval_results(topic_index, topic_index_n, topics_retrieved_doc_ids):
     retrieval_results = {q_id: {'related_documents': set(doc_ids)} for q_id, doc_ids in topic_index.items()}
+    R = as_qrels(topic_index, topic_index_n)
 
     for q in tqdm(topic_index, desc=f'{f"RETRIEVING":20}'):
-        retrieved_doc_ids = boolean_query(q, I, k, metric=metric)
+        retrieved_doc_ids = topics_retrieved_doc_ids[q]
         assessed_doc_ids = set(topic_index.get(q, []) + topic_index_n.get(q, []))
         retrieval_result = {
             'unrelated_documents': set(topic_index_n.get(q, [])),
             'total_result': len(retrieved_doc_ids),
             'visited_documents': retrieved_doc_ids,
-            'assessed_documents': {doc_id: int(doc_id in topic_index[q]) for doc_id in assessed_doc_ids if
-                                   doc_id in topic_index.get(q, []) or doc_id in topic_index_n.get(q, [])},
+            'assessed_documents': {doc_id: int(R.is_relevant(q, doc_id)) for doc_id in assessed_doc_ids},
 
             'predicted_related': set(retrieved_doc_ids).intersection(assessed_doc_ids),
             'predicted_unrelated': assessed_doc_ids.difference(retrieved_doc_ids),
@@ -420,8 +827,7 @@ def retrieve_topics(I, topic_index, topic_index_n, k=5, metric=None):
 
 def get_boolean_at_k(I, k_values):
     k_dict = defaultdict(list)
-    for k in k_values:
-        retrieval_results_at_k = retrieve_topics(I, topic_index, topic_index_n, k, metric='tfidf')
+    for k, retrieval_results_at_k in retrieve_topics_at_k(I, topic_index, topic_index_n, k_values, metric='tfidf').items():
         boolean_precision_values = calculate_precision_boolean(I, retrieval_results_at_k)
         k_dict[k].append(boolean_precision_values['f-beta'])
         plt.figure(figsize=(15, 5))
@@ -433,83 +839,85 @@ def rank_topics(I, topic_index, topic_index_n, scoring=None, leave=True):
     if scoring:
         I.scoring = scoring
     ranking_results = {q_id: {'related_documents': set(doc_ids)} for q_id, doc_ids in topic_index.items()}
-    for q in tqdm(topic_index, desc=f'{f"RANKING":20}', leave=leave):
-        retrieved_doc_ids, retrieved_scores = zip(*ranking(q, DEFAULT_P, I))
+    R = as_qrels(topic_index, topic_index_n)
+    rankings = I.search_index_many([' '.join(topics[q].values()) for q in topic_index], DEFAULT_P)
+    for q, q_ranking in zip(tqdm(topic_index, desc=f'{f"RANKING":20}', leave=leave), rankings):
+        retrieved_doc_ids, retrieved_scores = zip(*q_ranking)
         ranking_result = {
             'total_result': len(retrieved_doc_ids),
             'visited_documents': retrieved_doc_ids,
+            'visited_scores': retrieved_scores,
             'visited_documents_orders': {doc_id: rank + 1 for rank, doc_id in enumerate(retrieved_doc_ids)},
-            'assessed_documents': {doc_id: (rank + 1, int(doc_id in topic_index[q])) for rank, doc_id in enumerate(retrieved_doc_ids) if
-                                   doc_id in topic_index.get(q, []) or doc_id in topic_index_n.get(q, [])}
+            'assessed_documents': {doc_id: (rank + 1, int(label)) for rank, (doc_id, label) in enumerate(zip(retrieved_doc_ids, R.label(q, retrieved_doc_ids)))
+                                   if label != UNJUDGED}
         }
         ranking_results[q].update(ranking_result)
+    if I.query_cache is not None:
+        print(f"Query cache: {I.query_cache.stats()}")
 
     return ranking_results
 
 
 def get_RRF_ranks(models_ranking_results, topic_index, topic_index_n):
-    rrf_scores = {}
-    for q_id in models_ranking_results[0]:
-        q_ranks = defaultdict(list)
-        for model in models_ranking_results:
-            for rank, doc_id in enumerate(model[q_id]["visited_documents"]):
-                q_ranks[doc_id].append(rank + 1)
-        for doc_id, ranks in q_ranks.items():
-            q_ranks[doc_id] = sum([1 / (50 + rank) for rank in q_ranks[doc_id]])
-        rrf_scores[q_id] = sorted(q_ranks.keys(), key=q_ranks.get, reverse=True)[:len(models_ranking_results[0][q_id]["visited_documents"])]
+    return get_fused_ranks(models_ranking_results, topic_index, topic_index_n, method='rrf')
+
+
+def get_fused_ranks(models_ranking_results, topic_index, topic_index_n, method=FUSION_METHOD, k=RRF_K, weights=None):
+    doc_id_map = DocIdMap(doc_id for model in models_ranking_results for q_id in model for doc_id in model[q_id]["visited_documents"])
+    topic_doc_runs = {q_id: [doc_id_map.encode(model[q_id]["visited_documents"]) for model in models_ranking_results]
+                      for q_id in models_ranking_results[0]}
+    topic_score_runs = None
+    if method != 'rrf':
+        if any("visited_scores" not in model[q_id] for model in models_ranking_results for q_id in topic_doc_runs):
+            warnings.warn(f"Some rankings were saved without their scores, {method} fuses them by rank instead; "
+                          f"re-run them to fuse their scores")
+        topic_score_runs = {q_id: [ranking_scores(model[q_id]) for model in models_ranking_results] for q_id in topic_doc_runs}
+    fused = fuse_topics(topic_doc_runs, topic_score_runs, method, k, weights,
+                        {q_id: len(models_ranking_results[0][q_id]["visited_documents"]) for q_id in topic_doc_runs})
 
     ranking_results = {q_id: {'related_documents': set(doc_ids)} for q_id, doc_ids in topic_index.items()}
+    R = as_qrels(topic_index, topic_index_n)
     for q in tqdm(topic_index, desc=f'{f"RANKING":20}'):
-        retrieved_doc_ids = rrf_scores[q]
+        fused_docs, fused_scores = fused[q]
+        retrieved_doc_ids = doc_id_map.decode(fused_docs)
         ranking_result = {
             'total_result': len(retrieved_doc_ids),
             'visited_documents': retrieved_doc_ids,
+            'visited_scores': fused_scores.tolist(),
             'visited_documents_orders': {doc_id: rank + 1 for rank, doc_id in enumerate(retrieved_doc_ids)},
-            'assessed_documents': {doc_id: (rank + 1, int(doc_id in topic_index[q])) for rank, doc_id in enumerate(retrieved_doc_ids) if
-                                   doc_id in topic_index.get(q, []) or doc_id in topic_index_n.get(q, [])}
+            'assessed_documents': {doc_id: (rank + 1, int(label)) for rank, (doc_id, label) in enumerate(zip(retrieved_doc_ids, R.label(q, retrieved_doc_ids)))
+                                   if label != UNJUDGED}
         }
         ranking_results[q].update(ranking_result)
 
     return ranking_results
 
 
-def tune_bm25(BM25tune_file, I, topic_index):
-    print(f"Tuning BM25 with {I.analyzer}...")
-    if os.path.isfile(f'{COLLECTION_PATH}{BM25tune_file}'):
-        results = pd.read_json(f'{COLLECTION_PATH}{BM25tune_file}', orient='split')
-    else:
-        results = None
-    results_update = defaultdict(list)
-    with tqdm(K1_TEST_VALS, desc=f'{f"TESTING k1={K1_TEST_VALS[0]:.2f}":20}') as k1_tqdm:
-        for k1 in k1_tqdm:
-            k1_tqdm.set_description(desc=f'{f"TESTING k1={k1:.2f}":20}')
-            with tqdm(B_TEST_VALS, desc=f'{f"TESTING b={B_TEST_VALS[0]:.2f}":20}', leave=False) as b_tqdm:
-                for b in b_tqdm:
-                    b_tqdm.set_description(desc=f'{f"TESTING b={b:.2f}":20}')
-                    if results is not None and not results.loc[(results['k1'] == k1) & (results['b'] == b)].empty:
-                        continue
-
-                    I.scoring = whoosh.scoring.BM25F(B=b, K1=k1)
-                    precision_results = rank_topics(I, topic_index, leave=False)
-
-                    metrics_scores = defaultdict(list)
-                    for q_id, data in precision_results.items():
-                        for metric, score in calc_precision_based_measures(data['visited_documents'], data['related_documents'], K_TESTS).items():
-                            metrics_scores[metric].append(score)
-
-                    for metric, scores in metrics_scores.items():
-                        results_update[metric].append(np.mean(scores))
-                    results_update['k1'].append(k1)
-                    results_update['b'].append(b)
-    update_data = pd.DataFrame(data=results_update)
-    if results is None:
-        results = update_data
-    else:
-        results.append(update_data, ignore_index=True)
-    with open(f'{COLLECTION_PATH}{BM25tune_file}{I.analyzer}.json', 'w') as f:
-        f.write(json.dumps(json.loads(results.to_json(orient='split')), indent=4))
+def ranking_scores(ranking_result):
+    # Checkpoints written before the scores were kept only have the ranking: scores then decrease with the rank
+    if "visited_scores" in ranking_result:
+        return ranking_result["visited_scores"]
+    return list(range(len(ranking_result["visited_documents"]), 0, -1))
+
+
+def tune_bm25(BM25tune_file, I, topic_index, k1_values=K1_TEST_VALS, b_values=B_TEST_VALS, workers=TUNING_WORKERS):
+    # Tunes Whoosh's BM25F, the scoring evaluation ranks with, from the statistics of the Whoosh index
+    print(f"Tuning BM25F with {I.analyzer}...")
+    q_ids = list(topic_index)
+    doc_rows = {doc_id: row for row, doc_id in enumerate(I.D)}
+    relevant_rows = [sorted({doc_rows[doc_id] for doc_id in topic_index[q_id] if doc_id in doc_rows}) for q_id in q_ids]
+    session = I.get_search_session()
+    queries = [set(session.parser.parse(' '.join(topics[q_id].values())).iter_all_terms()) for q_id in q_ids]
+    searcher = session.searcher()
+    whoosh_rows = np.full(searcher.doc_count_all(), -1, dtype=np.int64)
+    for docnum, stored_fields in searcher.reader().iter_docs():
+        whoosh_rows[docnum] = doc_rows.get(stored_fields['id'], -1)
+    sweep = BM25Sweep(whoosh_bm25f_fields(searcher, queries, whoosh_rows), relevant_rows, [len(set(topic_index[q_id])) for q_id in q_ids],
+                      DEFAULT_P, K_TESTS, model='bm25f')
+    results = run_sweep(sweep, k1_values, b_values, f'{COLLECTION_PATH}{BM25tune_file}{I.analyzer}.json', workers)
 
     print(results)
+    return results
 
 
 def invert_index(index):
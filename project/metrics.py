@@ -1,13 +1,15 @@
 import math
 from collections import defaultdict
+from itertools import accumulate
 
-import matplotlib.pyplot as plt
-import ml_metrics
 import numpy as np
-import pandas as pd
-import seaborn as sns
 
-from ir_evaluation.effectiveness import effectiveness
+from lazy import LazyModule, LazyObject, lazy_import
+
+plt = LazyModule('matplotlib.pyplot')
+pd = LazyModule('pandas')
+sns = LazyModule('seaborn')
+effectiveness = lazy_import('ir_evaluation.effectiveness', 'effectiveness')
 
 COLLECTION_LEN = 807168
 COLLECTION_PATH = 'collection/'
@@ -34,10 +36,10 @@ BETA_SQR = 0.5 ** 2
 K_TESTS = tuple([int(1.5 ** i) for i in range(1, 18)]) + (1000,)
 # K_TESTS = (1, 3, 5, 10, 20, 50, 100, 200, 500, DEFAULT_P)
 #
-ir = effectiveness()  # --> an object, which we can use all methods in it, is created
+ir = LazyObject(effectiveness)  # --> an object, which we can use all methods in it, is created on first use
 
 
-def multiple_line_chart(ax: plt.Axes, xvalues: list, yvalues: dict, title: str, xlabel: str, ylabel: str,
+def multiple_line_chart(ax: 'plt.Axes', xvalues: list, yvalues: dict, title: str, xlabel: str, ylabel: str,
                         show_points=False, xpercentage=False, ypercentage=False):
     legend: list = []
     ax.set_title(title)
@@ -61,22 +63,36 @@ def multiple_line_chart(ax: plt.Axes, xvalues: list, yvalues: dict, title: str,
 
 
 def calc_precision_based_measures(predicted_ids, expected_ids, ks=(10,), metric=None):
-    def precision(_predicted, _expected, k):
-        return len(set(_predicted[:k]).intersection(set(_expected))) / len(_predicted[:k])
-
-    def recall(_predicted, _expected, k):
-        return len(set(_predicted[:k]).intersection(set(_expected))) / len(_expected)
-
-    def fbeta(_predicted, _expected, k):
-        pre, rec = precision(_predicted, _expected, k), BETA * recall(_predicted, _expected, k)
+    # Every measure is read off one pass over the ranking: hits[i] is 1 when the i-th id is relevant and not repeated
+    predicted_ids, expected_ids = list(predicted_ids), list(expected_ids)
+    expected, seen, hits = set(expected_ids), set(), []
+    for doc_id in predicted_ids:
+        hits.append(int(doc_id in expected and doc_id not in seen))
+        seen.add(doc_id)
+    cum_hits = list(accumulate(hits, initial=0))
+
+    def precision(k):
+        return cum_hits[min(k, len(hits))] / min(k, len(hits))
+
+    def recall(k):
+        return cum_hits[min(k, len(hits))] / len(expected_ids)
+
+    def fbeta(k):
+        pre, rec = precision(k), BETA * recall(k)
         return 0.0 if pre == rec == 0 else (BETA_SQR + 1) * pre * rec / (BETA_SQR * pre + rec)
 
-    def map(_predicted, _expected, k):
-        return ml_metrics.mapk([_expected], [_predicted], k)
+    def map(k):  # same as ml_metrics.mapk([expected], [predicted], k)
+        if not expected_ids:
+            return 0.0
+        score = 0.0
+        for i, hit in enumerate(hits[:k]):
+            if hit:
+                score += cum_hits[i + 1] / (i + 1.0)
+        return score / min(len(expected_ids), k)
 
-    def MRR(predicted, expected, k):
+    def MRR(k):
         MRR = 0
-        for i, qid in zip(range(k), predicted):
+        for i, qid in zip(range(k), predicted_ids):
             if qid in expected:
                 MRR = 1 / (i + 1)
                 break
@@ -93,8 +109,28 @@ def calc_precision_based_measures(predicted_ids, expected_ids, ks=(10,), metric=
     if metric is None:
         metric = metrics.keys()
 
-    return {f'{measure}@{k}': metrics[measure]([int(i) for i in predicted_ids], [int(i) for i in expected_ids], k) for k
-            in ks for measure in metric}
+    return {f'{measure}@{k}': metrics[measure](k) for k in ks for measure in metric}
+
+
+def calc_hit_measures(hits, n_expected, ks=(10,), metric=None):
+    # calc_precision_based_measures over a 0/1 numpy hit vector, for rankings without repeated ids
+    hits = np.asarray(hits, dtype=np.float64)
+    cum_hits = np.concatenate(([0.0], np.cumsum(hits)))
+    precisions = cum_hits[1:] / np.arange(1, len(hits) + 1)
+    first_hit = np.flatnonzero(hits)
+    results, measures = {}, {}
+    for k in ks:
+        n = min(k, len(hits))
+        pre = cum_hits[n] / n if n else 0.0
+        rec = cum_hits[n] / n_expected if n_expected else 0.0
+        measures['precision'] = pre
+        measures['recall'] = rec
+        measures['fbeta'] = 0.0 if pre == BETA * rec == 0 else (BETA_SQR + 1) * pre * BETA * rec / (BETA_SQR * pre + BETA * rec)
+        measures['map'] = (precisions[:n] * hits[:n]).sum() / min(n_expected, k) if n_expected else 0.0
+        measures['mrr'] = 1 / (first_hit[0] + 1) if len(first_hit) and first_hit[0] < k else 0
+        for measure in metric or measures:
+            results[f'{measure}@{k}'] = measures[measure]
+    return results
 
 
 def precision_recall_generator(predicted, expected):
@@ -237,7 +273,7 @@ def precision_boolean_metrics(I, retrieval_results):
     return confusion_matrix_vals
 
 
-def bar_chart(ax: plt.Axes, xvalues: list, yvalues: list, title: str, xlabel: str, ylabel: str, percentage=False,
+def bar_chart(ax: 'plt.Axes', xvalues: list, yvalues: list, title: str, xlabel: str, ylabel: str, percentage=False,
               reverse=None):
     ax.set_title(title)
     ax.set_xlabel(xlabel)
@@ -304,7 +340,7 @@ def plot_confusion_matrix(ax, cnf_mtx, labels, title="", class_name="class"):
     return
 
 
-def print_general_stats(precision_results, title=None):
+def general_stats(precision_results):
     metrics_scores, results = defaultdict(list), defaultdict(list)
 
     for q_id, data in precision_results.items():
@@ -323,6 +359,12 @@ def print_general_stats(precision_results, title=None):
 
     results['BPref'] = [stats['value'] for k, stats in ir.bpref(precision_results, K_TESTS[:-1] + ('all',)).items()]
     results['BPref'] = [x if x else results['BPref'][-1] for x in results['BPref']]
+    return results
+
+
+def print_general_stats(precision_results, title=None, results=None):
+    if results is None:
+        results = general_stats(precision_results)
     multiple_line_chart(plt.gca(), list(K_TESTS), results, 'Metrics' + (f" for {title}" if title else ""), 'k', 'score',
                         True, False, True)
     plt.show()
@@ -0,0 +1,101 @@
+""" Shared memo of token normalisations (lemmas, stems)
+Every normaliser gets one surface form -> normal form dict, kept by name in a module-level registry so all the
+analyzer chains of a process share it. Once a dict holds NORMALISATION_CACHE_SIZE forms, new forms are still
+normalised but no longer kept. Forked analysis workers start from a copy of the parent's dicts and send back the
+forms they added (see drain/merge), so the parent's dicts keep growing while analysis runs in parallel. The dicts can
+be saved to normalisation_cache/<name>.json and loaded on the next run.
+"""
+
+import json
+import os
+
+NORMALISATION_CACHE_SIZE = 1000000
+NORMALISATION_CACHE_PATH = 'normalisation_cache'
+
+normalisation_caches = {}
+
+
+class NormalisationCache:
+    def __init__(self, name, function, size=NORMALISATION_CACHE_SIZE):
+        self.name = name
+        self.function = function
+        self.size = size
+        self.forms = {}
+        self.added = []  # forms added since the last drain
+        self.hits = self.misses = 0
+
+    def __call__(self, text):
+        form = self.forms.get(text)
+        if form is not None:
+            self.hits += 1
+            return form
+        self.misses += 1
+        form = self.function(text)
+        if len(self.forms) < self.size:
+            self.forms[text] = form
+            self.added.append(text)
+        return form
+
+    def __reduce__(self):
+        # Analyzers are pickled into Whoosh schemas: only the name travels, the forms come from the registry
+        return normalisation_cache, (self.name, self.function, self.size)
+
+    def drain(self):
+        forms, hits, misses = {text: self.forms[text] for text in self.added}, self.hits, self.misses
+        self.added, self.hits, self.misses = [], 0, 0
+        return forms, hits, misses
+
+    def clear(self):
+        self.forms, self.added = {}, []
+        self.hits = self.misses = 0
+
+    def merge(self, forms, hits, misses):
+        for text, form in forms.items():
+            if len(self.forms) >= self.size:
+                break
+            self.forms.setdefault(text, form)
+        self.hits += hits
+        self.misses += misses
+
+    def hit_rate(self):
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0
+
+    def load(self, path):
+        with open(path, encoding='utf8') as f:
+            self.forms.update(json.load(f))
+
+    def save(self, path):
+        with open(path, 'w', encoding='utf8') as f:
+            json.dump(self.forms, f)
+
+
+def normalisation_cache(name, function, size=NORMALISATION_CACHE_SIZE, path=None):
+    if name not in normalisation_caches:
+        cache = NormalisationCache(name, function, size)
+        if path and os.path.isfile(f'{path}/{name}.json'):
+            cache.load(f'{path}/{name}.json')
+        normalisation_caches[name] = cache
+    return normalisation_caches[name]
+
+
+def drain_normalisation_caches():
+    return {name: cache.drain() for name, cache in normalisation_caches.items()}
+
+
+def merge_normalisation_caches(drained):
+    for name, (forms, hits, misses) in drained.items():
+        if name in normalisation_caches:
+            normalisation_caches[name].merge(forms, hits, misses)
+
+
+def save_normalisation_caches(path=NORMALISATION_CACHE_PATH):
+    os.makedirs(path, exist_ok=True)
+    for name, cache in normalisation_caches.items():
+        cache.save(f'{path}/{name}.json')
+
+
+def normalisation_report():
+    for name, cache in normalisation_caches.items():
+        print(f"Normalisation cache {name}: {cache.hit_rate():.2%} hits ({cache.hits} of {cache.hits + cache.misses}), "
+              f"{len(cache.forms)} forms")
@@ -1,14 +1,23 @@
+import hashlib
 import json
 import os
 import tarfile
+import time
+import warnings
 from collections import defaultdict
+from multiprocessing import Pool
 
 import numpy as np
 
+from io import BytesIO
 from itertools import groupby
 from tqdm import tqdm
 
 from bs4 import BeautifulSoup
+from lxml import etree
+
+from docstore import docstore_exists, open_docstore, remove_docs, save_docstore
+from qrels import QrelsIndex
 
 COLLECTION_LEN = 807168
 COLLECTION_PATH = 'collection/'
@@ -31,6 +40,13 @@ K1_TEST_VALS = np.arange(0, 4.1, 0.5)
 B_TEST_VALS = np.arange(0, 1.1, 0.2)
 DEFAULT_P = 1000
 K_TESTS = (1, 3, 5, 10, 20, 50, 100, 200, 500, DEFAULT_P)
+PARSING_WORKERS = 1  # > 1 parses the collection files on a process pool
+PARSING_CHUNK_SIZE = 512  # files handed to a worker at a time
+STREAM_ARCHIVE = False  # parse the documents straight out of the archive, without extracting it
+ARCHIVE_PATH = f'{COLLECTION_PATH}{DATASET}.tar.xz'
+XML_BACKEND = 'bs4'  # 'lxml' extracts the newsitem fields in a single iterparse pass, with identical output
+REFRESH_CORPUS = False  # parse only new or changed collection files into the saved document stores
+VERIFY_REFRESH = False  # list every directory on refresh, instead of trusting unchanged directory mtimes for added or deleted files
 
 
 def tqdm_generator(members, n):
@@ -38,53 +54,149 @@ def tqdm_generator(members, n):
         yield member
 
 
-def read_documents(dirs, sample_size=None):
+def read_documents(dirs, sample_size=None, workers=PARSING_WORKERS, chunk_size=PARSING_CHUNK_SIZE):
+    start_time = time.time()
+    if workers > 1:
+        docs, files = read_documents_parallel(dirs, sample_size, workers, chunk_size)
+    else:
+        docs, files = {}, {}
+        for directory in tqdm(dirs, desc=f'{"PARSING DATASET":20}'):
+            for file_name in tqdm(sorted(os.listdir(f"{COLLECTION_PATH}{DATASET}/{directory}"))[:sample_size],
+                                  desc=f'{f"  DIR[{directory}]":20}', leave=False):
+                file_path = f"{COLLECTION_PATH}{DATASET}/{directory}/{file_name}"
+                parsed_doc, files[file_path] = parse_xml_file(file_path)
+                docs.update(parsed_doc)
+    elapsed_time = time.time() - start_time
+    print(f"Parsed {len(docs)} documents with {max(workers, 1)} worker(s) in {elapsed_time:.2f}s "
+          f"({len(docs) / max(elapsed_time, 1e-9):.1f} files/s)")
+    return docs, files
+
+
+def read_documents_parallel(dirs, sample_size=None, workers=PARSING_WORKERS, chunk_size=PARSING_CHUNK_SIZE):
+    file_names = [f"{COLLECTION_PATH}{DATASET}/{directory}/{file_name}" for directory in dirs
+                  for file_name in sorted(os.listdir(f"{COLLECTION_PATH}{DATASET}/{directory}"))[:sample_size]]
+    return parse_files(file_names, workers, chunk_size)
+
+
+def parse_files(file_names, workers=PARSING_WORKERS, chunk_size=PARSING_CHUNK_SIZE):
+    if workers <= 1:
+        return parse_xml_docs(tqdm(file_names, desc=f'{"PARSING FILES":20}'))
+    chunks = [file_names[i:i + chunk_size] for i in range(0, len(file_names), chunk_size)]
+    docs, files = {}, {}
+    with Pool(workers) as pool:
+        # imap keeps the chunks in submission order, so the merge matches the sequential path
+        for parsed_docs, parsed_files in tqdm(pool.imap(parse_xml_docs, chunks), total=len(chunks), desc=f'{"PARSING DATASET":20}'):
+            docs.update(parsed_docs)
+            files.update(parsed_files)
+    return docs, files
+
+
+def parse_xml_docs(filenames):
+    parsed_docs, parsed_files = {}, {}
+    for filename in filenames:
+        parsed_doc, parsed_files[filename] = parse_xml_file(filename)
+        parsed_docs.update(parsed_doc)
+    return parsed_docs, parsed_files
+
+
+def read_documents_from_archive(splits=('test',), workers=PARSING_WORKERS, chunk_size=PARSING_CHUNK_SIZE):
+    start_time = time.time()
+    parsed_files = {split: defaultdict(dict) for split in splits}
+    pool = Pool(workers) if workers > 1 else None
+    try:
+        imap = pool.imap if pool else map
+        for parsed_chunk in imap(parse_archive_members, archive_member_chunks(splits, chunk_size)):
+            for split, directory, file_name, parsed_doc in parsed_chunk:
+                parsed_files[split][directory][file_name] = parsed_doc
+    finally:
+        if pool:
+            pool.close()
+            pool.join()
     docs = {}
-    for directory in tqdm(dirs, desc=f'{"PARSING DATASET":20}'):
-        for file_name in tqdm(sorted(os.listdir(f"{COLLECTION_PATH}{DATASET}/{directory}"))[:sample_size],
-                              desc=f'{f"  DIR[{directory}]":20}', leave=False):
-            docs.update(parse_xml_doc(f"{COLLECTION_PATH}{DATASET}/{directory}/{file_name}"))
+    # Members are merged in sorted directory/file order, as read_documents would list them on disk
+    for split, directories in parsed_files.items():
+        docs[split] = {}
+        for directory in sorted(directories):
+            for file_name in sorted(directories[directory]):
+                docs[split].update(directories[directory][file_name])
+    elapsed_time = time.time() - start_time
+    n_docs = sum(len(split_docs) for split_docs in docs.values())
+    print(f"Parsed {n_docs} documents from {ARCHIVE_PATH} with {max(workers, 1)} worker(s) in {elapsed_time:.2f}s "
+          f"({n_docs / max(elapsed_time, 1e-9):.1f} files/s)")
     return docs
 
 
-def parse_qrels(filename):
-    topic_index, doc_index, topic_index_n, doc_index_n = defaultdict(list), defaultdict(list), defaultdict(
-        list), defaultdict(list)
-    with open(filename, encoding='utf8') as f:
-        for line in tqdm(f.readlines(), desc=f'{"READING QRELS":20}'):
-            q_id, doc_id, relevance = line.split()
-            if int(relevance.replace('\n', '')):
-                topic_index[q_id].append(doc_id)
-                doc_index[doc_id].append(q_id)
-            else:
-                topic_index_n[q_id].append(doc_id)
-                doc_index_n[doc_id].append(q_id)
+def archive_member_chunks(splits, chunk_size):
+    chunk = []
+    with tarfile.open(ARCHIVE_PATH, 'r|xz') as D:
+        for member in tqdm_generator(D, COLLECTION_LEN):
+            path = member.name.split('/')
+            if not member.isfile() or len(path) < 2 or not path[-2].isdigit():
+                continue
+            directory, file_name = path[-2:]
+            split = dataset_dir_split(directory)
+            if split not in splits:
+                continue
+            chunk.append((split, directory, file_name, D.extractfile(member).read().decode('ISO-8859-1')))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+    if chunk:
+        yield chunk
+
 
-    return dict(topic_index), dict(doc_index), dict(topic_index_n), dict(doc_index_n)
+def parse_archive_members(members):
+    return [(split, directory, file_name, parse_xml_string(raw_doc)) for split, directory, file_name, raw_doc in members]
 
 
-def parse_dataset(split="test"):
-    train_dirs, test_dirs = [list(items) for key, items in groupby(sorted(os.listdir(COLLECTION_PATH + DATASET))[:-3],
-                                                                   lambda x: x == TRAIN_DATE_SPLIT) if not key]
+def split_dataset_dirs(dirs):
+    train_dirs, test_dirs = [list(items) for key, items in groupby(sorted(dirs), lambda x: x == TRAIN_DATE_SPLIT) if not key]
     train_dirs.append(TRAIN_DATE_SPLIT)
+    return train_dirs, test_dirs
+
+
+def dataset_dir_split(directory):
+    # Same split as split_dataset_dirs, decided one date directory at a time
+    return 'train' if directory <= TRAIN_DATE_SPLIT else 'test'
+
+
+def parse_qrels(filename):
+    return parse_qrels_index(filename).to_dicts()
+
+
+def parse_qrels_index(filename):
+    with open(filename, encoding='utf8') as f:
+        return QrelsIndex(line.split() for line in tqdm(f.readlines(), desc=f'{"READING QRELS":20}'))
+
+
+def parse_dataset(split="test", stream=STREAM_ARCHIVE):
+    if stream:
+        archive_docs = read_documents_from_archive(('test', 'train') if split not in ('test', 'train') else (split,))
+        read_split = lambda s: (archive_docs[s], None)
+    else:
+        train_dirs, test_dirs = split_dataset_dirs(sorted(os.listdir(COLLECTION_PATH + DATASET))[:-3])
+        split_dirs = {'train': train_dirs, 'test': test_dirs}
+        read_split = lambda s: read_documents_manifest(split_dirs[s])
     test_docs = train_docs = None
 
     if split != 'train':
-        test_docs = read_documents(test_dirs[:], sample_size=None)
+        test_docs, test_manifest = read_split('test')
 
-        print(f"Saving full set to {DATASET}.json...")
-        with open(f'{COLLECTION_PATH}{DATASET}_test.json', 'w', encoding='ISO-8859-1') as f:
-            f.write(json.dumps(test_docs, indent=4))
+        print(f"Saving full set to {DATASET}_test document store...")
+        save_docstore(corpus_path('_test'), test_docs)
+        if test_manifest is not None:
+            save_manifest(corpus_path('_test'), test_manifest)
 
         if split == 'test':
             return test_docs
 
     if split != 'test':
-        train_docs = read_documents(train_dirs[:], sample_size=None)
+        train_docs, train_manifest = read_split('train')
 
-        print(f"Saving full set to {DATASET}.json...")
-        with open(f'{COLLECTION_PATH}{DATASET}_train.json', 'w', encoding='ISO-8859-1') as f:
-            f.write(json.dumps(train_docs, indent=4))
+        print(f"Saving full set to {DATASET}_train document store...")
+        save_docstore(corpus_path('_train'), train_docs)
+        if train_manifest is not None:
+            save_manifest(corpus_path('_train'), train_manifest)
 
         if split == 'train':
             return train_docs
@@ -92,12 +204,128 @@ def parse_dataset(split="test"):
     return {'train': train_docs, 'test': test_docs}
 
 
+def corpus_path(suffix=''):
+    return f'{COLLECTION_PATH}{DATASET}{suffix}'
+
+
+def load_corpus(suffix=''):
+    path = corpus_path(suffix)
+    if not docstore_exists(path) and os.path.isfile(f'{path}.json'):
+        print(f"{DATASET}{suffix}.json found, converting it to a document store...")
+        with open(f'{path}.json', encoding='ISO-8859-1') as f:
+            save_docstore(path, json.loads(f.read()))
+    return open_docstore(path) if docstore_exists(path) else None
+
+
+def read_documents_manifest(dirs):
+    # Directory mtimes are taken before listing, so files added while parsing show up on the next refresh
+    dir_mtimes = {directory: os.stat(f"{COLLECTION_PATH}{DATASET}/{directory}").st_mtime_ns for directory in dirs}
+    docs, files = read_documents(dirs[:], sample_size=None)
+    manifest = {directory: {'mtime': dir_mtime, 'files': {}} for directory, dir_mtime in dir_mtimes.items()}
+    record_files(manifest, files)
+    return docs, manifest
+
+
+def record_files(manifest, files):
+    for file_path, entry in files.items():
+        directory, file_name = file_path.split('/')[-2:]
+        manifest[directory]['files'][file_name] = entry
+
+
+def manifest_doc_ids(manifest):
+    return {doc_id for known in manifest.values() for entry in known['files'].values() if len(entry) > 3 for doc_id in entry[3]}
+
+
+def manifest_files(manifest):
+    return {(directory, file_name): entry for directory, known in manifest.items() for file_name, entry in known['files'].items()}
+
+
+def refresh_dataset(split='test', verify=VERIFY_REFRESH):
+    if STREAM_ARCHIVE:
+        print(f"Streaming documents from \"{ARCHIVE_PATH}\", corpus refresh needs the extracted collection.")
+        return 0
+    path = corpus_path(f'_{split}')
+    train_dirs, test_dirs = split_dataset_dirs(sorted(os.listdir(COLLECTION_PATH + DATASET))[:-3])
+    old_manifest = load_manifest(path) if docstore_exists(path) else {}
+    manifest, changed_files = build_manifest(train_dirs if split == 'train' else test_dirs, old_manifest, verify)
+    print(f"Refreshing {DATASET}_{split}: {len(changed_files)} new or changed files...")
+    if changed_files:
+        docs, files = parse_files(changed_files)
+        save_docstore(path, docs, append=True)
+        record_files(manifest, files)
+    # Documents of deleted files, or gone from their changed file, are dropped from the store
+    removed_doc_ids = manifest_doc_ids(old_manifest) - manifest_doc_ids(manifest)
+    current_files = manifest_files(manifest)
+    unknown = sum(len(entry) < 4 for key, entry in manifest_files(old_manifest).items() if key not in current_files)
+    if unknown:
+        warnings.warn(f"{unknown} deleted files were recorded without their document ids, "
+                      f"parse {DATASET}_{split} again to drop their documents")
+    if removed_doc_ids:
+        print(f"Removing {len(removed_doc_ids)} documents of deleted files from {DATASET}_{split}...")
+        remove_docs(path, removed_doc_ids)
+    save_manifest(path, manifest)
+    return len(changed_files) + len(removed_doc_ids)
+
+
+def build_manifest(dirs, manifest=None, verify=True):
+    manifest = manifest or {}
+    # {directory: {'mtime': ns, 'files': {file_name: [size, mtime_ns, sha1, doc ids]}}}
+    new_manifest, changed_files = {}, []
+    for directory in tqdm(dirs, desc=f'{"CHECKING DATASET":20}'):
+        dir_path = f"{COLLECTION_PATH}{DATASET}/{directory}"
+        dir_mtime = os.stat(dir_path).st_mtime_ns
+        known = manifest.get(directory)
+        known_files = known['files'] if known else {}
+        if known and not verify and known['mtime'] == dir_mtime:
+            # No file was added or deleted, but files edited in place only show in their own size and mtime
+            file_names = list(known_files)
+        else:
+            file_names = sorted(os.listdir(dir_path))
+        files = {}
+        for file_name in file_names:
+            file_path = f"{dir_path}/{file_name}"
+            try:
+                stat = os.stat(file_path)
+            except FileNotFoundError:
+                continue
+            entry = known_files.get(file_name)
+            if entry and entry[:2] == [stat.st_size, stat.st_mtime_ns]:
+                files[file_name] = entry
+                continue
+            files[file_name] = [stat.st_size, stat.st_mtime_ns, file_hash(file_path)]
+            if entry and entry[2] == files[file_name][2]:
+                files[file_name] += entry[3:]  # touched, not changed: the documents stay the same
+            else:
+                changed_files.append(file_path)
+        new_manifest[directory] = {'mtime': dir_mtime, 'files': files}
+    return new_manifest, changed_files
+
+
+def file_hash(file_path):
+    with open(file_path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_manifest(path):
+    if not os.path.isfile(f'{path}.manifest.json'):
+        return {}
+    with open(f'{path}.manifest.json', encoding='utf8') as f:
+        return json.load(f)
+
+
+def save_manifest(path, manifest):
+    with open(f'{path}.manifest.json', 'w', encoding='utf8') as f:
+        json.dump(manifest, f)
+
+
 def extract_dataset():
-    if os.path.isdir(f'{COLLECTION_PATH}{DATASET}'):
+    if STREAM_ARCHIVE:
+        print(f'Streaming documents from "{ARCHIVE_PATH}", no extraction needed.', flush=True)
+    elif os.path.isdir(f'{COLLECTION_PATH}{DATASET}'):
         print(f'Directory "{DATASET}" already exists, no extraction needed.', flush=True)
     else:
         print('Directory "rcv1" not found. Extracting "rcv.tar.xz..."', flush=True)
-        with tarfile.open('collection/rcv1.tar.xz', 'r:xz') as D:
+        with tarfile.open(ARCHIVE_PATH, 'r:xz') as D:
             def is_within_directory(directory, target):
                 
                 abs_directory = os.path.abspath(directory)
@@ -120,13 +348,72 @@ def extract_dataset():
             safe_extract(D, "collection/", members=tqdm_generator(D,COLLECTION_LEN))
 
 
-def parse_xml_doc(filename):
+def parse_xml_file(filename):
+    # The manifest entry is taken from the very bytes that were parsed: [size, mtime_ns, sha1, doc ids]
+    with open(filename, 'rb') as f:
+        stat = os.fstat(f.fileno())
+        raw_doc = f.read()
+    parsed_doc = parse_xml_string(raw_doc.decode('ISO-8859-1'))
+    return parsed_doc, [stat.st_size, stat.st_mtime_ns, hashlib.sha1(raw_doc).hexdigest(), list(parsed_doc)]
+
+
+def parse_xml_string(raw_doc, backend=None):
+    return XML_EXTRACTORS[backend or XML_BACKEND](raw_doc)
+
+
+def parse_xml_string_bs4(raw_doc):
     parsed_doc = {}
-    with open(filename, encoding='ISO-8859-1') as f:
-        soup = BeautifulSoup(f.read().strip(), 'lxml')
-        for tag in AVAILABLE_DATA:
-            parsed_doc[tag] = ''.join([str(e.string) for e in soup.find_all(tag)])
-        return {soup.find(DATA_HEADER[0])[DATA_HEADER[1]]: parsed_doc}
+    soup = BeautifulSoup(raw_doc.strip(), 'lxml')
+    for tag in AVAILABLE_DATA:
+        parsed_doc[tag] = ''.join([str(e.string) for e in soup.find_all(tag)])
+    return {soup.find(DATA_HEADER[0])[DATA_HEADER[1]]: parsed_doc}
+
+
+def parse_xml_string_lxml(raw_doc):
+    if '<![CDATA[' in raw_doc:  # the HTML parser behind the bs4 backend mangles CDATA, keep its output
+        return parse_xml_string_bs4(raw_doc)
+    strings, pending, doc_id = {tag: [] for tag in AVAILABLE_DATA}, {}, None
+    try:
+        for event, element in etree.iterparse(BytesIO(raw_doc.strip().encode('ISO-8859-1')), events=('start', 'end'),
+                                              encoding='ISO-8859-1', resolve_entities=False):
+            if not isinstance(element.tag, str):
+                continue
+            tag = element.tag.lower()
+            if event == 'start':
+                if tag == DATA_HEADER[0] and doc_id is None:
+                    doc_id = element.get(DATA_HEADER[1])
+                elif tag in strings:
+                    if tag == 'p' and any(pending_tag == 'p' for pending_tag, _ in pending.values()):
+                        return parse_xml_string_bs4(raw_doc)  # the HTML parser closes the outer <p> first
+                    # Slots are taken in document order, like find_all, and filled once the element is complete
+                    pending[element] = (tag, len(strings[tag]))
+                    strings[tag].append(None)
+            elif element in pending:
+                tag, slot = pending.pop(element)
+                strings[tag][slot] = element_string(element)
+    except etree.XMLSyntaxError:
+        return parse_xml_string_bs4(raw_doc)
+    if doc_id is None:
+        return parse_xml_string_bs4(raw_doc)
+    return {doc_id: {tag: ''.join([str(string) for string in strings[tag]]) for tag in AVAILABLE_DATA}}
+
+
+def element_string(element):
+    # Same as bs4's Tag.string: the lone text child, looking through tags with a single child, else None
+    while True:
+        if element.text is not None:
+            return None if len(element) else element.text
+        if len(element) != 1 or element[0].tail is not None:
+            return None
+        element = element[0]
+        if not isinstance(element.tag, str):
+            return element.text
+
+
+XML_EXTRACTORS = {
+    'bs4': parse_xml_string_bs4,
+    'lxml': parse_xml_string_lxml,
+}
 
 
 def parse_topics(filename):
@@ -0,0 +1,255 @@
+""" Compressed, memory-mapped posting file of the count index
+A posting file at <path> holds a (docs x terms) count matrix term by term:
+    <path>.docs             doc id gaps in variable-byte code, 7 bits per byte, the high bit set on all but the last
+    <path>.freqs.npy        one byte per posting: its count, or TF_EXCEPTION for counts that do not fit in it
+    <path>.exceptions.npy   (n_exceptions, 2) posting number and count of every posting coded TF_EXCEPTION
+    <path>.indptr.npy       (n_terms + 1) first posting of every term
+    <path>.skips.npy        (n_blocks + 1, 2) last doc id and first byte in <path>.docs of every block of
+                            POSTING_BLOCK_SIZE postings of a term; the last row only closes the byte range
+    <path>.terms            term dictionary: the vocabulary, sorted, one term per line (UTF-8)
+    <path>.term_offsets.npy (n_terms + 1) byte offset of every term in <path>.terms
+    <path>.columns.npy      (n_terms, 2) column and vocabulary position of every term in <path>.terms
+    <path>.meta.json        shape and block size
+Everything is opened with mmap, so opening a file costs a few milliseconds whatever its size. Postings are decoded
+for the terms a query touches, and lookups of given documents only decode the blocks their skip pointers point to.
+The gap of the first posting of a block is relative to the last doc id of the previous block (0 at a term start), so
+every block decodes on its own. Counts are quantised to one byte and the rare larger ones patched from the
+exceptions, so decoded counts are exact.
+"""
+
+import json
+import mmap
+import os
+
+import numpy as np
+from scipy import sparse
+
+from postings import PostingLists
+from tokencache import corpus_fingerprint
+
+POSTING_FILE_PATH = 'postings'
+POSTING_BLOCK_SIZE = 128
+TF_EXCEPTION = 255
+POSTING_FILES = ('docs', 'freqs.npy', 'exceptions.npy', 'indptr.npy', 'skips.npy', 'terms', 'term_offsets.npy',
+                 'columns.npy', 'meta.json')
+
+
+def vbyte_encode(values):
+    values = np.asarray(values, dtype=np.uint64)
+    n_bytes = np.ones(len(values), dtype=np.int64)
+    for shift in range(7, 64, 7):
+        n_bytes += values >= np.uint64(1 << shift)
+    owners = np.repeat(np.arange(len(values)), n_bytes)
+    positions = np.arange(len(owners)) - np.repeat(np.cumsum(n_bytes) - n_bytes, n_bytes)
+    encoded = ((values[owners] >> (7 * positions).astype(np.uint64)) & np.uint64(127)).astype(np.uint8)
+    encoded[positions < n_bytes[owners] - 1] |= 128
+    return encoded, n_bytes
+
+
+def vbyte_decode(encoded):
+    encoded = np.asarray(encoded, dtype=np.uint8)
+    ends = np.flatnonzero(encoded < 128)
+    if not len(ends):
+        return np.zeros(0, dtype=np.int64)
+    starts = np.concatenate(([0], ends[:-1] + 1))
+    shifts = 7 * (np.arange(len(encoded)) - np.repeat(starts, ends - starts + 1))
+    return np.add.reduceat((encoded & 127).astype(np.int64) << shifts, starts)
+
+
+def ranges(starts, ends):
+    # Concatenation of arange(start, end) for every pair, without a Python loop
+    lengths = ends - starts
+    return np.arange(lengths.sum()) + np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+
+
+class PostingFile:
+    def __init__(self, path):
+        self.path = path
+        with open(f'{path}.meta.json', encoding='utf8') as f:
+            meta = json.load(f)
+        self.n_docs, self.n_terms, self.block_size = meta['n_docs'], meta['n_terms'], meta['block_size']
+        self.freqs = np.load(f'{path}.freqs.npy', mmap_mode='r')
+        self.exceptions = np.load(f'{path}.exceptions.npy', mmap_mode='r')
+        self.indptr = np.load(f'{path}.indptr.npy', mmap_mode='r')
+        self.skips = np.load(f'{path}.skips.npy', mmap_mode='r')
+        self.term_offsets = np.load(f'{path}.term_offsets.npy', mmap_mode='r')
+        self.columns = np.load(f'{path}.columns.npy', mmap_mode='r')
+        self._docs = self._map(f'{path}.docs')
+        self._terms = self._map(f'{path}.terms')
+        self._block_ptr = None
+
+    @staticmethod
+    def _map(path):
+        with open(path, 'rb') as f:
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b''
+
+    def __reduce__(self):
+        return PostingFile, (self.path,)
+
+    @property
+    def block_ptr(self):
+        # First block of every term
+        if self._block_ptr is None:
+            n_blocks = (np.diff(self.indptr) + self.block_size - 1) // self.block_size
+            self._block_ptr = np.concatenate(([0], np.cumsum(n_blocks)))
+        return self._block_ptr
+
+    def term(self, i):
+        return self._terms[self.term_offsets[i]:self.term_offsets[i + 1] - 1].decode('utf8')
+
+    def column(self, term):
+        # Binary search of the term dictionary, -1 for unknown terms
+        low, high = 0, self.n_terms
+        while low < high:
+            middle = (low + high) // 2
+            if self.term(middle) < term:
+                low = middle + 1
+            else:
+                high = middle
+        return int(self.columns[low, 0]) if low < self.n_terms and self.term(low) == term else -1
+
+    def vocabulary(self):
+        # term -> column, in the order of the vocabulary the file was written from
+        terms = self._terms[:].decode('utf8').split('\n')[:-1] if self.n_terms else []
+        order = np.argsort(self.columns[:, 1], kind='stable')
+        return {terms[i]: int(column) for i, column in zip(order.tolist(), self.columns[order, 0].tolist())}
+
+    def document_frequencies(self):
+        return np.diff(self.indptr)
+
+    def decode_blocks(self, blocks):
+        # Doc ids and counts of the postings of the given blocks, concatenated in block order
+        blocks = np.asarray(blocks, dtype=np.int64)
+        byte_ranges = ranges(self.skips[blocks, 1].astype(np.int64), self.skips[blocks + 1, 1].astype(np.int64))
+        gaps = vbyte_decode(np.frombuffer(self._docs, dtype=np.uint8)[byte_ranges] if len(byte_ranges) else [])
+        terms = np.searchsorted(self.block_ptr, blocks, side='right') - 1
+        first = self.indptr[terms] + (blocks - self.block_ptr[terms]) * self.block_size
+        lengths = np.minimum(first + self.block_size, self.indptr[terms + 1]) - first
+        # The first gap of a block counts from the last doc id of the previous block of its term
+        bases = np.where(blocks > self.block_ptr[terms], self.skips[np.maximum(blocks - 1, 0), 0], 0)
+        starts = np.cumsum(lengths) - lengths
+        docs = np.cumsum(gaps)
+        docs += np.repeat(bases - (docs[starts] - gaps[starts]) if len(gaps) else bases, lengths)
+        return docs, self.counts(ranges(first, first + lengths)), lengths
+
+    def counts(self, positions):
+        counts = self.freqs[positions].astype(np.int64)
+        patched = np.flatnonzero(counts == TF_EXCEPTION)
+        if len(patched):
+            counts[patched] = self.exceptions[np.searchsorted(self.exceptions[:, 0], positions[patched]), 1]
+        return counts
+
+    def decode(self, terms):
+        # Postings of all given terms concatenated, with their counts and the number of postings of every term
+        terms = np.asarray(terms, dtype=np.int64)
+        docs, counts, _ = self.decode_blocks(ranges(self.block_ptr[terms], self.block_ptr[terms + 1]))
+        return docs, counts, self.indptr[terms + 1] - self.indptr[terms]
+
+    def postings(self, term):
+        return self.decode([term])[0]
+
+    def lookup(self, term, docs):
+        # Counts of the given docs in the postings of a term (0 where absent); only the blocks whose doc id range
+        # can hold one of them are decoded
+        docs = np.asarray(docs, dtype=np.int64)
+        first, last = self.block_ptr[term], self.block_ptr[term + 1]
+        blocks = np.unique(first + np.searchsorted(self.skips[first:last, 0], docs))
+        blocks = blocks[blocks < last]
+        block_docs, block_counts, _ = self.decode_blocks(blocks)
+        found = np.minimum(np.searchsorted(block_docs, docs), max(len(block_docs) - 1, 0))
+        return np.where(block_docs[found] == docs, block_counts[found], 0) if len(block_docs) else np.zeros(len(docs), dtype=np.int64)
+
+    def count_matrix(self):
+        docs, counts, _ = self.decode(np.arange(self.n_terms))
+        matrix = sparse.csc_matrix((counts, docs, np.asarray(self.indptr, dtype=np.int64)), shape=(self.n_docs, self.n_terms))
+        return matrix.tocsr()
+
+    def size(self):
+        return sum(os.path.getsize(f'{self.path}.{file}') for file in POSTING_FILES)
+
+    def close(self):
+        for data in (self._docs, self._terms):
+            if isinstance(data, mmap.mmap):
+                data.close()
+
+
+class CompressedPostingLists(PostingLists):
+    # The boolean retrieval queries of PostingLists, answered from a posting file
+    def __init__(self, posting_file):
+        self.posting_file = posting_file
+        self.n_docs, self.n_terms = posting_file.n_docs, posting_file.n_terms
+
+    def postings(self, term):
+        return self.posting_file.postings(term)
+
+    def document_frequencies(self):
+        return self.posting_file.document_frequencies()
+
+    def gather(self, terms):
+        docs, _, lengths = self.posting_file.decode(terms)
+        return docs, lengths
+
+    def nbytes(self):
+        return 0  # mapped, not loaded
+
+
+def posting_file_path(D, analyzer, fingerprint=None):
+    # Named like the token cache of the same corpus and analyzer
+    return f'{POSTING_FILE_PATH}/{analyzer}_{fingerprint or corpus_fingerprint(D)}'
+
+
+def posting_file_exists(path):
+    return all(os.path.isfile(f'{path}.{file}') for file in POSTING_FILES)
+
+
+def open_posting_file(path):
+    return PostingFile(path)
+
+
+def save_posting_file(path, counts, vocabulary, block_size=POSTING_BLOCK_SIZE):
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    counts = sparse.csc_matrix(counts)
+    counts.sum_duplicates()  # also sorts the docs of every term
+    counts.eliminate_zeros()
+    n_docs, n_terms = counts.shape
+    indptr, docs, values = counts.indptr.astype(np.int64), counts.indices.astype(np.int64), counts.data.astype(np.int64)
+
+    gaps = docs.copy()
+    gaps[1:] -= docs[:-1]
+    term_starts = indptr[:-1][np.diff(indptr) > 0]
+    gaps[term_starts] = docs[term_starts]
+    encoded, n_bytes = vbyte_encode(gaps)
+    byte_starts = np.cumsum(n_bytes) - n_bytes
+
+    n_blocks = (np.diff(indptr) + block_size - 1) // block_size
+    block_ptr = np.concatenate(([0], np.cumsum(n_blocks)))
+    first = np.repeat(indptr[:-1], n_blocks) + (np.arange(block_ptr[-1]) - np.repeat(block_ptr[:-1], n_blocks)) * block_size
+    last = np.minimum(first + block_size, np.repeat(indptr[1:], n_blocks)) - 1
+    skips = np.column_stack((docs[last], byte_starts[first]))
+    skips = np.concatenate((skips, [[0, len(encoded)]])).astype(np.int64)
+
+    freqs = np.minimum(values, TF_EXCEPTION).astype(np.uint8)
+    patched = np.flatnonzero(values >= TF_EXCEPTION)
+    exceptions = np.column_stack((patched, values[patched])).astype(np.int64)
+
+    positions = {term: position for position, term in enumerate(vocabulary)}
+    terms = sorted(vocabulary)
+    term_bytes = [f'{term}\n'.encode('utf8') for term in terms]
+    term_offsets = np.concatenate(([0], np.cumsum([len(term) for term in term_bytes]))).astype(np.int64)
+    columns = np.array([(vocabulary[term], positions[term]) for term in terms], dtype=np.int64).reshape(-1, 2)
+
+    with open(f'{path}.docs', 'wb') as f:
+        f.write(encoded.tobytes())
+    with open(f'{path}.terms', 'wb') as f:
+        f.write(b''.join(term_bytes))
+    np.save(f'{path}.freqs.npy', freqs)
+    np.save(f'{path}.exceptions.npy', exceptions.reshape(-1, 2))
+    np.save(f'{path}.indptr.npy', indptr)
+    np.save(f'{path}.skips.npy', skips)
+    np.save(f'{path}.term_offsets.npy', term_offsets)
+    np.save(f'{path}.columns.npy', columns)
+    with open(f'{path}.meta.json', 'w', encoding='utf8') as f:
+        json.dump({'n_docs': n_docs, 'n_terms': n_terms, 'block_size': block_size}, f)
+    return PostingFile(path)
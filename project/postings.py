@@ -0,0 +1,66 @@
+""" Posting lists over the boolean (docs x terms) matrix
+The postings of a term are the sorted rows of the documents that contain it. "At least m of these terms" queries
+only merge the postings of their terms, so their cost follows posting length instead of collection size, and a
+batch of queries is answered with a single counting pass over all of their postings.
+"""
+
+import numpy as np
+from scipy import sparse
+
+
+class PostingLists:
+    def __init__(self, matrix):
+        matrix = sparse.csc_matrix(matrix)
+        matrix.sum_duplicates()  # also sorts the rows of every term
+        self.n_docs, self.n_terms = matrix.shape
+        self.indptr = matrix.indptr
+        self.indices = matrix.indices
+
+    def postings(self, term):
+        return self.indices[self.indptr[term]:self.indptr[term + 1]]
+
+    def document_frequencies(self):
+        return np.diff(self.indptr)
+
+    def nbytes(self):
+        return self.indptr.nbytes + self.indices.nbytes
+
+    def gather(self, terms):
+        # Postings of all terms concatenated, without a Python loop over terms
+        terms = np.asarray(terms, dtype=np.int64)
+        starts, lengths = self.indptr[terms], np.diff(self.indptr)[terms]
+        offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+        return self.indices[np.arange(lengths.sum()) + offsets], lengths
+
+    def at_least(self, terms, m):
+        return self.at_least_many([terms], [m])[0]
+
+    def at_least_many(self, term_lists, thresholds):
+        term_lists = [np.unique(np.asarray(terms, dtype=np.int64)) for terms in term_lists]
+        rows, lengths = self.gather(np.concatenate(term_lists) if term_lists else np.array([], dtype=np.int64))
+        queries = np.repeat(np.repeat(np.arange(len(term_lists)), [len(terms) for terms in term_lists]), lengths)
+        keys, counts = np.unique(queries * self.n_docs + rows, return_counts=True)
+        keys = keys[counts >= np.asarray(thresholds, dtype=np.int64)[keys // self.n_docs]] if len(keys) else keys
+        bounds = np.searchsorted(keys, np.arange(len(term_lists) + 1) * self.n_docs)
+        # A threshold of zero or less is met by every document, matched or not
+        return [np.arange(self.n_docs) if m <= 0 else keys[bounds[i]:bounds[i + 1]] - i * self.n_docs
+                for i, m in enumerate(thresholds)]
+
+    def at_least_prefixes(self, ranked_terms, ks, thresholds):
+        # Matches of "at least thresholds[i] of the first ks[i] terms" for every i; unknown terms are -1 and only take up a rank
+        ranked_terms = np.asarray(ranked_terms, dtype=np.int64)[:max(ks, default=0)]
+        ranks = np.flatnonzero(ranked_terms >= 0)
+        rows, lengths = self.gather(ranked_terms[ranks])
+        ranks = np.repeat(ranks, lengths)
+        order = np.lexsort((ranks, rows))
+        rows, ranks = rows[order], ranks[order]
+        # Per document, the m-th smallest rank among its hits decides the first k at which it has m hits
+        docs, starts, counts = np.unique(rows, return_index=True, return_counts=True)
+        matches = []
+        for k, m in zip(ks, thresholds):
+            if m <= 0:
+                matches.append(np.arange(self.n_docs))
+            else:
+                hit = counts >= m
+                matches.append(docs[hit][ranks[starts[hit] + m - 1] < k])
+        return matches
@@ -0,0 +1,60 @@
+""" Cheap per-stage timing and memory accounting
+Component sizes are read from array nbytes and file sizes instead of walking object graphs. tracemalloc is only
+started when asked for, as tracing every allocation slows the traced stages down.
+"""
+
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+import numpy as np
+from scipy import sparse
+
+
+def nbytes(obj):
+    if obj is None:
+        return 0
+    if sparse.issparse(obj):
+        obj = obj.tocsr() if not hasattr(obj, 'indptr') else obj
+        return obj.data.nbytes + obj.indices.nbytes + obj.indptr.nbytes
+    if isinstance(obj, np.ndarray):
+        return obj.nbytes + (sum(sys.getsizeof(value) for value in obj.tolist()) if obj.dtype == object else 0)
+    if isinstance(obj, dict):
+        return sys.getsizeof(obj) + sum(sys.getsizeof(key) for key in obj)
+    return sys.getsizeof(obj)
+
+
+def directory_size(path):
+    return sum(os.path.getsize(os.path.join(root, file_name)) for root, _, file_names in os.walk(path) for file_name in file_names)
+
+
+class StageProfiler:
+    def __init__(self, trace_memory=False):
+        self.trace_memory = trace_memory
+        self.times = {}
+        self.memory = {}
+
+    @contextmanager
+    def stage(self, name):
+        started_tracing = self.trace_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+        memory_before = tracemalloc.get_traced_memory()[0] if self.trace_memory else 0
+        start_time = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] = self.times.get(name, 0) + time.perf_counter() - start_time
+            if self.trace_memory:
+                self.memory[name] = self.memory.get(name, 0) + tracemalloc.get_traced_memory()[0] - memory_before
+            if started_tracing:
+                tracemalloc.stop()
+
+    def report(self, sizes=None):
+        for name, elapsed_time in self.times.items():
+            memory = f", {self.memory[name] / (1024 ** 2):10.3f}mb allocated" if name in self.memory else ''
+            print(f'{name:>20}: {elapsed_time:10.3f}s{memory}')
+        for name, size in (sizes or {}).items():
+            print(f'{name:>20}: {size / (1024 ** 2):10.3f}mb')
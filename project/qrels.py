@@ -0,0 +1,129 @@
+""" Relevance judgements indexed by dense integer topic/doc ids
+Each topic keeps a CSR row of its judged docs (sorted) and their labels, 1 (relevant) or 0 (not relevant), so a
+ranking is labelled with one binary search and memory grows with the judgements, not topics x docs.
+"""
+
+from collections import OrderedDict, defaultdict
+
+import numpy as np
+
+UNJUDGED = -1
+QRELS_CACHE_SIZE = 8  # QrelsIndex objects kept by as_qrels, keyed on the identity of the dicts they were built from
+
+qrels_cache = OrderedDict()
+
+
+class QrelsIndex:
+    def __init__(self, judgements=()):
+        self.topic_ids, self.doc_ids = [], []
+        self.topic_positions, self.doc_positions = {}, {}
+        topics, docs, relevance = [], [], []
+        judged = defaultdict(list)
+        for q_id, doc_id, relevant in judgements:
+            topics.append(self._position(q_id, self.topic_ids, self.topic_positions))
+            docs.append(self._position(doc_id, self.doc_ids, self.doc_positions))
+            relevance.append(int(relevant))
+            judged[topics[-1], relevance[-1]].append(doc_id)
+        self.judged = dict(judged)
+        # Judgements are kept in input order, so the dict views match parse_qrels
+        self.topics = np.array(topics, dtype=np.int32)
+        self.docs = np.array(docs, dtype=np.int32)
+        self.relevance = np.array(relevance, dtype=np.int8)
+        # A doc judged both ways for a topic counts as relevant
+        n_docs = max(len(self.doc_ids), 1)
+        pairs, inverse = np.unique(self.topics.astype(np.int64) * n_docs + self.docs, return_inverse=True)
+        self.labels = np.full(len(pairs), UNJUDGED, dtype=np.int8)
+        np.maximum.at(self.labels, inverse.ravel(), self.relevance)
+        self.label_docs = (pairs % n_docs).astype(np.int32)
+        self.indptr = np.searchsorted(pairs // n_docs, np.arange(len(self.topic_ids) + 1))
+
+    @staticmethod
+    def _position(key, keys, positions):
+        if key not in positions:
+            positions[key] = len(keys)
+            keys.append(key)
+        return positions[key]
+
+    @classmethod
+    def from_topic_index(cls, topic_index, topic_index_n=None):
+        judgements = [(q_id, doc_id, 1) for q_id, doc_ids in topic_index.items() for doc_id in doc_ids]
+        judgements += [(q_id, doc_id, 0) for q_id, doc_ids in (topic_index_n or {}).items() for doc_id in doc_ids]
+        return cls(judgements)
+
+    def __len__(self):
+        return len(self.relevance)
+
+    def __iter__(self):
+        for q, doc, relevant in zip(self.topics.tolist(), self.docs.tolist(), self.relevance.tolist()):
+            yield self.topic_ids[q], self.doc_ids[doc], relevant
+
+    def merge(self, other):
+        return QrelsIndex(list(self) + list(other))
+
+    def _row(self, q):
+        start, end = self.indptr[q], self.indptr[q + 1]
+        return self.label_docs[start:end], self.labels[start:end]
+
+    def get_label(self, q_id, doc_id):
+        q, doc = self.topic_positions.get(q_id), self.doc_positions.get(doc_id)
+        if q is None or doc is None:
+            return UNJUDGED
+        row_docs, row_labels = self._row(q)
+        i = np.searchsorted(row_docs, doc)
+        return int(row_labels[i]) if i < len(row_docs) and row_docs[i] == doc else UNJUDGED
+
+    def is_relevant(self, q_id, doc_id):
+        return self.get_label(q_id, doc_id) == 1
+
+    def is_judged(self, q_id, doc_id):
+        return self.get_label(q_id, doc_id) != UNJUDGED
+
+    def label(self, q_id, doc_ids):
+        doc_ids = list(doc_ids)
+        q = self.topic_positions.get(q_id)
+        if q is None:
+            return np.full(len(doc_ids), UNJUDGED, dtype=np.int8)
+        docs = np.fromiter((self.doc_positions.get(doc_id, -1) for doc_id in doc_ids), dtype=np.int64, count=len(doc_ids))
+        row_docs, row_labels = self._row(q)
+        if not len(row_docs):
+            return np.full(len(doc_ids), UNJUDGED, dtype=np.int8)
+        i = np.minimum(np.searchsorted(row_docs, docs), len(row_docs) - 1)
+        return np.where(row_docs[i] == docs, row_labels[i], UNJUDGED).astype(np.int8)
+
+    def positives(self, q_id):
+        return self._judged(q_id, 1)
+
+    def negatives(self, q_id):
+        return self._judged(q_id, 0)
+
+    def _judged(self, q_id, relevant):
+        return list(self.judged.get((self.topic_positions.get(q_id), relevant), ()))
+
+    def to_dicts(self):
+        topic_index, doc_index, topic_index_n, doc_index_n = defaultdict(list), defaultdict(list), defaultdict(
+            list), defaultdict(list)
+        for q_id, doc_id, relevant in self:
+            if relevant:
+                topic_index[q_id].append(doc_id)
+                doc_index[doc_id].append(q_id)
+            else:
+                topic_index_n[q_id].append(doc_id)
+                doc_index_n[doc_id].append(q_id)
+        return dict(topic_index), dict(doc_index), dict(topic_index_n), dict(doc_index_n)
+
+
+def as_qrels(topic_index, topic_index_n=None):
+    if isinstance(topic_index, QrelsIndex):
+        return topic_index
+    if topic_index_n is None:
+        topic_index, topic_index_n = topic_index['p'], topic_index['n']
+    # The dicts are held by the cache, so their ids cannot be reused while the entry lives
+    key = (id(topic_index), id(topic_index_n))
+    if key in qrels_cache:
+        qrels_cache.move_to_end(key)
+        return qrels_cache[key][-1]
+    qrels = QrelsIndex.from_topic_index(topic_index, topic_index_n)
+    qrels_cache[key] = (topic_index, topic_index_n, qrels)
+    if len(qrels_cache) > QRELS_CACHE_SIZE:
+        qrels_cache.popitem(last=False)
+    return qrels
@@ -0,0 +1,99 @@
+""" Query result cache in front of InvertedIndex.search_index
+Results are keyed by (index generation, scoring name, k, normalised query string):
+    - a bounded in-memory LRU tier
+    - an optional persistent tier, one shelve per scoring under query_cache/<index>/, so concurrent rankings with
+      different scorings never write to the same file
+The generation is a random token written next to the Whoosh index every time it is built; entries of an older
+build carry an older token in their key and are never served again.
+"""
+
+import json
+import os
+import shelve
+import uuid
+from collections import OrderedDict
+
+QUERY_CACHE_SIZE = 4096
+QUERY_CACHE_PATH = 'query_cache'
+GENERATION_FILE = 'GENERATION'
+
+
+def write_generation(whoosh_dir):
+    generation = uuid.uuid4().hex
+    with open(f'{whoosh_dir}/{GENERATION_FILE}', 'w') as f:
+        f.write(generation)
+    return generation
+
+
+def read_generation(whoosh_dir):
+    # Indexes built before generations existed get one on first read
+    path = f'{whoosh_dir}/{GENERATION_FILE}'
+    if not os.path.isfile(path):
+        return write_generation(whoosh_dir)
+    with open(path) as f:
+        return f.read().strip()
+
+
+def normalise_query(string):
+    return ' '.join(string.split())
+
+
+class QueryCache:
+    def __init__(self, size=QUERY_CACHE_SIZE, path=None):
+        self.size = size
+        self.path = path
+        self.entries = OrderedDict()
+        self.shelves = {}
+        self.hits = self.disk_hits = self.misses = 0
+
+    @staticmethod
+    def key(string, scoring, generation, k):
+        return f'{generation}\0{scoring}\0{k}\0{normalise_query(string)}'
+
+    def shelf(self, scoring):
+        if self.path is None:
+            return None
+        if scoring not in self.shelves:
+            os.makedirs(self.path, exist_ok=True)
+            self.shelves[scoring] = shelve.open(f'{self.path}/{scoring}')
+        return self.shelves[scoring]
+
+    def get(self, key, scoring):
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            return self.entries[key]
+        shelf = self.shelf(scoring)
+        if shelf is not None and key in shelf:
+            self.disk_hits += 1
+            self.remember(key, shelf[key])
+            return self.entries[key]
+        self.misses += 1
+        return None
+
+    def put(self, key, scoring, results):
+        self.remember(key, results)
+        shelf = self.shelf(scoring)
+        if shelf is not None:
+            shelf[key] = results
+
+    def remember(self, key, results):
+        self.entries[key] = results
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.size:
+            self.entries.popitem(last=False)
+
+    def stats(self):
+        lookups = self.hits + self.disk_hits + self.misses
+        return {'hits': self.hits, 'disk hits': self.disk_hits, 'misses': self.misses,
+                'hit rate': (self.hits + self.disk_hits) / lookups if lookups else 0, 'entries': len(self.entries)}
+
+    def export_stats(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.stats(), f, indent=2)
+
+    def close(self):
+        # Flushes the persistent tier; shelves are reopened on the next lookup
+        for shelf in self.shelves.values():
+            shelf.close()
+        self.shelves = {}
@@ -0,0 +1,222 @@
+""" Columnar binary run files for ranking/retrieval/classification results
+A run {q_id: {field: value}} is saved as one .npz holding:
+    meta                    json with the topic ids and the kind of every field
+    doc_ids                 per-file doc id table, every document field stores int positions into it
+    <field>.present         (n_topics) whether the topic has the field
+    <field>.offsets         (n_topics + 1) start of every topic in the field's concatenated arrays
+    <field>.ids/.values     the field's doc positions and/or numbers, all topics one after the other
+Field kinds: ids (doc id list), set (doc id set), map (doc id -> number dict), values (number list), scalar, and
+the derived orders (visited_documents_orders) and assessed ({doc_id: (rank, label)}), which are rebuilt from
+visited_documents on load instead of being stored. Topics are decoded on first access; the file is released once
+every topic has been decoded, or on close(). A pickled run is reopened from its path; a deep copy is a plain dict of
+the decoded topics. export_trec_run writes a run as TREC run lines, for trec_eval.
+"""
+
+import json
+import os
+from collections.abc import MutableMapping
+from copy import deepcopy
+
+import numpy as np
+
+from docids import DocIdMap
+
+RUN_SUFFIX = '.npz'
+TREC_RUN_SUFFIX = '.trec'
+ORDERS_FIELD = 'visited_documents_orders'
+VISITED_FIELD = 'visited_documents'
+
+
+def field_kind(field, value):
+    # None when the value (e.g. an empty container) does not tell the kind apart
+    if field == ORDERS_FIELD:
+        return 'orders'
+    if isinstance(value, (set, frozenset)):
+        return 'set'
+    if isinstance(value, dict):
+        if not value:
+            return None
+        return 'assessed' if isinstance(next(iter(value.values())), tuple) else 'map'
+    if isinstance(value, (list, tuple, np.ndarray)):
+        if not len(value):
+            return None
+        return 'ids' if isinstance(value[0], str) else 'values'
+    return 'scalar'
+
+
+def run_fields(results):
+    fields = {}
+    for result in results.values():
+        for field, value in result.items():
+            if fields.get(field) is None:
+                fields[field] = field_kind(field, value)
+    empty_kinds = {dict: 'map', set: 'set', frozenset: 'set'}
+    for field, kind in fields.items():
+        if kind is None:  # empty in every topic
+            value = next(result[field] for result in results.values() if field in result)
+            fields[field] = empty_kinds.get(type(value), 'ids')
+    return fields
+
+
+def run_exists(path):
+    return os.path.isfile(path)
+
+
+def save_run(path, results):
+    topics, fields = list(results), run_fields(results)
+    doc_id_map = DocIdMap()
+    arrays = {}
+    for field, kind in fields.items():
+        present = np.array([field in results[q_id] for q_id in topics], dtype=bool)
+        arrays[f'{field}.present'] = present
+        if kind == 'orders':
+            continue
+        values = [results[q_id][field] if field in results[q_id] else None for q_id in topics]
+        if kind == 'scalar':
+            arrays[f'{field}.values'] = np.array([value if value is not None else 0 for value in values])
+            continue
+        lengths = [len(value) if value is not None else 0 for value in values]
+        arrays[f'{field}.offsets'] = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        values = [value for value in values if value is not None]
+        if kind in ('ids', 'set', 'map', 'assessed'):
+            doc_ids = [doc_id for value in values for doc_id in value]
+            doc_id_map.add(doc_ids)
+            arrays[f'{field}.ids'] = doc_id_map.encode(doc_ids)
+        if kind == 'map':
+            arrays[f'{field}.values'] = np.array([number for value in values for number in value.values()])
+        elif kind == 'assessed':  # only the labels are kept, ranks come from visited_documents
+            arrays[f'{field}.values'] = np.array([label for value in values for _, label in value.values()], dtype=np.int8)
+        elif kind == 'values':
+            arrays[f'{field}.values'] = np.array([number for value in values for number in value])
+    arrays['doc_ids'] = np.array(doc_id_map.doc_ids, dtype=str)
+    arrays['meta'] = np.array(json.dumps({'topics': topics, 'fields': fields}))
+    with open(path, 'wb') as f:
+        np.savez(f, **arrays)
+
+
+class RunFile(MutableMapping):
+    def __init__(self, path):
+        self.path = path
+        self.npz = np.load(path)
+        meta = json.loads(str(self.npz['meta']))
+        self.topics, self.fields = meta['topics'], meta['fields']
+        self.positions = {q_id: i for i, q_id in enumerate(self.topics)}  # q_id -> stored topic row
+        self._doc_ids, self._columns, self._results = None, {}, {}
+        self._undecoded = set(self.positions)  # stored topics still to be read; the file is closed once there are none
+        if not self._undecoded:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        # Topics decoded so far stay available
+        self.npz.close()
+
+    def __reduce__(self):
+        # The open npz can not be pickled: the file is reopened by path and the topics decoded or set so far travel as they are
+        return reopen_run, (self.path, list(self.topics), self._results)
+
+    def __deepcopy__(self, memo):
+        return deepcopy(dict(self), memo)
+
+    def column(self, name):
+        if name not in self._columns:
+            self._columns[name] = self.npz[name]
+        return self._columns[name]
+
+    @property
+    def doc_ids(self):
+        if self._doc_ids is None:
+            self._doc_ids = self.npz['doc_ids'].tolist()
+        return self._doc_ids
+
+    def decode_field(self, field, kind, i):
+        if kind == 'scalar':
+            return self.column(f'{field}.values')[i].item()
+        start, end = self.column(f'{field}.offsets')[i:i + 2]
+        if kind == 'values':
+            return self.column(f'{field}.values')[start:end].tolist()
+        doc_ids = [self.doc_ids[position] for position in self.column(f'{field}.ids')[start:end].tolist()]
+        if kind == 'ids':
+            return doc_ids
+        if kind == 'set':
+            return set(doc_ids)
+        return dict(zip(doc_ids, self.column(f'{field}.values')[start:end].tolist()))
+
+    def decode_topic(self, i):
+        result, derived = {}, {}
+        for field, kind in self.fields.items():
+            if self.column(f'{field}.present')[i]:
+                if kind in ('orders', 'assessed'):
+                    derived[field] = kind
+                result[field] = self.decode_field(field, kind, i) if kind != 'orders' else None
+        orders = {doc_id: rank + 1 for rank, doc_id in enumerate(result.get(VISITED_FIELD, []))}
+        for field, kind in derived.items():
+            if kind == 'orders':
+                result[field] = orders
+            else:
+                result[field] = {doc_id: (orders.get(doc_id), label) for doc_id, label in result[field].items()}
+        return result
+
+    def __getitem__(self, q_id):
+        if q_id not in self._results:
+            if q_id not in self.positions:
+                raise KeyError(q_id)
+            self._results[q_id] = self.decode_topic(self.positions[q_id])
+            self._decoded(q_id)
+        return self._results[q_id]
+
+    def __setitem__(self, q_id, result):
+        if q_id not in self._results and q_id not in self.positions:
+            self.topics.append(q_id)
+        self._results[q_id] = result
+        self._decoded(q_id)
+
+    def __delitem__(self, q_id):
+        if q_id not in self._results and q_id not in self.positions:
+            raise KeyError(q_id)
+        self.topics.remove(q_id)
+        self.positions.pop(q_id, None)
+        self._results.pop(q_id, None)
+        self._decoded(q_id)
+
+    def _decoded(self, q_id):
+        if q_id in self._undecoded:
+            self._undecoded.discard(q_id)
+            if not self._undecoded:
+                self.close()
+
+    def __iter__(self):
+        return iter(list(self.topics))
+
+    def __len__(self):
+        return len(self.topics)
+
+
+def load_run(path):
+    return RunFile(path)
+
+
+def reopen_run(path, topics, results):
+    run = RunFile(path)
+    for q_id in [q_id for q_id in run.topics if q_id not in topics]:
+        del run[q_id]
+    run.topics = list(topics)
+    for q_id, result in results.items():
+        run._results[q_id] = result
+        run._decoded(q_id)
+    return run
+
+
+def export_trec_run(results, path, run_name='run', score_field='visited_scores'):
+    # One "q_id Q0 doc_id rank score run_name" line per retrieved document; ranks stand in for missing scores
+    with open(path, 'w') as f:
+        for q_id, result in results.items():
+            visited_documents = result.get(VISITED_FIELD, [])
+            scores = result.get(score_field) or [len(visited_documents) - rank for rank in range(len(visited_documents))]
+            for rank, (doc_id, score) in enumerate(zip(visited_documents, scores)):
+                f.write(f"{q_id} Q0 {doc_id} {rank + 1} {score} {run_name}\n")
@@ -0,0 +1,146 @@
+""" Minimal stage DAG scheduler
+A stage is a function of the values of its input stages, optionally checkpointed to output files:
+    - a stage with outputs is up to date when all of them exist and none is older than the outputs of its inputs;
+      up to date stages are skipped and their value is read back with their loader when a later stage needs it
+    - a stage without outputs runs only when a stage that consumes it runs (or when it is a target)
+Local stages run in this process and keep their value in memory. The other stages run in a freshly forked process
+each, so they inherit every value computed so far without pickling; only their return value travels back.
+"""
+
+import os
+import time
+import traceback
+from multiprocessing import get_context
+from multiprocessing.connection import wait
+
+SCHEDULER_WORKERS = 1
+
+
+class Stage:
+    def __init__(self, name, function, inputs=(), outputs=(), loader=None, local=False):
+        self.name = name
+        self.function = function
+        self.inputs = tuple(inputs)
+        self.outputs = tuple(outputs)
+        self.loader = loader
+        self.local = local
+
+    def outputs_times(self):
+        # Oldest and newest output modification times, None when an output is missing
+        if not all(os.path.exists(output) for output in self.outputs):
+            return None
+        times = [os.path.getmtime(output) for output in self.outputs]
+        return min(times), max(times)
+
+
+class Scheduler:
+    def __init__(self, workers=SCHEDULER_WORKERS):
+        self.workers = workers
+        self.stages = {}
+        self.values = {}
+
+    def add(self, name, function, inputs=(), outputs=(), loader=None, local=False):
+        missing = [input_name for input_name in inputs if input_name not in self.stages]
+        if missing:
+            raise ValueError(f"Stage {name} depends on unknown stages {missing}")
+        self.stages[name] = Stage(name, function, inputs, outputs, loader, local)
+        return name
+
+    def plan(self, targets=()):
+        # Stages are added after their inputs, so insertion order is a topological order. A stage without outputs
+        # passes on the newest upstream output and whether anything upstream is updated
+        updates, newest = {}, {}
+        for stage in self.stages.values():
+            upstream_update = any(updates[name] for name in stage.inputs)
+            upstream_time = max((newest[name] for name in stage.inputs), default=0)
+            if stage.outputs:
+                times = stage.outputs_times()
+                updates[stage.name] = times is None or upstream_update or upstream_time > times[0]
+                newest[stage.name] = times[1] if times is not None else 0
+            else:
+                updates[stage.name], newest[stage.name] = upstream_update, upstream_time
+        dependents = {name: [] for name in self.stages}
+        for stage in self.stages.values():
+            for name in stage.inputs:
+                dependents[name].append(stage.name)
+        runs = {}
+        for stage in reversed(list(self.stages.values())):
+            consumed = any(runs[name] for name in dependents[stage.name])
+            if stage.outputs:
+                runs[stage.name] = updates[stage.name]
+            else:
+                runs[stage.name] = consumed or stage.name in targets or not dependents[stage.name]
+        return runs
+
+    def value(self, name):
+        # Values of stages that were skipped or only wrote their outputs are loaded on first use
+        if name not in self.values:
+            stage = self.stages[name]
+            self.values[name] = stage.loader(*stage.outputs) if stage.loader else None
+        return self.values[name]
+
+    def run(self, targets=()):
+        runs = self.plan(targets)
+        for name in self.stages:
+            if not runs[name] and self.stages[name].outputs:
+                print(f"Stage \"{name}\" is up to date")
+        pending = [name for name in self.stages if runs[name]]
+        running, done = {}, {name for name in self.stages if not runs[name]}
+        context = get_context('fork')
+        start_time = time.time()
+        while pending or running:
+            ready = [name for name in pending if all(input_name in done for input_name in self.stages[name].inputs)]
+            for name in ready:
+                stage = self.stages[name]
+                if not stage.local and self.workers > 1 and len(running) >= self.workers:
+                    continue
+                pending.remove(name)
+                print(f"Running stage \"{name}\"...")
+                if stage.local or self.workers <= 1:
+                    self.store(name, stage.function(*[self.value(input_name) for input_name in stage.inputs]))
+                    done.add(name)
+                else:
+                    receiver, sender = context.Pipe(duplex=False)
+                    process = context.Process(target=run_stage, args=(self, name, sender))
+                    process.start()
+                    sender.close()
+                    running[name] = (process, receiver)
+            if running and not any(name in done for name in ready):
+                self.collect(running, done)
+            elif not ready and not running and pending:
+                raise RuntimeError(f"Stages {pending} can not run, their inputs never finish")
+        print(f"Ran {sum(runs.values())} of {len(self.stages)} stages in {time.time() - start_time:.2f}s")
+        for name in targets:
+            self.value(name)
+        return self.values
+
+    def collect(self, running, done):
+        # Waits for at least one forked stage to finish
+        ready = wait([receiver for _, receiver in running.values()])
+        for name, (process, receiver) in list(running.items()):
+            if receiver in ready:
+                status, value = receiver.recv()
+                process.join()
+                del running[name]
+                if status == 'error':
+                    raise RuntimeError(f"Stage \"{name}\" failed:\n{value}")
+                self.store(name, value)
+                done.add(name)
+
+    def store(self, name, value):
+        # A stage that only wrote its outputs is read back from them when its value is needed
+        stage = self.stages[name]
+        self.values.pop(name, None)
+        if value is not None or not (stage.outputs and stage.loader):
+            self.values[name] = value
+
+
+def run_stage(scheduler, name, sender):
+    # Inputs read from outputs are loaded here, so forked stages never share an open file with the parent
+    try:
+        stage = scheduler.stages[name]
+        sender.send(('ok', stage.function(*[scheduler.value(input_name) for input_name in stage.inputs])))
+    except Exception:
+        sender.send(('error', traceback.format_exc()))
+    finally:
+        sender.close()
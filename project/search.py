@@ -0,0 +1,81 @@
+""" Long-lived Whoosh search session
+The index is opened and the query parser built once; every thread keeps its own searcher (and readers) open
+until the session is closed. Batches of queries run on a thread pool, or on a process pool where every worker
+opens its own session; either pool lives as long as the session.
+"""
+
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import Pool
+
+from whoosh import index
+from whoosh.qparser import MultifieldParser, OrGroup, PhrasePlugin
+
+SEARCH_WORKERS = 1
+SEARCH_POOL = 'thread'  # 'thread' or 'process'
+SEARCH_CHUNK_SIZE = 8
+
+worker_session = None
+
+
+class SearchSession:
+    def __init__(self, whoosh_dir, fields, scoring, workers=SEARCH_WORKERS, pool=SEARCH_POOL):
+        self.whoosh_dir = whoosh_dir
+        self.fields = fields
+        self.scoring = scoring
+        self.workers = workers
+        self.pool_type = pool
+        self.pool = None
+        self.ix = index.open_dir(whoosh_dir)
+        self.parser = MultifieldParser(fields, self.ix.schema, group=OrGroup)
+        self.parser.remove_plugin_class(PhrasePlugin)
+        self.local = threading.local()
+        self.searchers = []
+        self.lock = threading.Lock()
+
+    def searcher(self):
+        if getattr(self.local, 'searcher', None) is None:
+            self.local.searcher = self.ix.searcher(weighting=self.scoring)
+            with self.lock:
+                self.searchers.append(self.local.searcher)
+        return self.local.searcher
+
+    def search(self, string, k=10):
+        results = self.searcher().search(self.parser.parse(string), limit=k)
+        return [(r['id'], r.score) for r in results]
+
+    def search_many(self, strings, k=10):
+        strings = list(strings)
+        if self.workers <= 1 or len(strings) <= 1:
+            return [self.search(string, k) for string in strings]
+        if self.pool_type == 'process':
+            if self.pool is None:
+                self.pool = Pool(self.workers, initializer=init_search_worker, initargs=(self.whoosh_dir, self.fields, self.scoring))
+            return self.pool.map(search_worker, [(string, k) for string in strings], chunksize=SEARCH_CHUNK_SIZE)
+        if self.pool is None:
+            self.pool = ThreadPoolExecutor(self.workers)
+        return list(self.pool.map(lambda string: self.search(string, k), strings))
+
+    def close(self):
+        if self.pool is not None:
+            if self.pool_type == 'process':
+                self.pool.close()
+                self.pool.join()
+            else:
+                self.pool.shutdown()
+            self.pool = None
+        with self.lock:
+            for searcher in self.searchers:
+                searcher.close()
+            self.searchers = []
+        self.local = threading.local()
+
+
+def init_search_worker(whoosh_dir, fields, scoring):
+    global worker_session
+    worker_session = SearchSession(whoosh_dir, fields, scoring)
+
+
+def search_worker(args):
+    string, k = args
+    return worker_session.search(string, k)
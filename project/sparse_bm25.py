@@ -0,0 +1,188 @@
+""" In-memory BM25 ranking over a (docs x terms) CSR count matrix
+Every stored (doc, term) count is turned into its BM25 impact once, with Whoosh's BM25 formula over the whole
+document, so a batch of topics is scored with a single sparse product and only the matching documents are ranked.
+
+With pruning, topics are ranked one by one over blocks of PRUNING_BLOCK_SIZE documents. Every term keeps the largest
+impact of its postings in each block, so a topic bounds every block by its query weights x those maxima. Blocks are
+scored by decreasing bound, reading only the query terms' postings in them, until no block left can reach the p-th
+score so far: the postings of the remaining blocks are never read. Postings are summed in term order, as the sparse
+product sums them, so rankings and scores are identical to the exhaustive ones.
+"""
+
+import numpy as np
+from scipy import sparse
+
+BLOCK_MAX_PRUNING = False  # rank topic by topic over block-max bounds instead of one sparse product
+PRUNING_BLOCK_SIZE = 64  # documents per block; smaller blocks give tighter bounds, but more of them
+PRUNING_SAFETY = 1e-9  # relative slack on the bounds, covers rounding from summing them in another order
+
+
+def bm25_statistics(counts):
+    counts = sparse.csr_matrix(counts, dtype=np.float64)
+    doc_lengths = np.asarray(counts.sum(axis=1)).ravel()
+    avg_doc_length = doc_lengths.mean() if counts.shape[0] else 0
+    df = np.bincount(counts.indices, minlength=counts.shape[1])
+    idf = np.log(counts.shape[0] / (df + 1)) + 1
+    return counts, doc_lengths, avg_doc_length, idf
+
+
+def bm25_impacts(counts, doc_lengths, avg_doc_length, idf, K1, B):
+    tf = counts.data
+    norms = K1 * ((1 - B) + B * doc_lengths / max(avg_doc_length, 1e-9))
+    impacts = counts.copy()
+    # Same operation order as whoosh.scoring.bm25, so impacts are bit-identical to Whoosh's per-posting scores
+    impacts.data = idf[counts.indices] * ((tf * (K1 + 1)) / (tf + np.repeat(norms, np.diff(counts.indptr))))
+    return impacts
+
+
+def top_p(scores, p):
+    rankings = []
+    for i in range(scores.shape[0]):
+        start, end = scores.indptr[i], scores.indptr[i + 1]
+        rankings.append(cut_top_p(scores.indices[start:end], scores.data[start:end], p))
+    return rankings
+
+
+def cut_top_p(docs, doc_scores, p):
+    if p <= 0:
+        return docs[:0], doc_scores[:0]
+    if len(doc_scores) > p:
+        top = np.argpartition(-doc_scores, p - 1)[:p]
+        # Keep every document tied with the p-th score, so the cut does not depend on argpartition
+        top = np.flatnonzero(doc_scores >= doc_scores[top].min())
+        docs, doc_scores = docs[top], doc_scores[top]
+    # Ties are broken by document order, as Whoosh does
+    order = np.lexsort((docs, -doc_scores))[:p]
+    return docs[order], doc_scores[order]
+
+
+def block_maxima(impacts, block_size):
+    # impacts: (terms x docs) CSR with sorted indices, so the postings of a term in a block are one run. Returns the
+    # (terms x blocks) largest impacts, with the start and length of the run behind every stored entry
+    n_blocks = -(-impacts.shape[1] // block_size)
+    terms = np.repeat(np.arange(impacts.shape[0], dtype=np.int64), np.diff(impacts.indptr))
+    keys = terms * n_blocks + impacts.indices // block_size
+    starts = np.flatnonzero(np.diff(keys, prepend=-1))
+    lengths = np.diff(np.append(starts, len(keys)))
+    maxima = np.maximum.reduceat(impacts.data, starts) if len(starts) else np.array([])
+    indptr = np.searchsorted(terms[starts], np.arange(impacts.shape[0] + 1))
+    return sparse.csr_matrix((maxima, keys[starts] % n_blocks, indptr), shape=(impacts.shape[0], n_blocks)), starts, lengths
+
+
+def concatenated_ranges(starts, lengths):
+    # np.concatenate([np.arange(start, start + length) for ...]) without the loop
+    return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(lengths.sum())
+
+
+def p_th_score(doc_scores, p):
+    return np.partition(doc_scores, len(doc_scores) - p)[len(doc_scores) - p] if len(doc_scores) >= p > 0 else -np.inf
+
+
+def reaches(bounds, threshold):
+    return bounds * (1 + PRUNING_SAFETY) >= threshold
+
+
+def block_max_top_p(impacts, block_max, run_starts, run_lengths, block_size, terms, weights, block_bounds, p, accumulator):
+    # One topic: terms/weights are its canonical query row, block_bounds its bound on every block and accumulator a
+    # zeroed buffer over the documents, left zeroed
+    term_entries = np.diff(block_max.indptr)[terms]
+    entries = concatenated_ranges(block_max.indptr[terms], term_entries)
+    entry_weights, entry_blocks = np.repeat(weights, term_entries), block_max.indices[entries]
+    by_bound = np.argsort(-block_bounds, kind='stable')
+    by_bound = by_bound[block_bounds[by_bound] > 0]
+    selected = np.zeros(len(block_bounds), dtype=bool)
+    docs, doc_scores = [], []
+    threshold, n_scored, batch, scored = -np.inf, 0, max(1, -(-p // block_size)), 0
+    while p > 0 and n_scored < len(by_bound) and reaches(block_bounds[by_bound[n_scored]], threshold):
+        # Blocks are scored in growing batches, the threshold rising between them
+        blocks = by_bound[n_scored:n_scored + batch]
+        blocks = blocks[reaches(block_bounds[blocks], threshold)]
+        selected[blocks] = True
+        round_entries = np.flatnonzero(selected[entry_blocks])
+        selected[blocks] = False
+        lengths = run_lengths[entries[round_entries]]
+        postings = concatenated_ranges(run_starts[entries[round_entries]], lengths)
+        # Entries go term by term, so every document sums its impacts in term order
+        np.add.at(accumulator, impacts.indices[postings], np.repeat(entry_weights[round_entries], lengths) * impacts.data[postings])
+        # Impacts are positive, so the documents reached are the ones with a score in the blocks
+        round_docs = (blocks[:, None] * block_size + np.arange(block_size)).ravel()
+        round_docs = round_docs[round_docs < len(accumulator)]
+        round_docs = round_docs[accumulator[round_docs] > 0]
+        docs.append(round_docs)
+        doc_scores.append(accumulator[round_docs])
+        accumulator[round_docs] = 0
+        threshold = max(threshold, p_th_score(np.concatenate(doc_scores), p))
+        n_scored, batch, scored = n_scored + len(blocks), batch * 2, scored + len(postings)
+    docs, doc_scores = cut_top_p(np.concatenate(docs) if docs else np.array([], dtype=impacts.indices.dtype),
+                                 np.concatenate(doc_scores) if doc_scores else np.array([]), p)
+    postings = int(np.diff(impacts.indptr)[terms].sum())
+    return docs, doc_scores, {'postings': postings, 'scored': scored, 'skipped': postings - scored}
+
+
+def pruning_report(pruning_stats):
+    postings = sum(stats['postings'] for stats in pruning_stats)
+    skipped = sum(stats['skipped'] for stats in pruning_stats)
+    return (f"{len(pruning_stats)} topics, {postings - skipped} of {postings} postings scored, "
+            f"{skipped} skipped ({skipped / postings if postings else 0:.2%})")
+
+
+class NamedSparseBM25:
+    def __init__(self, K1=1.2, B=0.75, pruning=BLOCK_MAX_PRUNING, block_size=PRUNING_BLOCK_SIZE):
+        self.K1 = K1
+        self.B = B
+        self.pruning = pruning
+        self.block_size = block_size
+        self.name = f"SPARSE_BM25_k1_{self.K1:.2f}_b_{self.B:.2f}".replace('.', ',')
+        self.impacts = None
+        self.blocks = None  # block maxima, run starts and run lengths, with pruning
+        self.pruning_stats = []  # postings, scored and skipped counts of every topic of the last pruned ranking
+        self._fitted_matrix = None  # the count matrix the impacts were built from, kept so identity stays meaningful
+
+    def __str__(self):
+        return self.name
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['impacts'], state['blocks'], state['_fitted_matrix'] = None, None, None  # rebuilt from the count matrix on demand
+        return state
+
+    def __setstate__(self, state):
+        # Scorings pickled before pruning rank exhaustively
+        self.__dict__.update({'pruning': False, 'block_size': PRUNING_BLOCK_SIZE, 'blocks': None, 'pruning_stats': [], **state})
+
+    def fit(self, count_matrix):
+        if self._fitted_matrix is count_matrix and (self.blocks is not None) == bool(self.pruning):
+            return self
+        impacts = bm25_impacts(*bm25_statistics(count_matrix), self.K1, self.B)
+        self.impacts = impacts.T.tocsr()  # terms x docs
+        self.impacts.sort_indices()
+        self.blocks = block_maxima(self.impacts, self.block_size) if self.pruning else None
+        self._fitted_matrix = count_matrix
+        return self
+
+    def score(self, query_matrix):
+        return canonical_queries(query_matrix) @ self.impacts  # topics x docs
+
+    def rank(self, query_matrix, p):
+        if not self.pruning:
+            return top_p(self.score(query_matrix), p)
+        query_matrix = canonical_queries(query_matrix)
+        block_max, run_starts, run_lengths = self.blocks
+        block_bounds = (query_matrix @ block_max).toarray()
+        accumulator = np.zeros(self.impacts.shape[1])
+        rankings, self.pruning_stats = [], []
+        for i in range(query_matrix.shape[0]):
+            start, end = query_matrix.indptr[i], query_matrix.indptr[i + 1]
+            docs, doc_scores, stats = block_max_top_p(self.impacts, block_max, run_starts, run_lengths, self.block_size,
+                                                      query_matrix.indices[start:end], query_matrix.data[start:end],
+                                                      block_bounds[i], p, accumulator)
+            rankings.append((docs, doc_scores))
+            self.pruning_stats.append(stats)
+        return rankings
+
+
+def canonical_queries(query_matrix):
+    # Duplicate terms summed and terms sorted, so both paths sum the impacts of a document in the same order
+    query_matrix = sparse.csr_matrix(query_matrix, dtype=np.float64, copy=True)
+    query_matrix.sum_duplicates()
+    return query_matrix
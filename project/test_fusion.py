@@ -0,0 +1,72 @@
+""" Brute-force tests of rank fusion against a per-document Python loop """
+
+import numpy as np
+import pytest
+
+from fusion import FUSION_METHODS, fuse, fuse_topics, normalise_scores
+
+
+def brute_fuse(doc_runs, score_runs, method, k, weights, p):
+    scores, hits, first = {}, {}, {}
+    for run, docs in enumerate(doc_runs):
+        weight = 1 if weights is None else weights[run]
+        run_scores = normalise_scores(score_runs[run]) if method != 'rrf' else None
+        for rank, doc in enumerate(docs):
+            contribution = 1 / (k + rank + 1) if method == 'rrf' else run_scores[rank]
+            scores[doc] = scores.get(doc, 0) + weight * contribution
+            hits[doc] = hits.get(doc, 0) + 1
+            first.setdefault(doc, len(first))
+    if method == 'combmnz':
+        scores = {doc: score * hits[doc] for doc, score in scores.items()}
+    ranking = sorted(scores, key=lambda doc: (-scores[doc], first[doc]))[:p]
+    return ranking, [scores[doc] for doc in ranking]
+
+
+def random_runs(rng, n_runs):
+    doc_runs = [rng.permutation(30)[:rng.integers(0, 20)] for _ in range(n_runs)]
+    # Rounded scores, so there are ties
+    score_runs = [np.sort(rng.integers(0, 5, len(docs)))[::-1].astype(float) for docs in doc_runs]
+    return doc_runs, score_runs
+
+
+@pytest.mark.parametrize('method', FUSION_METHODS)
+def test_fuse(method):
+    rng = np.random.default_rng(0)
+    for _ in range(100):
+        doc_runs, score_runs = random_runs(rng, int(rng.integers(1, 5)))
+        weights = rng.uniform(0.5, 2, len(doc_runs)) if rng.random() < 0.5 else None
+        p = None if rng.random() < 0.3 else int(rng.integers(0, 25))
+        k = int(rng.integers(1, 60))
+        docs, scores = fuse(doc_runs, score_runs, method, k, weights, p)
+        expected_docs, expected_scores = brute_fuse(doc_runs, score_runs, method, k, weights, p)
+        assert docs.tolist() == expected_docs
+        assert np.allclose(scores, expected_scores)
+
+
+def test_ties_keep_first_occurrence():
+    docs, scores = fuse([[3, 1], [1, 3], [7]], p=2)
+    assert docs.tolist() == [3, 1] and scores[0] == scores[1]
+    docs, _ = fuse([[5], [4], [6]], [[1.0], [1.0], [1.0]], 'combsum', p=2)
+    assert docs.tolist() == [5, 4]
+
+
+def test_empty_and_errors():
+    docs, scores = fuse([[], []])
+    assert not len(docs) and not len(scores)
+    assert not len(fuse([[1, 2]], p=0)[0])
+    assert not len(normalise_scores([]))
+    assert normalise_scores([2, 2]).tolist() == [1, 1]
+    with pytest.raises(ValueError):
+        fuse([[1]], method='borda')
+    with pytest.raises(ValueError):
+        fuse([[1]], method='combsum')
+
+
+def test_fuse_topics():
+    topic_doc_runs = {'R1': [[1, 2], [2, 3]], 'R2': [[4], [5, 4]]}
+    topic_score_runs = {'R1': [[2.0, 1.0], [3.0, 0.0]], 'R2': [[1.0], [2.0, 1.0]]}
+    fused = fuse_topics(topic_doc_runs, topic_score_runs, 'combmnz', p={'R1': 1, 'R2': 5})
+    for q_id, (docs, scores) in fused.items():
+        expected = fuse(topic_doc_runs[q_id], topic_score_runs[q_id], 'combmnz', p={'R1': 1, 'R2': 5}[q_id])
+        assert docs.tolist() == expected[0].tolist() and scores.tolist() == expected[1].tolist()
+    assert fused['R1'][0].tolist() == [2]
@@ -0,0 +1,83 @@
+""" Tests of the shared normalisation cache: memoisation, bounds, worker merges and persistence """
+
+import pickle
+from multiprocessing import get_context
+
+import pytest
+
+import normcache
+from normcache import (NormalisationCache, drain_normalisation_caches, merge_normalisation_caches,
+                       normalisation_cache, save_normalisation_caches)
+
+WORDS = ['Running', 'runs', 'Running', 'ran', 'runs', 'Running']
+
+
+@pytest.fixture(autouse=True)
+def registry(monkeypatch):
+    monkeypatch.setattr(normcache, 'normalisation_caches', {})
+
+
+def test_memoises():
+    calls = []
+    cache = NormalisationCache('lower', lambda text: calls.append(text) or text.lower())
+    assert [cache(word) for word in WORDS] == [word.lower() for word in WORDS]
+    assert calls == ['Running', 'runs', 'ran']
+    assert (cache.hits, cache.misses) == (3, 3) and cache.hit_rate() == 0.5
+
+
+def test_size_bound():
+    cache = NormalisationCache('lower', str.lower, size=2)
+    assert [cache(word) for word in WORDS] == [word.lower() for word in WORDS]
+    assert cache.forms == {'Running': 'running', 'runs': 'runs'}
+    cache.merge({'ran': 'ran'}, 0, 0)
+    assert len(cache.forms) == 2
+
+
+def test_registry_and_pickle():
+    cache = normalisation_cache('upper', str.upper)
+    assert normalisation_cache('upper', str.lower) is cache
+    cache('a')
+    assert pickle.loads(pickle.dumps(cache)) is cache
+    normcache.normalisation_caches.clear()
+    unpickled = pickle.loads(pickle.dumps(cache))
+    assert unpickled is not cache and unpickled('b') == 'B' and unpickled.forms == {'b': 'B'}
+
+
+def analyse(sender):
+    # A forked analysis worker: normalises and sends back what it added
+    cache = normcache.normalisation_caches['upper']
+    [cache(word) for word in WORDS]
+    sender.send(drain_normalisation_caches())
+    sender.close()
+
+
+def test_drain_and_merge_from_forked_workers():
+    cache = normalisation_cache('upper', str.upper)
+    cache('ran')
+    cache.drain()
+    context = get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=analyse, args=(sender,))
+    process.start()
+    drained = receiver.recv()
+    process.join()
+    assert drained == {'upper': ({'Running': 'RUNNING', 'runs': 'RUNS'}, 4, 2)}
+    assert cache.forms == {'ran': 'RAN'}
+    merge_normalisation_caches(drained)
+    merge_normalisation_caches({'unknown': ({'a': 'A'}, 1, 0)})
+    assert cache.forms == {'ran': 'RAN', 'Running': 'RUNNING', 'runs': 'RUNS'}
+    assert (cache.hits, cache.misses) == (4, 2)
+    assert cache.drain() == ({}, 4, 2)
+
+
+def test_save_and_load(tmp_path):
+    path = str(tmp_path / 'normalisation_cache')
+    cache = normalisation_cache('lower', str.lower)
+    [cache(word) for word in WORDS]
+    save_normalisation_caches(path)
+    normcache.normalisation_caches.clear()
+    loaded = normalisation_cache('lower', str.lower, path=path)
+    assert loaded is not cache and loaded.forms == cache.forms
+    assert loaded('Running') == 'running' and loaded.hits == 1
+    loaded.clear()
+    assert loaded.forms == {} and loaded.hits == 0
@@ -0,0 +1,110 @@
+""" Round-trip tests of the posting file against the count matrix it was written from """
+
+import pickle
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from postingfile import (CompressedPostingLists, open_posting_file, posting_file_exists, save_posting_file,
+                         vbyte_decode, vbyte_encode)
+from postings import PostingLists
+
+
+def random_counts(seed, n_docs=300, n_terms=40, density=0.1):
+    rng = np.random.default_rng(seed)
+    counts = sparse.random(n_docs, n_terms, density=density, format='csr', random_state=rng,
+                           data_rvs=lambda n: rng.integers(1, 6, n))
+    counts = counts.tolil()
+    counts[0, 0], counts[n_docs - 1, 1] = 300, 70000  # counts that do not fit in a byte
+    counts[:, n_terms - 1] = 0  # a term without postings
+    return counts.tocsr().astype(np.int64)
+
+
+def vocabulary_of(n_terms):
+    # Not in column order, and not ASCII, so the dictionary order differs from the columns
+    return {f'térm{(i * 7) % n_terms:03}': i for i in range(n_terms)}
+
+
+@pytest.fixture(params=[1, 4, 128])
+def posting_file(tmp_path, request):
+    counts = random_counts(request.param)
+    vocabulary = vocabulary_of(counts.shape[1])
+    posting_file = save_posting_file(str(tmp_path / 'postings'), counts, vocabulary, block_size=request.param)
+    yield counts, vocabulary, posting_file
+    posting_file.close()
+
+
+def test_vbyte_round_trip():
+    values = np.array([0, 1, 127, 128, 16383, 16384, 2 ** 35, 2 ** 62], dtype=np.int64)
+    encoded, n_bytes = vbyte_encode(values)
+    assert len(encoded) == n_bytes.sum()
+    assert np.array_equal(vbyte_decode(encoded), values)
+    assert not len(vbyte_decode(np.zeros(0, dtype=np.uint8)))
+
+
+def test_count_matrix(posting_file):
+    counts, _, posting_file = posting_file
+    assert (posting_file.n_docs, posting_file.n_terms) == counts.shape
+    assert (posting_file.count_matrix() != counts).nnz == 0
+    assert np.array_equal(posting_file.document_frequencies(), np.diff(counts.tocsc().indptr))
+
+
+def test_postings_and_decode(posting_file):
+    counts, _, posting_file = posting_file
+    counts = counts.tocsc()
+    terms = [3, 0, 39, 3, 1]
+    docs, term_counts, lengths = posting_file.decode(terms)
+    assert np.array_equal(lengths, [counts.indptr[t + 1] - counts.indptr[t] for t in terms])
+    assert np.array_equal(docs, np.concatenate([counts[:, t].indices for t in terms]))
+    assert np.array_equal(term_counts, np.concatenate([counts[:, t].data for t in terms]))
+    for term in range(counts.shape[1]):
+        assert np.array_equal(posting_file.postings(term), counts[:, term].indices)
+
+
+def test_lookup(posting_file):
+    counts, _, posting_file = posting_file
+    docs = np.array([0, 5, 5, 17, 150, 299])
+    for term in range(counts.shape[1]):
+        assert np.array_equal(posting_file.lookup(term, docs), counts[docs, term].toarray().ravel())
+    assert not len(posting_file.lookup(0, []))
+
+
+def test_term_dictionary(posting_file):
+    counts, vocabulary, posting_file = posting_file
+    assert posting_file.vocabulary() == vocabulary
+    assert list(posting_file.vocabulary()) == list(vocabulary)
+    for term, column in vocabulary.items():
+        assert posting_file.column(term) == column
+    for term in ('', 'term000', 'zzz', 'térm'):
+        assert posting_file.column(term) == -1
+
+
+def test_compressed_posting_lists(posting_file):
+    counts, _, posting_file = posting_file
+    compressed, plain = CompressedPostingLists(posting_file), PostingLists(counts > 0)
+    term_lists = [[0, 1, 2], [5], [], [39, 3, 3], list(range(40))]
+    thresholds = [2, 1, 1, 1, 3]
+    for expected, matches in zip(plain.at_least_many(term_lists, thresholds),
+                                 compressed.at_least_many(term_lists, thresholds)):
+        assert np.array_equal(matches, expected)
+
+
+def test_files_and_pickle(tmp_path):
+    counts, vocabulary = random_counts(0), vocabulary_of(40)
+    path = str(tmp_path / 'nested' / 'postings')
+    assert not posting_file_exists(path)
+    save_posting_file(path, counts, vocabulary).close()
+    assert posting_file_exists(path)
+    posting_file = pickle.loads(pickle.dumps(open_posting_file(path)))
+    assert (posting_file.count_matrix() != counts).nnz == 0
+    assert posting_file.size() > 0
+    posting_file.close()
+
+
+def test_empty(tmp_path):
+    posting_file = save_posting_file(str(tmp_path / 'postings'), sparse.csr_matrix((3, 0), dtype=np.int64), {})
+    assert posting_file.count_matrix().shape == (3, 0)
+    assert posting_file.vocabulary() == {}
+    assert posting_file.column('term') == -1
+    posting_file.close()
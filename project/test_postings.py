@@ -0,0 +1,67 @@
+""" Brute-force tests of the posting list queries against the dense boolean matrix """
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from postings import PostingLists
+
+
+@pytest.fixture(params=range(5))
+def matrix(request):
+    rng = np.random.default_rng(request.param)
+    return rng.random((60, 25)) < rng.uniform(0.05, 0.5)
+
+
+def brute_at_least(matrix, terms, m):
+    terms = sorted({term for term in terms if term >= 0})
+    return np.flatnonzero(matrix[:, terms].sum(axis=1) >= m)
+
+
+def test_postings_and_gather(matrix):
+    postings = PostingLists(sparse.csr_matrix(matrix))
+    for term in range(matrix.shape[1]):
+        assert np.array_equal(postings.postings(term), np.flatnonzero(matrix[:, term]))
+    assert np.array_equal(postings.document_frequencies(), matrix.sum(axis=0))
+    terms = [4, 0, 4, 24]
+    rows, lengths = postings.gather(terms)
+    assert np.array_equal(rows, np.concatenate([np.flatnonzero(matrix[:, term]) for term in terms]))
+    assert np.array_equal(lengths, matrix[:, terms].sum(axis=0))
+
+
+def test_duplicates_are_summed():
+    matrix = sparse.coo_matrix(([1, 1, 1], ([2, 0, 2], [1, 1, 1])), shape=(3, 2))
+    assert np.array_equal(PostingLists(matrix).postings(1), [0, 2])
+
+
+def test_at_least(matrix):
+    postings = PostingLists(matrix)
+    rng = np.random.default_rng(0)
+    for _ in range(50):
+        terms = rng.choice(matrix.shape[1], rng.integers(0, 8)).tolist()  # with repeats
+        m = int(rng.integers(-1, 5))
+        expected = np.arange(len(matrix)) if m <= 0 else brute_at_least(matrix, terms, m)
+        assert np.array_equal(postings.at_least(terms, m), expected)
+
+
+def test_at_least_many(matrix):
+    postings = PostingLists(matrix)
+    term_lists = [[0, 1, 2], [], [3, 3], list(range(25)), [7]]
+    thresholds = [2, 1, 1, 10, 0]
+    for terms, m, matches in zip(term_lists, thresholds, postings.at_least_many(term_lists, thresholds)):
+        expected = np.arange(len(matrix)) if m <= 0 else brute_at_least(matrix, terms, m)
+        assert np.array_equal(matches, expected)
+    assert postings.at_least_many([], []) == []
+
+
+def test_at_least_prefixes(matrix):
+    postings = PostingLists(matrix)
+    rng = np.random.default_rng(1)
+    for _ in range(50):
+        ranked_terms = rng.permutation(matrix.shape[1])[:rng.integers(0, 12)]
+        ranked_terms[rng.random(len(ranked_terms)) < 0.2] = -1  # unknown terms
+        ks = rng.integers(0, 14, 6).tolist()
+        thresholds = rng.integers(-1, 5, 6).tolist()
+        for k, m, matches in zip(ks, thresholds, postings.at_least_prefixes(ranked_terms, ks, thresholds)):
+            expected = np.arange(len(matrix)) if m <= 0 else brute_at_least(matrix, ranked_terms[:k].tolist(), m)
+            assert np.array_equal(matches, expected)
@@ -0,0 +1,82 @@
+""" Brute-force tests of QrelsIndex against plain judgement dicts """
+
+import numpy as np
+import pytest
+
+import qrels
+from qrels import UNJUDGED, QrelsIndex, as_qrels
+
+
+@pytest.fixture(params=range(3))
+def judgements(request):
+    rng = np.random.default_rng(request.param)
+    topics, docs = [f'R{i}' for i in range(8)], [f'd{i}' for i in range(40)]
+    return [(topics[q], docs[d], int(relevant)) for q, d, relevant in
+            zip(rng.integers(0, 8, 150), rng.integers(0, 40, 150), rng.random(150) < 0.3)]
+
+
+def brute_labels(judgements):
+    # A doc judged both ways counts as relevant
+    labels = {}
+    for q_id, doc_id, relevant in judgements:
+        labels[q_id, doc_id] = max(labels.get((q_id, doc_id), UNJUDGED), relevant)
+    return labels
+
+
+def test_labels(judgements):
+    index, labels = QrelsIndex(judgements), brute_labels(judgements)
+    doc_ids = [f'd{i}' for i in range(45)]
+    for q_id in [f'R{i}' for i in range(9)]:
+        expected = [labels.get((q_id, doc_id), UNJUDGED) for doc_id in doc_ids]
+        assert [index.get_label(q_id, doc_id) for doc_id in doc_ids] == expected
+        assert index.label(q_id, doc_ids).tolist() == expected
+        assert index.label(q_id, doc_ids[::-1] + doc_ids[:3]).tolist() == expected[::-1] + expected[:3]
+        assert [index.is_relevant(q_id, doc_id) for doc_id in doc_ids] == [label == 1 for label in expected]
+        assert [index.is_judged(q_id, doc_id) for doc_id in doc_ids] == [label != UNJUDGED for label in expected]
+    assert index.label('R0', []).tolist() == []
+
+
+def test_judged_lists(judgements):
+    index = QrelsIndex(judgements)
+    assert len(index) == len(judgements)
+    assert list(index) == judgements
+    for q_id in [f'R{i}' for i in range(9)]:
+        assert index.positives(q_id) == [d for q, d, relevant in judgements if q == q_id and relevant]
+        assert index.negatives(q_id) == [d for q, d, relevant in judgements if q == q_id and not relevant]
+
+
+def test_dicts_round_trip(judgements):
+    topic_index, doc_index, topic_index_n, doc_index_n = QrelsIndex(judgements).to_dicts()
+    assert sum(map(len, topic_index.values())) == sum(map(len, doc_index.values())) == sum(r for *_, r in judgements)
+    index = QrelsIndex.from_topic_index(topic_index, topic_index_n)
+    assert brute_labels(index) == brute_labels(judgements)
+    assert index.to_dicts()[0] == topic_index and index.to_dicts()[2] == topic_index_n
+
+
+def test_merge(judgements):
+    half = len(judgements) // 2
+    merged = QrelsIndex(judgements[:half]).merge(QrelsIndex(judgements[half:]))
+    assert list(merged) == judgements
+
+
+def test_empty():
+    index = QrelsIndex()
+    assert len(index) == 0
+    assert index.get_label('R1', 'd1') == UNJUDGED
+    assert index.label('R1', ['d1']).tolist() == [UNJUDGED]
+    assert index.positives('R1') == []
+
+
+def test_as_qrels_cache(monkeypatch):
+    monkeypatch.setattr(qrels, 'qrels_cache', type(qrels.qrels_cache)())
+    monkeypatch.setattr(qrels, 'QRELS_CACHE_SIZE', 2)
+    topic_index, topic_index_n = {'R1': ['d1']}, {'R1': ['d2']}
+    index = as_qrels(topic_index, topic_index_n)
+    assert as_qrels(topic_index, topic_index_n) is index
+    assert as_qrels({'p': topic_index, 'n': topic_index_n}) is index
+    assert as_qrels(dict(topic_index), topic_index_n) is not index  # keyed on identity, not contents
+    assert as_qrels(index) is index
+    assert index.get_label('R1', 'd1') == 1 and index.get_label('R1', 'd2') == 0
+    as_qrels({}, {}), as_qrels({}, {})
+    assert len(qrels.qrels_cache) == 2
+    assert as_qrels(topic_index, topic_index_n) is not index  # evicted
@@ -0,0 +1,50 @@
+""" Tests of the query result cache tiers and index generations """
+
+from querycache import GENERATION_FILE, QueryCache, read_generation, write_generation
+
+RESULTS = [('d1', 2.5), ('d2', 1.0)]
+
+
+def test_key():
+    key = QueryCache.key(' economic\tgrowth \n', 'bm25', 'g1', 10)
+    assert key == QueryCache.key('economic growth', 'bm25', 'g1', 10)
+    assert len({key, QueryCache.key('economic growth', 'tfidf', 'g1', 10),
+                QueryCache.key('economic growth', 'bm25', 'g2', 10),
+                QueryCache.key('economic growth', 'bm25', 'g1', 20)}) == 4
+
+
+def test_memory_tier_is_lru():
+    cache = QueryCache(size=2)
+    for query in ('a', 'b'):
+        cache.put(query, 'bm25', [(query, 1.0)])
+    assert cache.get('a', 'bm25') == [('a', 1.0)]
+    cache.put('c', 'bm25', [])
+    assert cache.get('b', 'bm25') is None  # least recently used
+    assert cache.get('a', 'bm25') == [('a', 1.0)] and cache.get('c', 'bm25') == []
+    assert cache.stats() == {'hits': 3, 'disk hits': 0, 'misses': 1, 'hit rate': 0.75, 'entries': 2}
+
+
+def test_persistent_tier(tmp_path):
+    path = str(tmp_path / 'query_cache')
+    bm25_key, tfidf_key = QueryCache.key('a', 'bm25', 'g1', 10), QueryCache.key('a', 'tfidf', 'g1', 10)
+    cache = QueryCache(size=1, path=path)
+    cache.put(bm25_key, 'bm25', RESULTS)
+    cache.put(tfidf_key, 'tfidf', [])
+    assert cache.get(bm25_key, 'bm25') == RESULTS  # evicted from memory, read from disk
+    assert cache.disk_hits == 1
+    assert {file.name.split('.')[0] for file in (tmp_path / 'query_cache').iterdir()} == {'bm25', 'tfidf'}
+    cache.close()
+    cache = QueryCache(path=path)
+    assert cache.get(bm25_key, 'tfidf') is None  # one shelve per scoring
+    assert cache.get(bm25_key, 'bm25') == RESULTS and cache.get(tfidf_key, 'tfidf') == []
+    assert cache.stats()['disk hits'] == 2
+    cache.export_stats(str(tmp_path / 'stats.json'))
+    cache.close()
+
+
+def test_generations(tmp_path):
+    generation = read_generation(str(tmp_path))  # written on first read
+    assert (tmp_path / GENERATION_FILE).read_text() == generation
+    assert read_generation(str(tmp_path)) == generation
+    assert write_generation(str(tmp_path)) != generation
+    assert QueryCache.key('a', 'bm25', generation, 10) != QueryCache.key('a', 'bm25', read_generation(str(tmp_path)), 10)
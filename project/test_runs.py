@@ -0,0 +1,103 @@
+""" Round-trip tests of the binary run files """
+
+import copy
+import pickle
+
+import pytest
+
+from runs import export_trec_run, load_run, save_run
+
+
+def ranking_result(doc_ids, labels):
+    return {
+        'related_documents': {doc_ids[0], 'unranked'},
+        'total_result': len(doc_ids),
+        'visited_documents': tuple(doc_ids),
+        'visited_scores': tuple(float(len(doc_ids) - rank) / 2 for rank in range(len(doc_ids))),
+        'visited_documents_orders': {doc_id: rank + 1 for rank, doc_id in enumerate(doc_ids)},
+        'assessed_documents': {doc_id: (doc_ids.index(doc_id) + 1, label) for doc_id, label in labels.items()},
+    }
+
+
+@pytest.fixture
+def results():
+    return {
+        'R101': ranking_result(['d3', 'd1', 'd2'], {'d3': 1, 'd2': 0}),
+        'R102': ranking_result(['d2', 'd9'], {}),
+        'R103': {'related_documents': set(), 'total_result': 0, 'visited_documents': ()},
+        'R104': {'retrieved_documents': {'d1': 0.5, 'd4': 2.0}, 'total_result': 2},
+    }
+
+
+def as_saved(results):
+    # Sequences are read back as lists
+    return {q_id: {field: list(value) if isinstance(value, tuple) else value for field, value in result.items()}
+            for q_id, result in results.items()}
+
+
+@pytest.fixture
+def path(tmp_path, results):
+    path = str(tmp_path / 'run.npz')
+    save_run(path, results)
+    return path
+
+
+def test_round_trip(path, results):
+    with load_run(path) as run:
+        assert list(run) == list(results)
+        assert dict(run) == as_saved(results)
+
+
+def test_lazy_decoding(path, results):
+    run = load_run(path)
+    assert run['R102'] == as_saved(results)['R102']
+    assert run._undecoded == {'R101', 'R103', 'R104'}
+    with pytest.raises(KeyError):
+        run['R999']
+    for q_id in ('R101', 'R103', 'R104'):
+        run[q_id]
+    assert not run._undecoded
+    assert dict(run) == as_saved(results)
+
+
+def test_edit(path, results):
+    run = load_run(path)
+    run['R105'] = {'total_result': 7}
+    del run['R101']
+    run['R102'] = {'total_result': 1}
+    with pytest.raises(KeyError):
+        del run['R999']
+    expected = as_saved(results)
+    del expected['R101']
+    expected.update({'R102': {'total_result': 1}, 'R105': {'total_result': 7}})
+    assert list(run) == ['R102', 'R103', 'R104', 'R105']
+    assert dict(run) == expected
+
+
+def test_pickle_and_deepcopy(path, results):
+    run = load_run(path)
+    run['R101']
+    run['R105'] = {'total_result': 7}
+    del run['R103']
+    expected = dict(run)
+    reopened = pickle.loads(pickle.dumps(run))
+    assert list(reopened) == list(run)
+    assert dict(reopened) == expected
+    copied = copy.deepcopy(run)
+    assert type(copied) is dict and copied == expected
+    copied['R101']['visited_documents'].append('d0')
+    assert run['R101'] == as_saved(results)['R101']
+
+
+def test_empty_run(tmp_path):
+    path = str(tmp_path / 'run.npz')
+    save_run(path, {})
+    assert dict(load_run(path)) == {}
+
+
+def test_export_trec_run(tmp_path, results):
+    path = tmp_path / 'run.trec'
+    export_trec_run({'R101': results['R101'], 'R102': {'visited_documents': ['d2', 'd9']}}, str(path), 'test')
+    assert path.read_text().splitlines() == [
+        'R101 Q0 d3 1 1.5 test', 'R101 Q0 d1 2 1.0 test', 'R101 Q0 d2 3 0.5 test',
+        'R102 Q0 d2 1 2 test', 'R102 Q0 d9 2 1 test']
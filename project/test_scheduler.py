@@ -0,0 +1,122 @@
+""" Tests of the stage DAG scheduler: staleness, loaders and forked stages """
+
+import os
+
+import pytest
+
+from scheduler import Scheduler
+
+
+class Pipeline:
+    # source -> double -> report, with source and double checkpointed to files; every run is logged to a file so
+    # stages running in forked processes are counted too
+    def __init__(self, directory):
+        self.directory = directory
+        self.log = directory / 'log'
+        self.source, self.double = str(directory / 'source'), str(directory / 'double')
+
+    def ran(self, name):
+        with open(self.log, 'a') as f:
+            f.write(f'{name}\n')
+
+    def runs(self):
+        runs = self.log.read_text().split() if self.log.exists() else []
+        self.log.unlink(missing_ok=True)
+        return runs
+
+    def write_source(self):
+        self.ran('source')
+        with open(self.source, 'w') as f:
+            f.write('21')
+        return 21
+
+    def write_double(self, value):
+        self.ran('double')
+        with open(self.double, 'w') as f:
+            f.write(str(2 * value))
+
+    def report(self, value):
+        self.ran('report')
+        return f'value {value}'
+
+    def scheduler(self, workers=1):
+        scheduler = Scheduler(workers)
+        scheduler.add('source', self.write_source, outputs=(self.source,), loader=read_int)
+        scheduler.add('double', self.write_double, ('source',), (self.double,), read_int)
+        scheduler.add('report', self.report, ('double',))
+        return scheduler
+
+
+def read_int(path):
+    with open(path) as f:
+        return int(f.read())
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_up_to_date_stages_are_loaded(tmp_path, workers):
+    pipeline = Pipeline(tmp_path)
+    values = pipeline.scheduler(workers).run(['report'])
+    assert values['report'] == 'value 42'
+    assert pipeline.runs() == ['source', 'double', 'report']
+    scheduler = pipeline.scheduler(workers)
+    values = scheduler.run(['report'])
+    assert values['report'] == 'value 42'
+    assert pipeline.runs() == ['report']
+    assert 'source' not in values  # only loaded when a running stage needs it
+    assert scheduler.value('double') == 42
+
+
+def test_stale_outputs_rerun_their_consumers(tmp_path):
+    pipeline = Pipeline(tmp_path)
+    pipeline.scheduler().run()
+    pipeline.runs()
+    os.utime(pipeline.double, (0, 0))  # older than its input
+    pipeline.scheduler().run()
+    assert pipeline.runs() == ['double', 'report']
+    os.remove(pipeline.source)
+    pipeline.scheduler().run()
+    assert pipeline.runs() == ['source', 'double', 'report']
+
+
+def test_plan(tmp_path):
+    pipeline = Pipeline(tmp_path)
+    scheduler = pipeline.scheduler()
+    scheduler.add('unused', lambda value: value, ('source',))
+    scheduler.add('leaf', lambda: 1)
+    assert scheduler.plan() == {'source': True, 'double': True, 'report': True, 'unused': True, 'leaf': True}
+    scheduler.run()
+    scheduler = pipeline.scheduler()
+    scheduler.add('unused', lambda value: value, ('report',))
+    scheduler.add('side', lambda value: value, ('source',))
+    scheduler.add('consumer', lambda value: value, ('side',))
+    # report has no outputs, so it runs whenever a stage consuming it does
+    assert scheduler.plan() == {'source': False, 'double': False, 'report': True, 'unused': True, 'side': True,
+                                'consumer': True}
+    scheduler = pipeline.scheduler()
+    scheduler.add('side', lambda value: value, ('source',))
+    assert scheduler.plan() == {'source': False, 'double': False, 'report': True, 'side': True}
+    (tmp_path / 'consumer').write_text('')
+    scheduler.add('consumer', lambda value: value, ('report',), (str(tmp_path / 'consumer'),))
+    # An up to date consumer does not need it: report only runs as a target
+    assert not scheduler.plan()['report'] and scheduler.plan(['report'])['report']
+
+
+def test_local_and_forked_stages(tmp_path):
+    scheduler = Scheduler(3)
+    pid = os.getpid()
+    scheduler.add('a', os.getpid)
+    scheduler.add('b', os.getpid, local=True)
+    scheduler.add('c', lambda a, b: (a, b), ('a', 'b'))
+    values = scheduler.run()
+    assert values['b'] == pid and values['a'] != pid
+    assert values['c'] == (values['a'], pid)
+
+
+@pytest.mark.parametrize('workers', [1, 2])
+def test_errors(workers):
+    scheduler = Scheduler(workers)
+    with pytest.raises(ValueError):
+        scheduler.add('b', lambda a: a, ('a',))
+    scheduler.add('a', lambda: 1 / 0)
+    with pytest.raises((RuntimeError, ZeroDivisionError)):
+        scheduler.run()
@@ -0,0 +1,112 @@
+""" On-disk cache of analysed token streams
+The cache of an analyzer over a corpus lives in token_cache/<analyzer>_<corpus fingerprint>/:
+    vocabulary.json         term id -> term
+    <field>.tokens.npy      term ids of the field, one document after the other
+    <field>.offsets.npy     (n_docs + 1) start of every document in <field>.tokens.npy
+    topics.json             analysed query texts
+Fields are analysed separately, as Whoosh does when indexing them; joined they are the tokens of the whole document.
+"""
+
+import fcntl
+import hashlib
+import json
+import os
+
+import numpy as np
+
+TOKEN_CACHE_PATH = 'token_cache'
+
+
+def corpus_fingerprint(D):
+    fingerprint = hashlib.sha1()
+    for doc_id, doc in D.items():
+        fingerprint.update(doc_id.encode('utf8'))
+        for field, value in doc.items():
+            fingerprint.update(f'\0{field}\0{len(value)}\0'.encode('utf8'))
+            fingerprint.update(value.encode('utf8'))
+    return fingerprint.hexdigest()[:16]
+
+
+class TokenStreamCache:
+    def __init__(self, path, analyzer=None):
+        self.path = path
+        self.analyzer = analyzer
+        with open(f'{path}/vocabulary.json', encoding='utf8') as f:
+            meta = json.load(f)
+        self.fields, self.vocabulary = tuple(meta['fields']), np.array(meta['vocabulary'], dtype=object)
+        self.tokens = {field: np.load(f'{path}/{field}.tokens.npy', mmap_mode='r') for field in self.fields}
+        self.offsets = {field: np.load(f'{path}/{field}.offsets.npy', mmap_mode='r') for field in self.fields}
+        self.topics = {}
+        if os.path.isfile(f'{path}/topics.json'):
+            with open(f'{path}/topics.json', encoding='utf8') as f:
+                self.topics = json.load(f)
+
+    def __len__(self):
+        return len(self.offsets[self.fields[0]]) - 1 if self.fields else 0
+
+    def field_tokens(self, row, field):
+        start, end = self.offsets[field][row], self.offsets[field][row + 1]
+        return self.vocabulary[self.tokens[field][start:end]].tolist()
+
+    def doc_tokens(self, row):
+        return [token for field in self.fields for token in self.field_tokens(row, field)]
+
+    def raw_texts(self):
+        return [' '.join(self.doc_tokens(row)) for row in range(len(self))]
+
+    def analyse(self, raw_text):
+        if raw_text not in self.topics:
+            self.topics[raw_text] = self.analyzer.process_raw_text(raw_text)
+            self.save_topics()
+        return self.topics[raw_text]
+
+    def save_topics(self):
+        # Forked stages analyse topics at the same time: under a lock, the file is merged with what the others wrote
+        # and swapped in whole, so no reader sees it half written and no process drops the others' entries
+        path = f'{self.path}/topics.json'
+        with open(f'{path}.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if os.path.isfile(path):
+                with open(path, encoding='utf8') as f:
+                    self.topics = {**json.load(f), **self.topics}
+            with open(f'{path}.{os.getpid()}.tmp', 'w', encoding='utf8') as f:
+                json.dump(self.topics, f)
+            os.replace(f'{path}.{os.getpid()}.tmp', path)
+
+
+def token_cache_path(D, analyzer, fingerprint=None):
+    # Pass the corpus fingerprint when it is known, hashing the corpus is the slow part
+    return f'{TOKEN_CACHE_PATH}/{analyzer}_{fingerprint or corpus_fingerprint(D)}'
+
+
+def load_token_cache(D, analyzer, fingerprint=None):
+    path = token_cache_path(D, analyzer, fingerprint)
+    if os.path.isfile(f'{path}/vocabulary.json'):
+        print(f"Token cache found in \"{path}\"")
+    else:
+        print(f"Token cache not found, analysing corpus into \"{path}\"...")
+        build_token_cache(path, D, analyzer)
+    return TokenStreamCache(path, analyzer)
+
+
+def build_token_cache(path, D, analyzer):
+    fields = tuple(next(iter(D.values())).keys()) if len(D) else ()
+    field_texts = analyzer.process_raw_texts([doc[field] for doc in D.values() for field in fields])
+    vocabulary, term_ids = [], {}
+    tokens, offsets = {field: [] for field in fields}, {field: [0] for field in fields}
+    for i, field_text in enumerate(field_texts):
+        field = fields[i % len(fields)]
+        for token in field_text.split():
+            if token not in term_ids:
+                term_ids[token] = len(vocabulary)
+                vocabulary.append(token)
+            tokens[field].append(term_ids[token])
+        offsets[field].append(len(tokens[field]))
+
+    os.makedirs(path, exist_ok=True)
+    for field in fields:
+        np.save(f'{path}/{field}.tokens.npy', np.array(tokens[field], dtype=np.int32))
+        np.save(f'{path}/{field}.offsets.npy', np.array(offsets[field], dtype=np.int64))
+    # Written last, its presence marks a complete cache
+    with open(f'{path}/vocabulary.json', 'w', encoding='utf8') as f:
+        json.dump({'fields': fields, 'vocabulary': vocabulary}, f)
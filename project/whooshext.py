@@ -0,0 +1,76 @@
+""" Whoosh extensions
+Named scorings and the WordNet lemma filter. They subclass Whoosh classes, so they live apart from main, which only
+loads this module (and Whoosh) when an index, analyzer chain or scoring is first built.
+WordNet is never fetched over the network unless DOWNLOAD_WORDNET is set; otherwise a missing WordNet raises a
+LookupError naming the command that installs it.
+"""
+
+import whoosh.scoring
+from whoosh.analysis import Filter
+
+from lazy import LazyModule, lazy_import
+from normcache import normalisation_cache
+
+nltk = LazyModule('nltk')
+WordNetLemmatizer = lazy_import('nltk.stem', 'WordNetLemmatizer')
+
+DOWNLOAD_WORDNET = False  # fetch WordNet the first time a lemma is needed and it is not installed
+
+wordnet_lemmatizer = None
+
+
+class NamedBM25F(whoosh.scoring.BM25F):
+    def __init__(self, *args, **aargs):
+        super().__init__(*args, **aargs)
+        self.name = f"BM25_k1_{self.K1:.2f}_b_{self.B:.2f}".replace('.', ',')
+
+    def __str__(self):
+        return self.name
+
+
+class NamedTF_IDF(whoosh.scoring.TF_IDF):
+    def __init__(self, *args, **aargs):
+        super().__init__(*args, **aargs)
+        self.name = f"TF_IDF"
+
+    def __str__(self):
+        return self.name
+
+
+class LemmaFilter(Filter):
+    def __init__(self, normaliser=None):
+        self.lemmatize = normaliser or normalisation_cache('wordnet_lemma', lemmatize)
+
+    def __setstate__(self, state):
+        # Schemas pickled before the normalisation cache hold a WordNetLemmatizer in wnl instead
+        state.pop('wnl', None)
+        self.__dict__.update(state)
+        if 'lemmatize' not in state:
+            self.lemmatize = normalisation_cache('wordnet_lemma', lemmatize)
+
+    def __call__(self, tokens):
+        lemmatize = self.lemmatize
+        for t in tokens:
+            t.text = lemmatize(t.text)
+            yield t
+
+
+def wordnet_available():
+    # Only looks at the local NLTK data directories, never at the network
+    for resource in ('corpora/wordnet', 'corpora/wordnet.zip'):
+        try:
+            nltk.data.find(resource)
+            return True
+        except LookupError:
+            pass
+    return False
+
+
+def lemmatize(text):
+    global wordnet_lemmatizer
+    if wordnet_lemmatizer is None:
+        if not wordnet_available() and not (DOWNLOAD_WORDNET and nltk.download('wordnet', quiet=True) and wordnet_available()):
+            raise LookupError("WordNet is not installed: run \"python -m nltk.downloader wordnet\" to use the lemma "
+                              "analyzer, or set DOWNLOAD_WORDNET in whooshext.py to fetch it on first use")
+        wordnet_lemmatizer = WordNetLemmatizer()
+    return wordnet_lemmatizer.lemmatize(text)